@@ -0,0 +1,501 @@
+import argparse
+import configparser
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Throughput benchmark for creating, signing and verifying documents, and
+# for loading signers and scanning templates. It runs against a workspace of
+# synthetic templates, signers and keys built from templates/example.docx,
+# so results do not depend on local data. Every case runs in its own
+# process, so its peak RSS is its own; documents are created on a batch
+# worker pool as by desktop_app.batch, whose workers count towards it.
+# Results are written as JSON and compared against a baseline; the exit
+# code is 1 on a regression.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline_baseline.json')
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+PROFILES = {
+    'quick': {'pages': (1, 10, 100), 'concurrency': (1, 4), 'signers': 100, 'templates': 50},
+    'full': {'pages': (1, 10, 100, 300), 'concurrency': (1, 2, 4, 8), 'signers': 1000, 'templates': 200},
+}
+KEY_TYPES = ('rsa', 'ecdsa-p256', 'ed25519')
+# Private key used for creating documents, as generated by keygen by default
+CREATE_KEY = 'rsa'
+
+SEED = 20240601
+PASSWORD = 'benchmark'
+SIGNER = 'bench0000'
+# Paragraphs per page of the synthetic templates; one paragraph holds one
+# sentence, which keeps each page of the rendered document to one page
+PARAGRAPHS_PER_PAGE = 15
+# A create run covers about this many pages, and at least two documents per worker
+CREATE_PAGES = 200
+# Rows per task as in "doccreator batch --chunk-size", fewer when a run has too few documents for every worker
+CREATE_CHUNK = 16
+SIGNATURES = 40
+VERIFICATIONS = 40
+UPLOAD_CHUNK = 64 * 1024
+MIN_SECONDS = 0.5
+
+
+# Workspace
+
+def build_workspace(path, profile):
+    from docx import Document
+    from keygen.keygen import generate_key_pair
+
+    settings = PROFILES[profile]
+    templates_dir = os.path.join(path, 'templates')
+    scan_dir = os.path.join(path, 'scan')
+    for directory in (templates_dir, scan_dir, os.path.join(path, 'keys'), os.path.join(path, 'signers')):
+        os.makedirs(directory, exist_ok=True)
+
+    example_docx = os.path.join(ROOT, 'templates', 'example.docx')
+    example_ini = os.path.join(ROOT, 'templates', 'example.ini')
+    for pages in settings['pages']:
+        document = Document(example_docx)
+        for _ in range(pages - 1):
+            document.add_page_break()
+            for _ in range(PARAGRAPHS_PER_PAGE):
+                document.add_paragraph('{{Content}}')
+        document.save(os.path.join(templates_dir, f'pages-{pages}.docx'))
+        shutil.copyfile(example_ini, os.path.join(templates_dir, f'pages-{pages}.ini'))
+    for i in range(settings['templates']):
+        shutil.copyfile(example_docx, os.path.join(scan_dir, f'scan-{i:04d}.docx'))
+        shutil.copyfile(example_ini, os.path.join(scan_dir, f'scan-{i:04d}.ini'))
+
+    for key_type in KEY_TYPES:
+        generate_key_pair(key_path(path, key_type, 'public'), key_path(path, key_type, 'private'), key_type)
+
+    config_path = write_config(path, key_type=CREATE_KEY)
+    create_signers(path, config_path, settings['signers'])
+    return config_path
+
+
+def key_path(path, key_type, kind):
+    return os.path.join(path, 'keys', f'{key_type}-{kind}.pem')
+
+
+def write_config(path, key_type):
+    config = configparser.ConfigParser()
+    config['Paths'] = {
+        'templates_dir': os.path.join(path, 'templates'),
+        'signers_dir': os.path.join(path, 'signers'),
+        'public_key': key_path(path, key_type, 'public'),
+        'private_key': key_path(path, key_type, 'private'),
+        'output_dir': os.path.join(path, 'output'),
+        'drafts_dir': os.path.join(path, 'drafts'),
+        'registry': '',
+    }
+    config['Verification'] = {'url': 'https://verify.example.com/'}
+    config['Nextcloud'] = {'enabled': 'false'}
+    # Every verification does the public key operation
+    config['Webservice'] = {'cache_size': '0'}
+    config['Conversion'] = {'backend': 'builtin'}
+    # Cheap key derivation; unlocking is not what is measured
+    config['Signers'] = {'kdf': 'scrypt', 'scrypt_n': '1024'}
+    config['Logging'] = {'spans': 'false'}
+    config_path = os.path.join(path, 'config.ini')
+    with open(config_path, 'w') as f:
+        config.write(f)
+    return config_path
+
+
+def signature_png(rng):
+    # A handwriting-like stroke on a transparent background
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGBA', (900, 300), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(image)
+    points = [(x, 150 + rng.randint(-80, 80)) for x in range(40, 860, 30)]
+    draw.line(points, fill=(20, 20, 120, 255), width=6)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def create_signers(path, config_path, count):
+    from desktop_app.config.config_manager import ConfigManager
+    from desktop_app.models.author import Author
+
+    config = ConfigManager(config_path)
+    rng = random.Random(SEED)
+    png_path = os.path.join(path, 'signature.png')
+    with open(png_path, 'wb') as f:
+        f.write(signature_png(rng))
+    for i in range(count):
+        author = Author(f'Signer {i}', f'bench{i:04d}', f'signer{i}@example.com', '+49 30 1234567',
+                        '+49 170 1234567', 'Clerk', '', '', '', '', '', PASSWORD)
+        author.encrypt_signature(png_path, config, PASSWORD)
+
+
+def form_data(rng):
+    words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do')
+    return {
+        'ClientName': f'Client {rng.randint(1, 99999)}',
+        'ClientStreet': 'Main Street 1',
+        'ClientZIP': '10115',
+        'ClientPlace': 'Berlin',
+        'ClientState': 'Berlin',
+        'ClientCountry': 'Germany',
+        'Subject': 'Benchmark',
+        'Content': ' '.join(rng.choice(words) for _ in range(16)).capitalize() + '.',
+    }
+
+
+# Cases, each run in a child process
+
+def cases(profile):
+    settings = PROFILES[profile]
+    for pages in settings['pages']:
+        for concurrency in settings['concurrency']:
+            yield {'case': 'create', 'pages': pages, 'concurrency': concurrency}
+    for key_type in KEY_TYPES:
+        for pages in settings['pages']:
+            yield {'case': 'sign', 'key': key_type, 'pages': pages}
+    for key_type in KEY_TYPES:
+        for concurrency in settings['concurrency']:
+            yield {'case': 'verify', 'key': key_type, 'pages': 1, 'concurrency': concurrency}
+    for pages in settings['pages'][1:]:
+        yield {'case': 'verify', 'key': CREATE_KEY, 'pages': pages, 'concurrency': 1}
+    for index in ('cold', 'warm'):
+        yield {'case': 'signers', 'index': index, 'count': settings['signers']}
+    yield {'case': 'templates', 'count': settings['templates']}
+
+
+def case_id(case):
+    return ' '.join([case['case']] + [f'{key}={value}' for key, value in case.items() if key != 'case'])
+
+
+def timed(workload, count, repeat):
+    # Median rate over repeated runs; the first run warms caches and is not
+    # counted. Short workloads are repeated for at least MIN_SECONDS per run.
+    workload()
+    rates = []
+    for _ in range(repeat):
+        runs = 0
+        start = time.perf_counter()
+        while True:
+            workload()
+            runs += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= MIN_SECONDS:
+                break
+        rates.append(runs * count / elapsed)
+    per_sec = statistics.median(rates)
+    return {'count': count, 'seconds': round(count / per_sec, 4), 'per_sec': round(per_sec, 2)}
+
+
+def run_parallel(function, count, concurrency):
+    if concurrency == 1:
+        return [function(i) for i in range(count)]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(function, range(count)))
+
+
+def load_signer(config):
+    from desktop_app.models.author import Author
+
+    author = Author.load(SIGNER, config)
+    return author, author.decrypt_signature(config, PASSWORD)
+
+
+def unsigned_document(config, pages):
+    # The composed PDF of a pages-N template before the signature is appended
+    from desktop_app.utils.docx_converter import get_converter
+    from desktop_app.utils.pdf_creator import template_values
+    from desktop_app.utils.pdf_utils import compose_pdf
+    from desktop_app.utils.template_manager import TemplateManager
+
+    author, signature = load_signer(config)
+    values = template_values(form_data(random.Random(SEED)), author)
+    values['VerificationURL'] = config.get('Verification', 'url')
+    docx_data = TemplateManager(config).get_compiled_template(f'pages-{pages}.docx').fill(values)
+    base_pdf = io.BytesIO(get_converter(config).convert(docx_data))
+    output = io.BytesIO()
+    compose_pdf(output, [], signature, config.get('Verification', 'url'), base_pdf)
+    return output.getvalue()
+
+
+def run_create(workspace, config, case, repeat):
+    # The batch path: templates and the signer are loaded before the pool
+    # starts, each worker renders whole chunks and the results come back by IPC
+    from desktop_app import batch
+
+    template = f"pages-{case['pages']}.docx"
+    concurrency = case['concurrency']
+    count = max(2 * concurrency, CREATE_PAGES // case['pages'])
+    chunk_size = max(1, min(CREATE_CHUNK, count // (2 * concurrency)))
+    output_dir = tempfile.mkdtemp(dir=workspace)
+    rng = random.Random(SEED)
+    rows = list(enumerate(form_data(rng) for _ in range(count)))
+    sizes = []
+
+    config_file = os.path.join(workspace, 'config.ini')
+    os.environ[batch.PASSWORD_ENV] = PASSWORD
+    batch.preload_templates(config_file, template)
+    batch.preload_signers(config_file, SIGNER)
+    with ProcessPoolExecutor(max_workers=concurrency, initializer=batch.init_worker,
+                             initargs=(config_file, output_dir, template, SIGNER)) as executor:
+
+        def workload():
+            futures = [executor.submit(batch.render_chunk, chunk) for chunk in batch.chunked(rows, chunk_size)]
+            sizes.clear()
+            for future in futures:
+                for result in future.result():
+                    if result['error']:
+                        raise RuntimeError(f"Benchmark document failed: {result['error']}")
+                    sizes.append(os.path.getsize(result['path']))
+                    os.remove(result['path'])
+
+        result = timed(workload, count, repeat)
+    result['unit'] = 'documents'
+    result['bytes'] = sum(sizes) // count
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return result
+
+
+def run_sign(workspace, config, case, repeat):
+    from desktop_app.utils.pdf_signature import embed_signature
+    from desktop_app.utils.signing import SigningEngine
+
+    body = unsigned_document(config, case['pages'])
+    engine = SigningEngine(key_path(workspace, case['key'], 'private'))
+
+    def workload():
+        # Includes hashing the document, as when signing a file that was not hashed while written
+        for _ in range(SIGNATURES):
+            embed_signature(io.BytesIO(body), engine)
+
+    result = timed(workload, SIGNATURES, repeat)
+    result['unit'] = 'signatures'
+    result['bytes'] = len(body)
+    return result
+
+
+def run_verify(workspace, config, case, repeat):
+    from desktop_app.utils.pdf_signature import embed_signature
+    from desktop_app.utils.signing import SigningEngine, key_id, load_public_key
+    from webservice.verification import UploadVerifier
+
+    stream = io.BytesIO(unsigned_document(config, case['pages']))
+    embed_signature(stream, SigningEngine(key_path(workspace, case['key'], 'private')))
+    document = stream.getvalue()
+    public_key = load_public_key(key_path(workspace, case['key'], 'public'))
+    keys = {key_id(public_key): public_key}
+    concurrency = case['concurrency']
+    count = VERIFICATIONS * concurrency
+
+    def verify(i):
+        # The upload path of the web service: hashed while received, in chunks
+        verifier = UploadVerifier(keys, len(document))
+        for start in range(0, len(document), UPLOAD_CHUNK):
+            verifier.update(document[start:start + UPLOAD_CHUNK])
+        if not verifier.finish()['valid']:
+            raise RuntimeError('Benchmark document did not verify')
+
+    result = timed(lambda: run_parallel(verify, count, concurrency), count, repeat)
+    result['unit'] = 'documents'
+    result['bytes'] = len(document)
+    return result
+
+
+def run_signers(workspace, config, case, repeat):
+    from desktop_app.utils.signer_repository import INDEX_FILE, SignerRepository
+
+    signers_dir = config.get_signers_dir()
+
+    def workload():
+        if case['index'] == 'cold':
+            index_path = os.path.join(signers_dir, INDEX_FILE)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+        # A new repository each time, as in a newly started process
+        authors = SignerRepository(signers_dir).load_all()
+        if len(authors) != case['count']:
+            raise RuntimeError(f"Expected {case['count']} signers, found {len(authors)}")
+
+    result = timed(workload, case['count'], repeat)
+    result['unit'] = 'signers'
+    return result
+
+
+def run_templates(workspace, config, case, repeat):
+    from desktop_app.utils.template_manager import TemplateManager
+
+    config.config['Paths']['templates_dir'] = os.path.join(workspace, 'scan')
+
+    def workload():
+        # Listing, reading the questions and compiling every template, with an empty cache
+        TemplateManager._compiled_templates.clear()
+        manager = TemplateManager(config)
+        for name in manager.get_template_names():
+            manager.get_template_variables(name)
+            manager.get_template_settings(name)
+            manager.get_compiled_template(name)
+
+    result = timed(workload, case['count'], repeat)
+    result['unit'] = 'templates'
+    return result
+
+
+RUNNERS = {
+    'create': run_create,
+    'sign': run_sign,
+    'verify': run_verify,
+    'signers': run_signers,
+    'templates': run_templates,
+}
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Largest of this process and its finished workers
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_case(workspace, case, repeat):
+    from desktop_app.config.config_manager import ConfigManager
+
+    config = ConfigManager(os.path.join(workspace, 'config.ini'))
+    result = RUNNERS[case['case']](workspace, config, case, repeat)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_child(workspace, case, repeat):
+    env = dict(os.environ, PYTHONPATH=ROOT, DOCCREATOR_CONFIG=os.path.join(workspace, 'config.ini'))
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--workspace', workspace,
+                             '--case', json.dumps(case), '--repeat', str(repeat)],
+                            cwd=workspace, env=env, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+# Baseline
+
+def environment():
+    from importlib.metadata import PackageNotFoundError, version
+
+    packages = {}
+    for name in ('PyPDF2', 'reportlab', 'cryptography', 'python-docx', 'Pillow'):
+        try:
+            packages[name] = version(name)
+        except PackageNotFoundError:
+            packages[name] = None
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'packages': packages}
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance):
+    # Throughput may drop and peak memory grow by the tolerance; cases the
+    # baseline does not have are reported but not checked
+    failed = False
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            print(f"new:  {name}")
+            continue
+        checks = [('per_sec', result['per_sec'], expected['per_sec'] * (1 - tolerance), False)]
+        if result.get('peak_rss_mb') and expected.get('peak_rss_mb'):
+            checks.append(('peak_rss_mb', result['peak_rss_mb'], expected['peak_rss_mb'] * (1 + tolerance), True))
+        for metric, value, limit, upper in checks:
+            regressed = value > limit if upper else value < limit
+            if regressed:
+                print(f"FAIL: {name} {metric} {value} (baseline {expected[metric]}, limit {limit:.1f})")
+                failed = True
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure document throughput and memory against a baseline.')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='quick',
+                        help='quick: up to 100 pages; full: up to 300 pages and 8 workers')
+    parser.add_argument('--only', help='Comma-separated cases to run (create, sign, verify, signers, templates)')
+    parser.add_argument('--repeat', type=int, default=3, help='Measured runs per case, the median is reported')
+    parser.add_argument('--output', default='pipeline_results.json', help='Results JSON file')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.35,
+                        help='Allowed throughput drop and memory growth against the baseline (0.35 = 35%%)')
+    parser.add_argument('--update', action='store_true', help='Write the results as the new baseline')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated workspace')
+    parser.add_argument('--workspace', help=argparse.SUPPRESS)
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(args.workspace, json.loads(args.case), args.repeat)))
+        return 0
+
+    only = set(args.only.split(',')) if args.only else None
+    selected = [case for case in cases(args.profile) if only is None or case['case'] in only]
+    workspace = tempfile.mkdtemp(prefix='doccreator-bench-')
+    try:
+        start = time.perf_counter()
+        build_workspace(workspace, args.profile)
+        print(f"Workspace built in {time.perf_counter() - start:.1f}s: {workspace}")
+        results = {}
+        for case in selected:
+            name = case_id(case)
+            result = run_child(workspace, case, args.repeat)
+            results[name] = dict(case, **result)
+            print(f"{name:<45} {result['per_sec']:>10.2f} {result['unit']}/s  "
+                  f"{result['peak_rss_mb'] or 0:>7.1f} MB peak")
+    finally:
+        if args.keep:
+            print(f"Workspace kept at {workspace}")
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    report = {'profile': args.profile, 'environment': environment(), 'results': results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    print(f"Results written to {args.output}")
+
+    if args.update:
+        baseline = load_baseline(args.baseline) or {}
+        baseline.setdefault('profiles', {})[args.profile] = {'environment': report['environment'],
+                                                            'results': results}
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    baseline = (load_baseline(args.baseline) or {}).get('profiles', {}).get(args.profile)
+    if baseline is None:
+        print(f"No {args.profile} baseline in {args.baseline}, run with --update to create one")
+        return 0
+    failed = compare(results, baseline['results'], args.tolerance)
+    print('FAIL' if failed else 'ok: no regressions against the baseline')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Cold-start benchmark for the desktop app: import-time profile of the
+# main window and the time from process start to the first shown window.
+# Fails (exit code 1) if a module that should load on demand is imported
+# at startup or if the first window takes longer than the baseline allows.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_baseline.json')
+
+# Loaded on demand behind pdf_creator, signature_crypto and signature_image
+LAZY_MODULES = ('PyPDF2', 'reportlab', 'cryptography', 'PIL', 'docx', 'docx2pdf', 'lxml', 'sqlite3')
+
+FIRST_WINDOW = '''
+import json, sys, time
+start = time.perf_counter()
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QApplication
+from desktop_app.config.config_manager import ConfigManager
+from desktop_app.ui.main_window import MainWindow
+
+def shown():
+    modules = sorted({name.split('.')[0] for name in sys.modules})
+    print(json.dumps({'window_ms': (time.perf_counter() - start) * 1000, 'modules': modules}), flush=True)
+    app.quit()
+
+app = QApplication(sys.argv)
+window = MainWindow(ConfigManager('config.ini.default'))
+window.show()
+QTimer.singleShot(0, shown)
+app.exec_()
+'''
+
+
+def child_env():
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1')
+    # Headless machines (CI) have no display; the offscreen platform still creates the window
+    if not env.get('DISPLAY') and not env.get('WAYLAND_DISPLAY') and sys.platform.startswith('linux'):
+        env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    return env
+
+
+def first_window():
+    # Wall time includes interpreter start-up, which is what the user waits for
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', FIRST_WINDOW], cwd=ROOT, env=child_env(),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    total_ms = (time.perf_counter() - start) * 1000
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result['total_ms'] = total_ms
+    return result
+
+
+def import_profile(module='desktop_app.ui.main_window'):
+    # Parses the output of python -X importtime: (name, self µs, cumulative µs)
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT,
+                            env=child_env(), stderr=subprocess.PIPE, check=True).stderr
+    entries = []
+    for line in output.decode().splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        entries.append((name.strip(), int(own), int(cumulative)))
+    return entries
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure and check the cold start of the desktop app.')
+    parser.add_argument('--runs', type=int, default=5, help='Measured starts, the median is compared')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown against the baseline (0.25 = 25%%)')
+    parser.add_argument('--top', type=int, default=15, help='Slowest imports to list')
+    parser.add_argument('--update', action='store_true', help='Write the measured times as the new baseline')
+    args = parser.parse_args(argv)
+
+    entries = import_profile()
+    print("Slowest imports (cumulative) of desktop_app.ui.main_window:")
+    for name, own, cumulative in sorted(entries, key=lambda e: e[2], reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {own / 1000:8.1f} ms self  {name}")
+    import_ms = max(e[2] for e in entries) / 1000
+
+    # The first start also fills the OS file cache; it is not counted
+    first_window()
+    runs = [first_window() for _ in range(args.runs)]
+    total_ms = statistics.median(r['total_ms'] for r in runs)
+    window_ms = statistics.median(r['window_ms'] for r in runs)
+    print(f"Import of the main window: {import_ms:.1f} ms")
+    print(f"First window: {total_ms:.1f} ms from process start, {window_ms:.1f} ms after the interpreter "
+          f"(median of {args.runs})")
+
+    failed = False
+    loaded = sorted(set(runs[-1]['modules']) & set(LAZY_MODULES))
+    if loaded:
+        print(f"FAIL: loaded at startup although they should load on demand: {', '.join(loaded)}")
+        failed = True
+
+    measured = {'import_ms': round(import_ms, 1), 'first_window_ms': round(total_ms, 1)}
+    if args.update:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(measured, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+        return 1 if failed else 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f"No baseline at {args.baseline}, run with --update to create one")
+        return 1 if failed else 0
+    for key, value in measured.items():
+        limit = baseline[key] * (1 + args.tolerance)
+        status = 'ok' if value <= limit else 'FAIL'
+        print(f"{status}: {key} {value:.1f} ms (baseline {baseline[key]:.1f} ms, limit {limit:.1f} ms)")
+        failed = failed or value > limit
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
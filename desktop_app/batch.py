@@ -0,0 +1,299 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, ALL_COMPLETED, FIRST_COMPLETED
+from itertools import islice
+
+from desktop_app.config.config_manager import ConfigManager
+from desktop_app.utils.document_registry import get_registry, issued_now
+from desktop_app.utils.instrumentation import setup_logging
+
+TEMPLATE_COLUMN = 'template'
+SIGNER_COLUMN = 'signer'
+OUTPUT_COLUMN = 'output'
+PASSWORD_ENV = 'DOCCREATOR_SIGNER_PASSWORD'
+
+# Per-process worker state, set up once by init_worker
+_worker = None
+
+
+def read_rows(path, fmt=None):
+    if fmt is None:
+        fmt = 'jsonl' if path.endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BatchWorker:
+    def __init__(self, config_file, output_dir, template=None, signer=None, password_env=PASSWORD_ENV,
+                 merkle_leaves=0):
+        from desktop_app.utils.batch_signing import PendingSignatures
+        from desktop_app.utils.template_manager import TemplateManager
+
+        self.config = ConfigManager(config_file)
+        self.template_manager = TemplateManager(self.config)
+        self.output_dir = output_dir
+        self.template = template
+        self.signer = signer
+        self.password_env = password_env
+        self.templates = {}
+        self.signers = {}
+        # With batch signing, documents are left for run_batch to sign as a Merkle tree
+        self.batch_signing = PendingSignatures(merkle_leaves) if merkle_leaves else None
+
+    def get_template_variables(self, template_name):
+        if template_name not in self.templates:
+            self.templates[template_name] = self.template_manager.get_template_variables(template_name)
+        return self.templates[template_name]
+
+    def get_signer(self, short_name):
+        from desktop_app.models.author import Author
+
+        if short_name not in self.signers:
+            author = Author.load(short_name, self.config)
+            if author is None:
+                raise ValueError(f"Unknown signer: {short_name}")
+            signature = author.decrypt_signature(self.config, signer_password(self.password_env, short_name))
+            if signature is None:
+                raise ValueError(f"Signature of {short_name} could not be unlocked (set {self.password_env})")
+            self.signers[short_name] = (author, signature)
+        return self.signers[short_name]
+
+    def render(self, index, row):
+        from desktop_app.utils.pdf_creator import render_document
+        from desktop_app.utils.nextcloud import enqueue_document
+
+        row = dict(row)
+        template_name = row.pop(TEMPLATE_COLUMN, None) or self.template
+        short_name = row.pop(SIGNER_COLUMN, None) or self.signer
+        output_name = row.pop(OUTPUT_COLUMN, None)
+        if not template_name or not short_name:
+            raise ValueError("Row has no template or signer")
+
+        variables = self.get_template_variables(template_name)
+        if variables:
+            # Columns match variables regardless of case; keep the column's spelling
+            columns = {column.lower(): column for column in row}
+            form_data = {}
+            for key in variables:
+                column = columns.get(key.lower(), key)
+                form_data[column] = row.get(column, '')
+        else:
+            form_data = row
+        author, signature = self.get_signer(short_name)
+
+        if not output_name:
+            output_name = f"{index:06d}-{os.path.splitext(template_name)[0]}-{short_name}.pdf"
+        output_path = output_file(self.output_dir, output_name)
+        path, fingerprint = render_document(self.config, template_name, form_data, author, output_path, signature,
+                                            batch_signing=self.batch_signing)
+        if self.batch_signing is None:
+            # Queued for "doccreator archive run" or the desktop app to upload
+            enqueue_document(self.config, path, template_name, form_data, short_name)
+        return path, fingerprint, template_name, short_name, form_data
+
+    def render_chunk(self, chunk):
+        results = []
+        for index, row in chunk:
+            result = {'row': index, 'path': None, 'fingerprint': None, 'template': None, 'signer': None,
+                      'issued_at': None, 'seconds': None, 'error': None}
+            start = time.perf_counter()
+            try:
+                result['path'], fingerprint, result['template'], result['signer'], form_data = self.render(index, row)
+                result['fingerprint'] = str(fingerprint)
+                result['issued_at'] = issued_now()
+                if self.batch_signing is not None:
+                    # Leaf and signature offset for sealing, and the form data to queue the upload after it
+                    _, leaf, offset = self.batch_signing.take()[0]
+                    result['pending'] = (leaf, offset, form_data)
+            except Exception as e:
+                result['error'] = f"{type(e).__name__}: {e}"
+                if self.batch_signing is not None:
+                    self.batch_signing.take()
+            result['seconds'] = round(time.perf_counter() - start, 6)
+            results.append(result)
+        return results
+
+
+def output_file(output_dir, output_name):
+    # The row's output name, which must stay inside the output directory
+    output_dir = os.path.realpath(output_dir)
+    path = os.path.realpath(os.path.join(output_dir, output_name))
+    if path == output_dir or os.path.commonpath([output_dir, path]) != output_dir:
+        raise ValueError(f"Output name outside the output directory: {output_name}")
+    return path
+
+
+def signer_password(password_env, short_name):
+    # Passwords come from the environment: <VAR>_<short name> for one signer, <VAR> for any
+    return os.environ.get(f"{password_env}_{short_name}") or os.environ.get(password_env)
+
+
+def init_worker(config_file, output_dir, template, signer, password_env=PASSWORD_ENV, merkle_leaves=0):
+    global _worker
+    _worker = BatchWorker(config_file, output_dir, template, signer, password_env, merkle_leaves)
+
+
+def render_chunk(chunk):
+    return _worker.render_chunk(chunk)
+
+
+def preload_templates(config_file, template_name):
+    # Compile the run-wide template before the pool starts; forked workers inherit the cache
+    from desktop_app.utils.template_manager import TemplateManager
+
+    template_manager = TemplateManager(ConfigManager(config_file))
+    template_manager.get_compiled_template(template_name)
+
+
+def preload_signers(config_file, short_name=None, password_env=PASSWORD_ENV):
+    # Bulk load the signer index and unlock the run-wide signature before the
+    # pool starts; forked workers inherit both instead of parsing files and
+    # running the password key derivation again
+    from desktop_app.utils.signer_repository import SignerRepository
+
+    repository = SignerRepository.for_config(ConfigManager(config_file))
+    repository.load_all()
+    if short_name:
+        repository.signature(short_name, signer_password(password_env, short_name))
+
+
+def run_batch(config_file, input_path, output_dir, manifest_path, template=None, signer=None,
+              workers=None, chunk_size=16, fmt=None, password_env=PASSWORD_ENV, merkle_leaves=0):
+    # With merkle_leaves, documents are signed here as Merkle trees of that
+    # many documents, one private key operation per tree; they are recorded in
+    # the manifest and registry, and queued for upload, once their tree is sealed
+    from desktop_app.utils.batch_signing import MerkleBatch
+    from desktop_app.utils.nextcloud import enqueue_document
+    from desktop_app.utils.signing import get_signing_engine
+
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    # Keep a bounded number of chunks in flight so the input is never fully loaded
+    max_pending = workers * 2
+    succeeded = failed = 0
+    if template:
+        preload_templates(config_file, template)
+    preload_signers(config_file, signer, password_env)
+    config = ConfigManager(config_file)
+    # Workers only render; issued documents are registered here, one transaction per chunk or tree
+    registry = get_registry(config)
+    batch = None
+    if merkle_leaves:
+        batch = MerkleBatch(get_signing_engine(config.get('Paths', 'private_key')), merkle_leaves)
+    # Rendered documents waiting for their tree to be sealed, with their form data
+    unsealed = []
+
+    with open(manifest_path, 'w', encoding='utf-8') as manifest, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                initargs=(config_file, output_dir, template, signer, password_env,
+                                          merkle_leaves)) as executor:
+
+        def record(results):
+            nonlocal succeeded, failed
+            for result in results:
+                if result['error']:
+                    failed += 1
+                else:
+                    succeeded += 1
+                manifest.write(json.dumps(result) + '\n')
+            if registry is not None:
+                registry.register_many((result['fingerprint'], result['template'], result['signer'],
+                                        result['issued_at'])
+                                       for result in results if not result['error'])
+
+        def seal():
+            batch.seal()
+            for result, form_data in unsealed:
+                enqueue_document(config, result['path'], result['template'], form_data, result['signer'])
+            record([result for result, _ in unsealed])
+            unsealed.clear()
+
+        def drain(pending, return_when):
+            done, pending = wait(pending, return_when=return_when)
+            for future in done:
+                results = future.result()
+                if batch is None:
+                    record(results)
+                    continue
+                record([result for result in results if result['error']])
+                for result in results:
+                    if not result['error']:
+                        leaf, offset, form_data = result.pop('pending')
+                        batch.add(result['path'], leaf, offset)
+                        unsealed.append((result, form_data))
+                        if batch.full:
+                            seal()
+            manifest.flush()
+            return pending
+
+        pending = set()
+        for chunk in chunked(enumerate(read_rows(input_path, fmt)), chunk_size):
+            if len(pending) >= max_pending:
+                pending = drain(pending, FIRST_COMPLETED)
+            pending.add(executor.submit(render_chunk, chunk))
+        drain(pending, ALL_COMPLETED)
+        if batch is not None:
+            seal()
+
+    return succeeded, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='doccreator batch',
+                                     description='Render, sign and write PDFs for every row of a CSV/JSONL file.')
+    parser.add_argument('input', help='CSV or JSONL file with one form per row')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--template', help=f"template for rows without a '{TEMPLATE_COLUMN}' column")
+    parser.add_argument('--signer', help=f"signer short name for rows without a '{SIGNER_COLUMN}' column")
+    parser.add_argument('--password-env', default=PASSWORD_ENV,
+                        help='environment variable with the signer password, or <VAR>_<short name> per signer')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='input format (default: from file extension)')
+    parser.add_argument('--output-dir', help='directory for the PDFs (default: [Paths] output_dir)')
+    parser.add_argument('--manifest', help='per-row result manifest (default: <output-dir>/manifest.jsonl)')
+    parser.add_argument('--workers', type=int, help='worker processes (default: [Batch] workers or CPU count)')
+    parser.add_argument('--chunk-size', type=int, help='rows handed to a worker at a time')
+    parser.add_argument('--merkle-leaves', type=int,
+                        help='sign documents as Merkle trees of this many, one signature per tree '
+                             '(default: [Batch] merkle_leaves, 0 = sign each document)')
+    args = parser.parse_args(argv)
+
+    config = ConfigManager(args.config)
+    setup_logging(config)
+    output_dir = args.output_dir or config.get_output_dir()
+    manifest_path = args.manifest or os.path.join(output_dir, 'manifest.jsonl')
+    workers = args.workers or config.getint('Batch', 'workers', fallback=0)
+    chunk_size = args.chunk_size or config.getint('Batch', 'chunk_size', fallback=16)
+    merkle_leaves = (args.merkle_leaves if args.merkle_leaves is not None
+                     else config.getint('Batch', 'merkle_leaves', fallback=0))
+
+    start = time.perf_counter()
+    succeeded, failed = run_batch(args.config, args.input, output_dir, manifest_path,
+                                  args.template, args.signer, workers, chunk_size, args.format, args.password_env,
+                                  merkle_leaves)
+    elapsed = time.perf_counter() - start
+    print(f"{succeeded} documents created, {failed} failed in {elapsed:.1f}s, manifest: {manifest_path}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,13 +5,24 @@ class ConfigManager:
         self.config = configparser.ConfigParser()
         self.config.read(config_file)
 
-    def get(self, section, key):
+    def get(self, section, key, fallback=None):
+        if fallback is not None:
+            return self.config.get(section, key, fallback=fallback)
         return self.config[section][key]
 
+    def getint(self, section, key, fallback=None):
+        return self.config.getint(section, key, fallback=fallback)
+
+    def getboolean(self, section, key, fallback=None):
+        return self.config.getboolean(section, key, fallback=fallback)
+
     def get_templates_dir(self):
         return self.get('Paths', 'templates_dir')
 
     def get_signers_dir(self):
         return self.get('Paths', 'signers_dir')
 
+    def get_output_dir(self):
+        return self.get('Paths', 'output_dir', fallback='output/')
+
     # Add more specific getter methods as needed
\ No newline at end of file
@@ -1,11 +1,28 @@
 import sys
-from PyQt5.QtWidgets import QApplication
-from desktop_app.ui.main_window import MainWindow
 from desktop_app.config.config_manager import ConfigManager
 
 def main():
+    if sys.argv[1:2] == ['batch']:
+        from desktop_app.batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['registry']:
+        from desktop_app.utils.document_registry import main as registry_main
+        sys.exit(registry_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['archive']:
+        from desktop_app.utils.nextcloud import main as archive_main
+        sys.exit(archive_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['cache']:
+        from desktop_app.utils.render_cache import main as cache_main
+        sys.exit(cache_main(sys.argv[2:]))
+
+    # Qt is only loaded for the GUI, the subcommands above run without it
+    from PyQt5.QtWidgets import QApplication
+    from desktop_app.ui.main_window import MainWindow
+    from desktop_app.utils.instrumentation import setup_logging
+
     app = QApplication(sys.argv)
     config = ConfigManager('config.ini')
+    setup_logging(config)
     main_window = MainWindow(config)
     main_window.show()
     sys.exit(app.exec_())
@@ -1,6 +1,5 @@
-import configparser
-import os
-from cryptography.fernet import Fernet
+from desktop_app.utils.signature_crypto import derive_fernet, new_kdf_params
+from desktop_app.utils.signer_repository import SignerRepository, signer_signature_path
 
 class Author:
     def __init__(self, full_name, short_name, email, phone, mobile_phone, role,
@@ -33,101 +32,60 @@ class Author:
             'SignerExtraInfo5': self.extra_info5
         }
 
+    @staticmethod
+    def from_dict(data):
+        # Accepts to_dict() output as well as INI sections, whose keys configparser lowercases
+        data = {key.lower(): value for key, value in data.items()}
+        return Author(
+            full_name=data['signerfullname'],
+            short_name=data['signershortname'],
+            email=data['signeremail'],
+            phone=data['signerphone'],
+            mobile_phone=data['signermobilephone'],
+            role=data['signerrole'],
+            extra_info1=data['signerextrainfo1'],
+            extra_info2=data['signerextrainfo2'],
+            extra_info3=data['signerextrainfo3'],
+            extra_info4=data['signerextrainfo4'],
+            extra_info5=data['signerextrainfo5'],
+            password=''  # Password is not stored in the INI file for security reasons
+        )
+
     def save(self, config):
-        signers_dir = config.get_signers_dir()
-        ini_path = os.path.join(signers_dir, f"Signer-{self.short_name}.ini")
-        
-        author_config = configparser.ConfigParser()
-        author_config['Author'] = self.to_dict()
-        
-        with open(ini_path, 'w') as configfile:
-            author_config.write(configfile)
+        SignerRepository.for_config(config).save(self)
 
-    def encrypt_signature(self, signature_path, config):
+    def encrypt_signature(self, signature_path, config, password=None):
+        # The signature is encrypted with a key derived from the signer's
+        # password; only the salt and KDF parameters are stored in the INI file.
+        password = password or self.password
+        if not password:
+            raise ValueError("A password is required to encrypt the signature")
         signers_dir = config.get_signers_dir()
-        encrypted_path = os.path.join(signers_dir, f"Signer-{self.short_name}-Signatur.png")
-        
-        key = Fernet.generate_key()
-        fernet = Fernet(key)
-        
+        encrypted_path = signer_signature_path(signers_dir, self.short_name)
+
+        params = new_kdf_params(config)
+        fernet = derive_fernet(params, password)
+
+        # Trimmed and reduced to print resolution once, here, instead of on every document
+        from desktop_app.utils.signature_image import prepare_signature
+
         with open(signature_path, 'rb') as file:
-            signature = file.read()
-        
+            signature = prepare_signature(file.read())
+
         encrypted_signature = fernet.encrypt(signature)
-        
+
         with open(encrypted_path, 'wb') as file:
             file.write(encrypted_signature)
-        
-        # Save the key securely (in this example, we're saving it in the INI file, but in a real-world scenario, 
-        # you might want to use a more secure method)
-        ini_path = os.path.join(signers_dir, f"Signer-{self.short_name}.ini")
-        author_config = configparser.ConfigParser()
-        author_config.read(ini_path)
-        author_config['Signature'] = {'key': key.decode()}
-        
-        with open(ini_path, 'w') as configfile:
-            author_config.write(configfile)
+
+        SignerRepository.for_config(config).save(self, params)
 
     @staticmethod
     def load(short_name, config):
-        signers_dir = config.get_signers_dir()
-        ini_path = os.path.join(signers_dir, f"Signer-{short_name}.ini")
-        
-        if not os.path.exists(ini_path):
-            return None
-        
-        author_config = configparser.ConfigParser()
-        author_config.read(ini_path)
-        
-        author_data = author_config['Author']
-        
-        return Author(
-            full_name=author_data['SignerFullName'],
-            short_name=author_data['SignerShortName'],
-            email=author_data['SignerEmail'],
-            phone=author_data['SignerPhone'],
-            mobile_phone=author_data['SignerMobilePhone'],
-            role=author_data['SignerRole'],
-            extra_info1=author_data['SignerExtraInfo1'],
-            extra_info2=author_data['SignerExtraInfo2'],
-            extra_info3=author_data['SignerExtraInfo3'],
-            extra_info4=author_data['SignerExtraInfo4'],
-            extra_info5=author_data['SignerExtraInfo5'],
-            password=''  # Password is not stored in the INI file for security reasons
-        )
+        return SignerRepository.for_config(config).get(short_name)
 
-    def decrypt_signature(self, config):
-        signers_dir = config.get_signers_dir()
-        encrypted_path = os.path.join(signers_dir, f"Signer-{self.short_name}-Signatur.png")
-        ini_path = os.path.join(signers_dir, f"Signer-{self.short_name}.ini")
-        
-        if not os.path.exists(encrypted_path) or not os.path.exists(ini_path):
-            return None
-        
-        author_config = configparser.ConfigParser()
-        author_config.read(ini_path)
-        
-        key = author_config['Signature']['key'].encode()
-        fernet = Fernet(key)
-        
-        with open(encrypted_path, 'rb') as file:
-            encrypted_signature = file.read()
-        
-        try:
-            decrypted_signature = fernet.decrypt(encrypted_signature)
-            return decrypted_signature
-        except:
-            return None
+    def decrypt_signature(self, config, password=None):
+        return SignerRepository.for_config(config).signature(self.short_name, password or self.password)
 
     @staticmethod
     def delete(short_name, config):
-        signers_dir = config.get_signers_dir()
-        ini_path = os.path.join(signers_dir, f"Signer-{short_name}.ini")
-        signature_path = os.path.join(signers_dir, f"Signer-{short_name}-Signatur.png")
-        
-        if os.path.exists(ini_path):
-            os.remove(ini_path)
-        
-        if os.path.exists(signature_path):
-            os.remove(signature_path)
-            
\ No newline at end of file
+        SignerRepository.for_config(config).delete(short_name)
@@ -1,14 +1,11 @@
 from PyQt5.QtWidgets import QDialog, QFormLayout, QLineEdit, QPushButton, QFileDialog, QMessageBox
 from desktop_app.models.author import Author
-from PIL import Image
-import os
-from desktop_app.ui.document_dialog import DocumentDialog
-from desktop_app.utils.template_manager import TemplateManager
 
 class AuthorDialog(QDialog):
     def __init__(self, config):
         super().__init__()
         self.config = config
+        self.signature_path = None
         self.init_ui()
 
     def init_ui(self):
@@ -62,8 +59,12 @@ class AuthorDialog(QDialog):
                 QMessageBox.warning(self, "Fehler", "Die PNG-Datei muss einen transparenten Hintergrund haben.")
 
     def check_transparent_background(self, file_path):
+        # Pillow is only needed once a signature is chosen
+        from PIL import Image
+        from desktop_app.utils.signature_image import has_transparency
+
         with Image.open(file_path) as img:
-            return img.mode in ('RGBA', 'LA') and any(pixel[3] < 255 for pixel in img.getdata())
+            return has_transparency(img)
 
     def save_author(self):
         author = Author(
@@ -81,8 +82,13 @@ class AuthorDialog(QDialog):
             password=self.password.text()
         )
 
-        # TODO: Implement signature encryption and saving
-        # TODO: Save author information to INI file
+        if self.signature_path and not author.password:
+            QMessageBox.warning(self, "Fehler", "Zum Verschlüsseln der Unterschrift wird ein Passwort benötigt.")
+            return
+
+        author.save(self.config)
+        if self.signature_path:
+            author.encrypt_signature(self.signature_path, self.config)
 
         QMessageBox.information(self, "Erfolg", "Autor erfolgreich gespeichert.")
         self.accept()
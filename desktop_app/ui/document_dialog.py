@@ -1,67 +1,208 @@
-from PyQt5.QtWidgets import QDialog, QVBoxLayout, QFormLayout, QComboBox, QLineEdit, QPushButton, QMessageBox
-from desktop_app.utils.pdf_creator import create_pdf
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QFormLayout, QComboBox, QLineEdit, QPushButton,
+                             QMessageBox, QWidget, QLabel, QProgressBar)
 from desktop_app.models.author import Author
+from desktop_app.utils.signer_repository import SignerRepository
+from desktop_app.ui.document_queue import DocumentQueue
+
+STAGE_LABELS = {
+    'fill': 'Vorlage ausfüllen',
+    'convert': 'In PDF umwandeln',
+    'overlay': 'Unterschrift einfügen',
+    'fingerprint': 'Fingerabdruck berechnen',
+    'write': 'Schreiben',
+    'sign': 'Signieren',
+    'archive': 'Registrieren',
+}
+
+class JobRow(QWidget):
+    # One queued or running document with its progress and a cancel button
+    def __init__(self, title, cancel):
+        super().__init__()
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.label = QLabel(title)
+        self.progress = QProgressBar()
+        self.progress.setFormat('Wartet')
+        self.cancel_btn = QPushButton("Abbrechen")
+        self.cancel_btn.clicked.connect(cancel)
+        layout.addWidget(self.label)
+        layout.addWidget(self.progress)
+        layout.addWidget(self.cancel_btn)
+        self.setLayout(layout)
+
+    def update_progress(self, stage, percent):
+        self.progress.setValue(percent)
+        self.progress.setFormat(STAGE_LABELS.get(stage, stage))
+
+    def done(self, text, percent=100):
+        self.progress.setValue(percent)
+        self.progress.setFormat(text)
+        self.cancel_btn.setEnabled(False)
 
 class DocumentDialog(QDialog):
-    def __init__(self, config, template_manager):
+    def __init__(self, config, template_manager, drafts=None, resume=False):
         super().__init__()
         self.config = config
         self.template_manager = template_manager
+        self.drafts = drafts
+        # A resumed draft is continued; otherwise the first edit starts a new one
+        self.draft_started = resume
+        self.fields = {}
+        self.job_rows = {}
+        # Edits are collected and written to the draft journal once typing pauses
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.setSingleShot(True)
+        self.autosave_timer.setInterval(config.getint('Drafts', 'autosave_ms', fallback=1000))
+        self.autosave_timer.timeout.connect(self.save_draft)
+        # Documents are created on worker threads; results arrive through the queue's signals
+        self.queue = DocumentQueue(config, self)
+        self.queue.progress.connect(self.on_progress)
+        self.queue.finished.connect(self.on_finished)
+        self.queue.failed.connect(self.on_failed)
+        self.queue.cancelled.connect(self.on_cancelled)
         self.init_ui()
+        if resume and drafts is not None:
+            self.load_draft(drafts.draft())
 
     def init_ui(self):
         self.setWindowTitle("Dokument erstellen")
-        
+
         # Erstellen Sie ein Hauptlayout
         main_layout = QVBoxLayout()
         self.setLayout(main_layout)
 
+        selection_layout = QFormLayout()
+        self.author_combo = QComboBox()
+        self.author_combo.addItems(self.get_author_names())
+        self.template_combo = QComboBox()
+        self.template_combo.addItems(self.template_manager.get_template_names())
+        self.template_combo.currentTextChanged.connect(self.update_form)
+        self.template_combo.currentTextChanged.connect(self.on_selection_changed)
+        self.author_combo.currentTextChanged.connect(self.on_selection_changed)
+        self.password = QLineEdit()
+        self.password.setEchoMode(QLineEdit.Password)
+        selection_layout.addRow("Autor:", self.author_combo)
+        selection_layout.addRow("Vorlage:", self.template_combo)
+        selection_layout.addRow("Passwort:", self.password)
+        main_layout.addLayout(selection_layout)
+
         # Erstellen Sie ein Formlayout für die Eingabefelder
         self.form_layout = QFormLayout()
         main_layout.addLayout(self.form_layout)
 
         # Fügen Sie Buttons hinzu
-        create_btn = QPushButton("Erstellen")
+        create_btn = QPushButton("PDF erstellen und signieren")
         create_btn.clicked.connect(self.create_document)
         main_layout.addWidget(create_btn)
 
+        # Laufende und fertige Dokumente
+        self.jobs_layout = QVBoxLayout()
+        main_layout.addLayout(self.jobs_layout)
+
         # Aktualisieren Sie das Formular
         self.update_form()
 
     def get_author_names(self):
-        # This should be implemented to get the list of author short names
-        # For now, we'll return a dummy list
-        return ["Author1", "Author2"]
+        return SignerRepository.for_config(self.config).names()
 
     def update_form(self):
         # Löschen Sie zuerst alle vorhandenen Widgets im Formlayout
         for i in reversed(range(self.form_layout.rowCount())):
             self.form_layout.removeRow(i)
+        self.fields = {}
+
+        # One input per template variable, labelled with its question
+        template_name = self.template_combo.currentText()
+        variables = self.template_manager.get_template_variables(template_name) if template_name else {}
+        for name, question in variables.items():
+            field = QLineEdit()
+            field.textChanged.connect(lambda text, name=name: self.on_field_edited(name, text))
+            self.fields[name] = field
+            self.form_layout.addRow(question, field)
+
+    def load_draft(self, draft):
+        if draft['author']:
+            self.author_combo.setCurrentText(draft['author'])
+        if draft['template']:
+            self.template_combo.setCurrentText(draft['template'])
+        for name, value in draft['fields'].items():
+            if name in self.fields:
+                self.fields[name].setText(value)
+
+    def start_draft(self):
+        if not self.draft_started:
+            self.drafts.new_draft(self.template_combo.currentText(), self.author_combo.currentText())
+            self.draft_started = True
 
-        # Fügen Sie neue Eingabefelder hinzu
-        # (Hier sollten Sie Ihre Logik zum Hinzufügen von Feldern implementieren)
-        self.form_layout.addRow("Feldname:", QLineEdit())
+    def on_field_edited(self, name, text):
+        if self.drafts is None:
+            return
+        self.start_draft()
+        self.drafts.set_field(name, text)
+        self.autosave_timer.start()
+
+    def on_selection_changed(self):
+        if self.drafts is None or not self.draft_started:
+            return
+        self.drafts.set_meta(self.template_combo.currentText(), self.author_combo.currentText())
+        self.autosave_timer.start()
+
+    def save_draft(self):
+        if self.drafts is not None:
+            self.drafts.flush()
+
+    def form_data(self):
+        return {name: field.text() for name, field in self.fields.items()}
 
     def create_document(self):
-        # Implementieren Sie hier die Logik zum Erstellen des Dokuments
-        pass
+        self.create_pdf()
 
     def create_pdf(self):
-        # Collect form data
-        form_data = {}
-        for i in range(4, self.layout().rowCount() - 1):  # Skip template, author, password, and create button
-            question = self.layout().itemAt(i, QFormLayout.LabelRole).widget().text()
-            answer = self.layout().itemAt(i, QFormLayout.FieldRole).widget().text()
-            form_data[question] = answer
-
         selected_template = self.template_combo.currentText()
         selected_author = self.author_combo.currentText()
-        password = self.password.text()
+        if not selected_template or not selected_author:
+            QMessageBox.warning(self, "Fehler", "Bitte Autor und Vorlage auswählen.")
+            return
 
         author = Author.load(selected_author, self.config)
-        if author and author.decrypt_signature(self.config):
-            pdf_path = create_pdf(self.config, selected_template, form_data, author)
-            QMessageBox.information(self, "Erfolg", f"PDF wurde erstellt und gespeichert unter: {pdf_path}")
-            self.accept()
-        else:
-            QMessageBox.warning(self, "Fehler", "Autor nicht gefunden oder Passwort falsch.")
+        if author is None:
+            QMessageBox.warning(self, "Fehler", "Autor nicht gefunden.")
+            return
+        # The signature stays unlocked for the session, later documents skip the key derivation
+        author.password = self.password.text()
+
+        # Queued; the form stays open for the next document
+        job_id = self.queue.submit(selected_template, self.form_data(), author)
+        row = JobRow(f"{selected_template} ({selected_author})", lambda: self.queue.cancel(job_id))
+        self.job_rows[job_id] = row
+        self.jobs_layout.addWidget(row)
+
+    def on_progress(self, job_id, stage, percent):
+        self.job_rows[job_id].update_progress(stage, percent)
+
+    def on_finished(self, job_id, path):
+        row = self.job_rows[job_id]
+        row.done("Fertig")
+        row.label.setToolTip(path)
+        row.label.setText(f"{row.label.text()}: {path}")
+
+    def on_failed(self, job_id, message):
+        self.job_rows[job_id].done("Fehler", 0)
+        QMessageBox.warning(self, "Fehler", f"PDF konnte nicht erstellt werden: {message}")
+
+    def on_cancelled(self, job_id):
+        self.job_rows[job_id].done("Abgebrochen", 0)
+
+    def done(self, result):
+        # Closing the dialog stops documents that are still queued or running
+        if self.queue.active():
+            answer = QMessageBox.question(self, "Dokumente werden erstellt",
+                                          "Es werden noch Dokumente erstellt. Abbrechen und schließen?")
+            if answer != QMessageBox.Yes:
+                return
+            # Running documents end on their worker threads, after the dialog is gone
+            self.queue.drain()
+        self.autosave_timer.stop()
+        self.save_draft()
+        super().done(result)
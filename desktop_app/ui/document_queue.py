@@ -0,0 +1,158 @@
+import itertools
+import os
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+from desktop_app.utils.pdf_creator import STAGES, GenerationCancelled, create_pdf
+
+
+class DocumentJobSignals(QObject):
+    # QRunnable is no QObject, so a job's signals live here. They are emitted
+    # on the worker thread and delivered to the GUI thread as queued signals.
+    progress = pyqtSignal(int, str, int)
+    finished = pyqtSignal(int, str)
+    failed = pyqtSignal(int, str)
+    cancelled = pyqtSignal(int)
+
+
+class DocumentJob(QRunnable):
+    # Unlocks the signature and creates one document on a pool thread. The
+    # cancel flag is checked before every stage; a cancelled document is
+    # removed again by render_pdf. Once signed, the document is finished
+    # even if cancelled.
+
+    def __init__(self, job_id, config, template_name, form_data, author, output_path):
+        super().__init__()
+        # The queue keeps the job until it has finished
+        self.setAutoDelete(False)
+        self.job_id = job_id
+        self.config = config
+        self.template_name = template_name
+        self.form_data = form_data
+        self.author = author
+        self.output_path = output_path
+        self.signals = DocumentJobSignals()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def report(self, stage):
+        if self._cancelled.is_set():
+            raise GenerationCancelled()
+        self.signals.progress.emit(self.job_id, stage, STAGES.index(stage) * 100 // len(STAGES))
+
+    def run(self):
+        try:
+            if self._cancelled.is_set():
+                raise GenerationCancelled()
+            # The key derivation of the first unlock is slow, so it runs here and not in the dialog
+            signature = self.author.decrypt_signature(self.config)
+            if signature is None:
+                raise ValueError("Passwort falsch oder keine Unterschrift hinterlegt.")
+            path = create_pdf(self.config, self.template_name, self.form_data, self.author, self.output_path,
+                              signature, self.report)
+        except GenerationCancelled:
+            self.signals.cancelled.emit(self.job_id)
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, str(e))
+        else:
+            self.signals.finished.emit(self.job_id, path)
+
+
+# Queues of closed windows whose last jobs are still running
+_draining = set()
+
+
+class DocumentQueue(QObject):
+    # Documents waiting for or being created on a thread pool of
+    # [Desktop] workers threads. Each job gets its own output file, so
+    # several documents from the same template and signer do not collide.
+    progress = pyqtSignal(int, str, int)
+    finished = pyqtSignal(int, str)
+    failed = pyqtSignal(int, str)
+    cancelled = pyqtSignal(int)
+
+    def __init__(self, config, parent=None):
+        super().__init__(parent)
+        self.config = config
+        self.pool = QThreadPool(self)
+        workers = config.getint('Desktop', 'workers', fallback=0)
+        if workers > 0:
+            self.pool.setMaxThreadCount(workers)
+        self._jobs = {}
+        self._ids = itertools.count(1)
+
+    def submit(self, template_name, form_data, author):
+        job_id = next(self._ids)
+        job = DocumentJob(job_id, self.config, template_name, form_data, author,
+                          self._output_path(template_name, author))
+        job.signals.progress.connect(self.progress)
+        job.signals.finished.connect(self._finished)
+        job.signals.failed.connect(self._failed)
+        job.signals.cancelled.connect(self._cancelled)
+        self._jobs[job_id] = job
+        self.pool.start(job)
+        return job_id
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        job.cancel()
+        # A job that has not started yet is taken off the pool right away
+        if self.pool.tryTake(job):
+            self._cancelled(job_id)
+
+    def cancel_all(self):
+        for job_id in list(self._jobs):
+            self.cancel(job_id)
+
+    def active(self):
+        return len(self._jobs)
+
+    def drain(self):
+        # Cancels every job without waiting for the running ones: the queue
+        # leaves its window and is deleted once its last job has ended, so
+        # closing the window does not block the GUI thread
+        self.cancel_all()
+        if not self._jobs:
+            return
+        for signal in (self.progress, self.finished, self.failed, self.cancelled):
+            try:
+                signal.disconnect()
+            except TypeError:
+                # Nothing connected
+                pass
+        self.setParent(None)
+        _draining.add(self)
+
+    def _output_path(self, template_name, author):
+        base = os.path.join(self.config.get_output_dir(), f"{template_name}_{author.short_name}")
+        reserved = {job.output_path for job in self._jobs.values()}
+        path = f"{base}.pdf"
+        for number in itertools.count(2):
+            if path not in reserved and not os.path.exists(path):
+                return path
+            path = f"{base}-{number}.pdf"
+
+    def _finished(self, job_id, path):
+        self._jobs.pop(job_id, None)
+        self.finished.emit(job_id, path)
+        self._release()
+
+    def _failed(self, job_id, message):
+        self._jobs.pop(job_id, None)
+        self.failed.emit(job_id, message)
+        self._release()
+
+    def _cancelled(self, job_id):
+        if self._jobs.pop(job_id, None) is not None:
+            self.cancelled.emit(job_id)
+        self._release()
+
+    def _release(self):
+        if not self._jobs and self in _draining:
+            _draining.discard(self)
+            self.deleteLater()
@@ -1,14 +1,20 @@
-from PyQt5.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QPushButton
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QPushButton, QMessageBox
 from desktop_app.ui.document_dialog import DocumentDialog
 from desktop_app.ui.author_dialog import AuthorDialog
 from desktop_app.utils.template_manager import TemplateManager
+from desktop_app.utils.draft_store import DraftStore
 
 class MainWindow(QMainWindow):
     def __init__(self, config):
         super().__init__()
         self.config = config
         self.template_manager = TemplateManager(config)
+        self.drafts = DraftStore.for_config(config)
         self.init_ui()
+        self.update_draft_buttons()
+        # Uploads left from earlier sessions continue once the window is up
+        QTimer.singleShot(1000, self.start_archive_uploads)
 
     def init_ui(self):
         self.setWindowTitle('DocCreator')
@@ -42,17 +48,37 @@ class MainWindow(QMainWindow):
         self.btn_delete_previous.clicked.connect(self.delete_previous_document)
 
     def open_document_dialog(self):
-        dialog = DocumentDialog(self.config, self.template_manager)
+        dialog = DocumentDialog(self.config, self.template_manager, self.drafts)
         dialog.exec_()
+        self.update_draft_buttons()
 
     def open_author_dialog(self):
         dialog = AuthorDialog(self.config)
         dialog.exec_()
 
+    def start_archive_uploads(self):
+        if self.config.getboolean('Nextcloud', 'enabled', fallback=False):
+            from desktop_app.utils.nextcloud import start_uploader
+            start_uploader(self.config)
+
+    def update_draft_buttons(self):
+        # Only offered while form data of a previous document is stored
+        has_draft = self.drafts.has_draft()
+        self.btn_edit_previous.setEnabled(has_draft)
+        self.btn_delete_previous.setEnabled(has_draft)
+
     def edit_previous_document(self):
-        # To be implemented
-        pass
+        dialog = DocumentDialog(self.config, self.template_manager, self.drafts, resume=True)
+        dialog.exec_()
+        self.update_draft_buttons()
 
     def delete_previous_document(self):
-        # To be implemented
-        pass
+        answer = QMessageBox.question(self, "Daten löschen",
+                                      "Gespeicherte Daten des vorherigen Dokuments endgültig löschen?")
+        if answer == QMessageBox.Yes:
+            self.drafts.secure_delete()
+            self.update_draft_buttons()
+
+    def closeEvent(self, event):
+        self.drafts.close()
+        super().closeEvent(event)
@@ -0,0 +1,86 @@
+from desktop_app.utils.merkle import MAX_LEAVES, build_tree, signed_message
+from desktop_app.utils.pdf_signature import embed_signature_placeholder, fill_merkle_signature
+
+# Batch signing: the documents of a run are the leaves of Merkle trees of up
+# to max_leaves documents, and only each tree's root is signed. Every PDF
+# carries its own inclusion proof next to the root signature, so it still
+# verifies on its own; N documents cost one private key operation instead
+# of N. Documents are written with an empty signature first (possibly in
+# other processes), and the signature is filled in when the tree is sealed.
+
+DEFAULT_MAX_LEAVES = 1024
+
+
+def check_max_leaves(max_leaves):
+    if not 0 < max_leaves <= MAX_LEAVES:
+        raise ValueError(f"A tree holds 1 to {MAX_LEAVES} documents")
+
+
+class PendingSignatures:
+    # Signing step of render_pdf in batch mode: appends the signature
+    # placeholder and keeps the document's leaf for the sealing process
+
+    def __init__(self, max_leaves=DEFAULT_MAX_LEAVES):
+        check_max_leaves(max_leaves)
+        self.max_leaves = max_leaves
+        self.documents = []
+
+    def embed(self, path, stream, engine, digest=None):
+        leaf, offset = embed_signature_placeholder(stream, engine, self.max_leaves, digest)
+        self.documents.append((path, leaf, offset))
+
+    def take(self):
+        # (path, leaf, offset) of the documents embedded since the last call
+        documents, self.documents = self.documents, []
+        return documents
+
+
+class MerkleBatch:
+    # Collects the leaves of written documents and seals them: one signature
+    # over the root, then the proof of every document written into its file
+
+    def __init__(self, engine, max_leaves=DEFAULT_MAX_LEAVES):
+        check_max_leaves(max_leaves)
+        self.engine = engine
+        self.max_leaves = max_leaves
+        self.documents = []
+        self.signatures = 0
+
+    def __len__(self):
+        return len(self.documents)
+
+    @property
+    def full(self):
+        return len(self.documents) >= self.max_leaves
+
+    def add(self, path, leaf, offset):
+        if self.full:
+            raise ValueError("The batch is full, seal it first")
+        self.documents.append((path, leaf, offset))
+
+    def seal(self):
+        # Signs the tree and completes its documents; returns their paths
+        documents, self.documents = self.documents, []
+        if not documents:
+            return []
+        root, proofs = build_tree([leaf for _, leaf, _ in documents])
+        signature = self.engine.sign_digest(signed_message(root, len(documents)))
+        self.signatures += 1
+        for index, ((path, _, offset), proof) in enumerate(zip(documents, proofs)):
+            with open(path, 'r+b') as f:
+                fill_merkle_signature(f, offset, self.max_leaves, signature, index, len(documents), proof)
+        return [path for path, _, _ in documents]
+
+
+def sign_files(paths, engine, max_leaves=DEFAULT_MAX_LEAVES):
+    # Signs existing PDFs with one private key operation per max_leaves files
+    pending = PendingSignatures(max_leaves)
+    batch = MerkleBatch(engine, max_leaves)
+    for path in paths:
+        with open(path, 'r+b') as f:
+            pending.embed(path, f, engine)
+        batch.add(*pending.take()[0])
+        if batch.full:
+            batch.seal()
+    batch.seal()
+    return batch.signatures
@@ -0,0 +1,230 @@
+import argparse
+import datetime
+import hashlib
+import math
+import os
+import sqlite3
+import sys
+import threading
+from urllib.parse import quote
+
+from desktop_app.config.config_manager import ConfigManager
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    fingerprint TEXT PRIMARY KEY,
+    template TEXT NOT NULL,
+    signer TEXT NOT NULL,
+    issued_at TEXT NOT NULL
+) WITHOUT ROWID
+'''
+
+BLOOM_ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    # Fixed-size bit array with k probes derived from the SHA-256 of the key
+    # (double hashing). A miss is definite, a hit has to be confirmed.
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2) + 1
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def from_bytes(cls, size, hashes, bits):
+        bloom = cls.__new__(cls)
+        bloom.size = size
+        bloom.hashes = hashes
+        bloom.bits = bytearray(bits)
+        return bloom
+
+    def _positions(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class DocumentRegistry:
+    # Every issued document, keyed by fingerprint, in a single SQLite file.
+    # Lookups are primary key searches, a few page reads even with millions
+    # of rows. The desktop app and batch runs append to it; the web service
+    # reads a replica exported with export_replica().
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        if readonly:
+            self._conn = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True,
+                                         check_same_thread=False)
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            # Several processes may append at once; WAL lets readers continue meanwhile
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(SCHEMA)
+            self._conn.commit()
+
+    def register(self, fingerprint, template, signer, issued_at=None):
+        self.register_many([(fingerprint, template, signer, issued_at)])
+
+    def register_many(self, records):
+        # One transaction for the whole set; re-registering a fingerprint keeps the first record
+        now = issued_now()
+        rows = [(str(fingerprint), template, signer, issued_at or now)
+                for fingerprint, template, signer, issued_at in records]
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO documents VALUES (?, ?, ?, ?)', rows)
+
+    def lookup(self, fingerprint):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT template, signer, issued_at FROM documents WHERE fingerprint = ?',
+                (str(fingerprint),)).fetchone()
+        if row is None:
+            return None
+        return {'template': row[0], 'signer': row[1], 'issued_at': row[2]}
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def compact(self):
+        # In WAL mode VACUUM writes the rebuilt pages to the journal, so checkpoint after it
+        with self._lock:
+            self._conn.execute('VACUUM')
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def export_replica(self, replica_path):
+        # Consistent snapshot via the backup API, swapped in atomically so a
+        # running web service never sees a half-written file. The Bloom
+        # filter is stored alongside so loading the replica needs no scan.
+        tmp_path = replica_path + '.tmp'
+        replica = sqlite3.connect(tmp_path)
+        try:
+            with self._lock:
+                self._conn.backup(replica)
+            replica.execute('PRAGMA journal_mode=DELETE')
+            bloom = build_bloom_filter(replica)
+            replica.execute('CREATE TABLE bloom (size INTEGER, hashes INTEGER, bits BLOB)')
+            replica.execute('INSERT INTO bloom VALUES (?, ?, ?)', (bloom.size, bloom.hashes, bytes(bloom.bits)))
+            replica.commit()
+            replica.execute('VACUUM')
+        finally:
+            replica.close()
+        os.replace(tmp_path, replica_path)
+
+    def close(self):
+        self._conn.close()
+
+
+class RegistryReplica:
+    # Read-only registry for the web service with a Bloom filter in front,
+    # so documents that were never issued are rejected without a disk read.
+
+    def __init__(self, path):
+        self.registry = DocumentRegistry(path, readonly=True)
+        try:
+            row = self.registry._conn.execute('SELECT size, hashes, bits FROM bloom').fetchone()
+            self.bloom = BloomFilter.from_bytes(*row)
+        except sqlite3.OperationalError:
+            # Plain copy of a registry without a stored filter
+            self.bloom = build_bloom_filter(self.registry._conn)
+        self.filtered = 0
+        self.lookups = 0
+
+    def lookup(self, fingerprint):
+        if fingerprint is None or str(fingerprint) not in self.bloom:
+            self.filtered += 1
+            return None
+        self.lookups += 1
+        return self.registry.lookup(fingerprint)
+
+    def stats(self):
+        return {'filtered': self.filtered, 'lookups': self.lookups}
+
+    def close(self):
+        self.registry.close()
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def build_bloom_filter(conn, error_rate=BLOOM_ERROR_RATE):
+    count = conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+    bloom = BloomFilter(int(count * 1.1), error_rate)
+    # The cursor streams rows, so millions of fingerprints are never held at once
+    for (fingerprint,) in conn.execute('SELECT fingerprint FROM documents'):
+        bloom.add(fingerprint)
+    return bloom
+
+
+def issued_now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def get_registry(config):
+    # One writable registry per path and process; None when [Paths] registry is not set
+    path = config.get('Paths', 'registry', fallback='')
+    if not path:
+        return None
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = DocumentRegistry(path)
+        return _registries[path]
+
+
+def register_document(config, fingerprint, template_name, signer, issued_at=None):
+    registry = get_registry(config)
+    if registry is not None:
+        registry.register(fingerprint, template_name, signer, issued_at)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='doccreator registry',
+                                     description='Maintain the registry of issued documents.')
+    parser.add_argument('--config', default='config.ini')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('count', help='number of registered documents')
+    commands.add_parser('compact', help='checkpoint the journal and rebuild the file')
+    replica = commands.add_parser('replica', help='write a read-only copy for the web service')
+    replica.add_argument('path')
+    lookup = commands.add_parser('lookup', help='show the record for a fingerprint')
+    lookup.add_argument('fingerprint')
+    args = parser.parse_args(argv)
+
+    registry = get_registry(ConfigManager(args.config))
+    if registry is None:
+        print("No registry configured ([Paths] registry)", file=sys.stderr)
+        return 1
+    if args.command == 'count':
+        print(len(registry))
+    elif args.command == 'compact':
+        registry.compact()
+    elif args.command == 'replica':
+        registry.export_replica(args.path)
+    elif args.command == 'lookup':
+        record = registry.lookup(args.fingerprint)
+        if record is None:
+            print("Not registered", file=sys.stderr)
+            return 1
+        print(f"{record['issued_at']} {record['template']} {record['signer']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
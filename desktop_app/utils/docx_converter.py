@@ -0,0 +1,258 @@
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+BACKEND_BUILTIN = 'builtin'
+BACKEND_LIBREOFFICE = 'libreoffice'
+BACKEND_DOCX2PDF = 'docx2pdf'
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_TIMEOUT = 120
+CONNECT_TIMEOUT = 30
+
+
+# Marks a placeholder whose position the builtin renderer reports instead of printing it
+ANCHOR_MARK = '\ue000'
+
+
+def anchor_text(name):
+    return f"{ANCHOR_MARK}{name}{ANCHOR_MARK}"
+
+
+class ConversionError(Exception):
+    pass
+
+
+class ConversionTimeout(ConversionError):
+    pass
+
+
+class Converter:
+    # Turns a filled DOCX (bytes) into PDF bytes
+    # True if convert_anchored() reports where anchor_text() marks land
+    anchors = False
+
+    def convert(self, docx_data):
+        raise NotImplementedError
+
+    def convert_anchored(self, docx_data):
+        # PDF bytes and {name: (page index, x, y)} of the anchor marks
+        return self.convert(docx_data), {}
+
+    def close(self):
+        pass
+
+
+class BuiltinConverter(Converter):
+    # Pure-Python renderer for the Word features our templates use; runs on
+    # any platform and needs no external process
+    anchors = True
+
+    def convert(self, docx_data):
+        return self.convert_anchored(docx_data)[0]
+
+    def convert_anchored(self, docx_data):
+        from desktop_app.utils.docx_renderer import DocxRenderer
+
+        renderer = DocxRenderer(docx_data)
+        return renderer.render(), renderer.anchors
+
+
+class Docx2PdfConverter(Converter):
+    # Microsoft Word through docx2pdf (Windows and macOS only). Word is
+    # started for every file, so this is the slowest backend.
+    def convert(self, docx_data):
+        from docx2pdf import convert
+
+        with tempfile.TemporaryDirectory(prefix='doccreator-') as tmp:
+            docx_path = os.path.join(tmp, 'document.docx')
+            pdf_path = os.path.join(tmp, 'document.pdf')
+            with open(docx_path, 'wb') as f:
+                f.write(docx_data)
+            convert(docx_path, pdf_path)
+            with open(pdf_path, 'rb') as f:
+                return f.read()
+
+
+class LibreOfficeSession:
+    # One headless LibreOffice process with its own profile, driven over a
+    # UNO pipe. Starting it is the expensive part, so a session converts
+    # many documents until it crashes or times out.
+
+    def __init__(self, soffice):
+        import uno
+
+        self.uno = uno
+        self.profile = tempfile.mkdtemp(prefix='doccreator-lo-')
+        self.pipe = f"doccreator-{uuid.uuid4().hex}"
+        self.process = subprocess.Popen(
+            [soffice, '--headless', '--invisible', '--nologo', '--norestore', '--nodefault', '--nolockcheck',
+             f"-env:UserInstallation={uno.systemPathToFileUrl(self.profile)}",
+             f"--accept=pipe,name={self.pipe};urp;StarOffice.ComponentContext"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            self.desktop = self._connect()
+        except Exception:
+            self.kill()
+            raise
+
+    def _connect(self):
+        local = self.uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext('com.sun.star.bridge.UnoUrlResolver', local)
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(f"uno:pipe,name={self.pipe};urp;StarOffice.ComponentContext")
+                return context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+            except Exception:
+                if not self.alive() or time.monotonic() > deadline:
+                    raise ConversionError("LibreOffice did not start")
+                time.sleep(0.1)
+
+    def _properties(self, **values):
+        properties = []
+        for name, value in values.items():
+            prop = self.uno.createUnoStruct('com.sun.star.beans.PropertyValue')
+            prop.Name = name
+            prop.Value = value
+            properties.append(prop)
+        return tuple(properties)
+
+    def convert(self, docx_path, pdf_path):
+        document = self.desktop.loadComponentFromURL(
+            self.uno.systemPathToFileUrl(docx_path), '_blank', 0, self._properties(Hidden=True))
+        try:
+            document.storeToURL(self.uno.systemPathToFileUrl(pdf_path),
+                                self._properties(FilterName='writer_pdf_Export'))
+        finally:
+            document.close(True)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+        shutil.rmtree(self.profile, ignore_errors=True)
+
+
+class ConverterPool(Converter):
+    # A fixed number of worker threads, each owning one warm session. Jobs
+    # wait in a bounded queue; a job that runs longer than the timeout gets
+    # its session killed, and a dead session is replaced before the next job.
+
+    def __init__(self, session_factory, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 timeout=DEFAULT_TIMEOUT):
+        self.session_factory = session_factory
+        self.timeout = timeout
+        self.restarts = 0
+        self._restarts_lock = threading.Lock()
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def convert(self, docx_data):
+        future = Future()
+        try:
+            self._jobs.put((docx_data, future), timeout=self.timeout)
+        except queue.Full:
+            raise ConversionError("Conversion queue is full")
+        return future.result()
+
+    def close(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        session = None
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            docx_data, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if session is not None and not session.alive():
+                    session = self._discard(session)
+                if session is None:
+                    session = self.session_factory()
+                future.set_result(self._convert(session, docx_data))
+            except Exception as e:
+                if session is not None and not session.alive():
+                    session = self._discard(session)
+                future.set_exception(e if isinstance(e, ConversionError) else ConversionError(str(e)))
+        if session is not None:
+            session.kill()
+
+    def _discard(self, session):
+        # A crashed or killed session; the next job starts a new one
+        session.kill()
+        with self._restarts_lock:
+            self.restarts += 1
+        return None
+
+    def _convert(self, session, docx_data):
+        with tempfile.TemporaryDirectory(prefix='doccreator-') as tmp:
+            docx_path = os.path.join(tmp, 'document.docx')
+            pdf_path = os.path.join(tmp, 'document.pdf')
+            with open(docx_path, 'wb') as f:
+                f.write(docx_data)
+
+            timed_out = threading.Event()
+
+            def expire():
+                timed_out.set()
+                session.kill()
+
+            watchdog = threading.Timer(self.timeout, expire)
+            watchdog.start()
+            try:
+                session.convert(docx_path, pdf_path)
+            except Exception:
+                if timed_out.is_set():
+                    raise ConversionTimeout(f"Conversion took longer than {self.timeout}s")
+                raise
+            finally:
+                watchdog.cancel()
+            with open(pdf_path, 'rb') as f:
+                return f.read()
+
+
+_converters = {}
+_converters_lock = threading.Lock()
+
+
+def create_converter(config):
+    backend = config.get('Conversion', 'backend', fallback=BACKEND_BUILTIN)
+    if backend == BACKEND_BUILTIN:
+        return BuiltinConverter()
+    if backend == BACKEND_DOCX2PDF:
+        return Docx2PdfConverter()
+    if backend == BACKEND_LIBREOFFICE:
+        soffice = config.get('Conversion', 'soffice', fallback='soffice')
+        return ConverterPool(lambda: LibreOfficeSession(soffice),
+                             config.getint('Conversion', 'workers', fallback=DEFAULT_WORKERS),
+                             config.getint('Conversion', 'queue_size', fallback=DEFAULT_QUEUE_SIZE),
+                             config.getint('Conversion', 'timeout', fallback=DEFAULT_TIMEOUT))
+    raise ValueError(f"Unknown conversion backend: {backend}")
+
+
+def get_converter(config):
+    # One converter per backend and process, so warm workers are shared by all documents
+    backend = config.get('Conversion', 'backend', fallback=BACKEND_BUILTIN)
+    with _converters_lock:
+        if backend not in _converters:
+            _converters[backend] = create_converter(config)
+        return _converters[backend]
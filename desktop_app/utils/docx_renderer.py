@@ -0,0 +1,262 @@
+import io
+import re
+from xml.sax.saxutils import escape
+
+from docx import Document
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml.ns import qn
+from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_LEFT, TA_RIGHT
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import (Flowable, Image, PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table,
+                                TableStyle)
+
+EMU_PER_POINT = 12700
+DEFAULT_FONT_SIZE = 11
+LINE_HEIGHT = 1.2
+
+ALIGNMENTS = {
+    WD_ALIGN_PARAGRAPH.CENTER: TA_CENTER,
+    WD_ALIGN_PARAGRAPH.RIGHT: TA_RIGHT,
+    WD_ALIGN_PARAGRAPH.JUSTIFY: TA_JUSTIFY,
+}
+
+HEADING_SIZES = {'Title': 24, 'Heading 1': 16, 'Heading 2': 13, 'Heading 3': 12}
+
+# Written by docx_converter.anchor_text()
+ANCHOR_PATTERN = re.compile('\ue000(\\w+)\ue000')
+
+
+class AnchoredImage(Flowable):
+    # A floating picture positioned relative to the paragraph that anchors
+    # it. It takes no space in the flow, like a Word picture without wrapping.
+
+    def __init__(self, image, width, height, offset_x, offset_y, relative_x, relative_y, pagesize):
+        super().__init__()
+        self.image = image
+        self.image_width = width
+        self.image_height = height
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.relative_x = relative_x
+        self.relative_y = relative_y
+        self.pagesize = pagesize
+
+    def wrap(self, available_width, available_height):
+        return 0, 0
+
+    def draw(self):
+        origin_x, origin_y = self.canv.absolutePosition(0, 0)
+        x = self.offset_x - origin_x if self.relative_x == 'page' else self.offset_x
+        if self.relative_y == 'page':
+            y = self.pagesize[1] - self.offset_y - self.image_height - origin_y
+        else:
+            y = -self.offset_y - self.image_height
+        self.canv.drawImage(self.image, x, y, self.image_width, self.image_height, mask='auto')
+
+
+class Anchor(Flowable):
+    # Takes no space; records the page and position where it is drawn, so
+    # the signature can be stamped where its placeholder landed. The first
+    # position of a name wins.
+
+    def __init__(self, name, anchors):
+        super().__init__()
+        self.name = name
+        self.anchors = anchors
+
+    def wrap(self, available_width, available_height):
+        return 0, 0
+
+    def draw(self):
+        x, y = self.canv.absolutePosition(0, 0)
+        self.anchors.setdefault(self.name, (self.canv.getPageNumber() - 1, x, y))
+
+
+class DocxRenderer:
+    # Renders the subset of WordprocessingML our templates use: paragraphs
+    # with bold/italic/underline runs, font sizes, alignment, line and page
+    # breaks, simple tables, inline and floating pictures, and the first
+    # section's header and footer. Everything runs in-process, so there is
+    # no converter start-up cost per document. Anchor marks in the text are
+    # not printed; their positions are collected in self.anchors.
+
+    def __init__(self, data):
+        self.document = Document(io.BytesIO(data))
+        section = self.document.sections[0]
+        self.pagesize = (section.page_width.pt, section.page_height.pt)
+        self.margins = (section.left_margin.pt, section.right_margin.pt,
+                        section.top_margin.pt, section.bottom_margin.pt)
+        self.header_distance = section.header_distance.pt
+        self.footer_distance = section.footer_distance.pt
+        self.section = section
+        self.anchors = {}
+
+    def render(self):
+        output = io.BytesIO()
+        left, right, top, bottom = self.margins
+        doc = SimpleDocTemplate(output, pagesize=self.pagesize, leftMargin=left, rightMargin=right,
+                                topMargin=top, bottomMargin=bottom,
+                                title='', author='', creator='', producer='DocCreator')
+        story = self._blocks(self.document.element.body, self.document.part)
+        doc.build(story or [Spacer(0, 0)], onFirstPage=self._draw_page, onLaterPages=self._draw_page)
+        return output.getvalue()
+
+    def _blocks(self, parent, part):
+        story = []
+        for child in parent.iterchildren():
+            if child.tag == qn('w:p'):
+                story.extend(self._paragraph(child, part))
+            elif child.tag == qn('w:tbl'):
+                story.append(self._table(child, part))
+        return story
+
+    def _paragraph(self, p, part):
+        from docx.text.paragraph import Paragraph as DocxParagraph
+
+        paragraph = DocxParagraph(p, None)
+        style_name = self._style_name(p)
+        base_size = HEADING_SIZES.get(style_name, DEFAULT_FONT_SIZE)
+        flowables = []
+
+        if paragraph.paragraph_format.page_break_before:
+            flowables.append(PageBreak())
+
+        markup = []
+        sizes = [base_size]
+        anchors = []
+        for r in p.iter(qn('w:r')):
+            size = self._run_size(r) or base_size
+            sizes.append(size)
+            for child in r.iterchildren():
+                if child.tag == qn('w:t'):
+                    text = child.text or ''
+                    anchors.extend(ANCHOR_PATTERN.findall(text))
+                    text = ANCHOR_PATTERN.sub('', text)
+                    markup.append(self._format(escape(text), r, size, base_size, style_name))
+                elif child.tag == qn('w:tab'):
+                    markup.append('&nbsp;' * 4)
+                elif child.tag == qn('w:br'):
+                    if child.get(qn('w:type')) == 'page':
+                        flowables.append(self._text(markup, paragraph, max(sizes)))
+                        flowables.append(PageBreak())
+                        markup = []
+                    else:
+                        markup.append('<br/>')
+                elif child.tag == qn('w:drawing'):
+                    flowables.extend(self._drawing(child, part))
+
+        flowables.append(self._text(markup, paragraph, max(sizes)))
+        # Below the paragraph, at its left edge
+        flowables.extend(Anchor(name, self.anchors) for name in anchors)
+        return flowables
+
+    def _text(self, markup, paragraph, size):
+        fmt = paragraph.paragraph_format
+        style = ParagraphStyle(
+            'docx', fontName='Helvetica', fontSize=size, leading=size * LINE_HEIGHT,
+            alignment=ALIGNMENTS.get(paragraph.alignment, TA_LEFT),
+            spaceBefore=fmt.space_before.pt if fmt.space_before is not None else 0,
+            spaceAfter=fmt.space_after.pt if fmt.space_after is not None else 0,
+            leftIndent=fmt.left_indent.pt if fmt.left_indent is not None else 0,
+        )
+        # Empty paragraphs still take one line, as in Word
+        return Paragraph(''.join(markup) or '&nbsp;', style)
+
+    def _format(self, text, r, size, base_size, style_name):
+        rpr = r.find(qn('w:rPr'))
+        bold = style_name in HEADING_SIZES or self._flag(rpr, 'w:b')
+        if bold:
+            text = f'<b>{text}</b>'
+        if self._flag(rpr, 'w:i'):
+            text = f'<i>{text}</i>'
+        if rpr is not None and rpr.find(qn('w:u')) is not None and rpr.find(qn('w:u')).get(qn('w:val')) != 'none':
+            text = f'<u>{text}</u>'
+        if size != base_size:
+            text = f'<font size="{size}">{text}</font>'
+        return text
+
+    def _flag(self, rpr, tag):
+        if rpr is None:
+            return False
+        element = rpr.find(qn(tag))
+        return element is not None and element.get(qn('w:val')) not in ('0', 'false', 'off')
+
+    def _run_size(self, r):
+        rpr = r.find(qn('w:rPr'))
+        size = rpr.find(qn('w:sz')) if rpr is not None else None
+        return int(size.get(qn('w:val'))) / 2 if size is not None else None
+
+    def _style_name(self, p):
+        return self._element_style(p, 'w:pPr', 'w:pStyle', 1) or 'Normal'
+
+    def _element_style(self, element, properties_tag, style_tag, style_type):
+        # Name of the style an element refers to in its properties, or None
+        properties = element.find(qn(properties_tag))
+        style = properties.find(qn(style_tag)) if properties is not None else None
+        if style is None:
+            return None
+        try:
+            return self.document.styles.get_by_id(style.get(qn('w:val')), style_type).name
+        except (KeyError, ValueError):
+            return None
+
+    def _drawing(self, drawing, part):
+        blip = drawing.find('.//' + qn('a:blip'))
+        if blip is None or blip.get(qn('r:embed')) not in part.related_parts:
+            return []
+        image = ImageReader(io.BytesIO(part.related_parts[blip.get(qn('r:embed'))].blob))
+
+        container = drawing[0]
+        extent = container.find(qn('wp:extent'))
+        width = int(extent.get('cx')) / EMU_PER_POINT
+        height = int(extent.get('cy')) / EMU_PER_POINT
+        if container.tag == qn('wp:inline'):
+            return [Image(image, width, height)]
+
+        position = {}
+        for axis in ('wp:positionH', 'wp:positionV'):
+            element = container.find(qn(axis))
+            offset = element.find(qn('wp:posOffset')) if element is not None else None
+            position[axis] = (int(offset.text) / EMU_PER_POINT if offset is not None else 0,
+                              element.get('relativeFrom') if element is not None else 'column')
+        (offset_x, relative_x), (offset_y, relative_y) = position['wp:positionH'], position['wp:positionV']
+        return [AnchoredImage(image, width, height, offset_x, offset_y, relative_x, relative_y, self.pagesize)]
+
+    def _table(self, tbl, part):
+        from docx.enum.style import WD_STYLE_TYPE
+
+        rows = []
+        for row in tbl.iterchildren(qn('w:tr')):
+            rows.append([self._blocks(tc, part) for tc in row.iterchildren(qn('w:tc'))])
+        widths = None
+        grid = tbl.find(qn('w:tblGrid'))
+        if grid is not None:
+            widths = [int(col.get(qn('w:w'))) / 20 for col in grid.iterchildren(qn('w:gridCol'))] or None
+        flowable = Table(rows, colWidths=widths)
+        style = [('VALIGN', (0, 0), (-1, -1), 'TOP')]
+        if 'Grid' in (self._element_style(tbl, 'w:tblPr', 'w:tblStyle', WD_STYLE_TYPE.TABLE) or ''):
+            style.append(('GRID', (0, 0), (-1, -1), 0.5, (0, 0, 0)))
+        flowable.setStyle(TableStyle(style))
+        return flowable
+
+    def _draw_page(self, canvas, doc):
+        left, right, top, bottom = self.margins
+        width = self.pagesize[0] - left - right
+        for part, top_edge in ((self.section.header, True), (self.section.footer, False)):
+            # A first section without its own header or footer has none
+            if part.is_linked_to_previous:
+                continue
+            blocks = self._blocks(part._element, part.part)
+            heights = [block.wrap(width, self.pagesize[1])[1] for block in blocks]
+            if top_edge:
+                y = self.pagesize[1] - self.header_distance
+            else:
+                y = self.footer_distance + sum(heights)
+            for block, height in zip(blocks, heights):
+                y -= height
+                block.drawOn(canvas, left, y)
+
+
+def render_docx(data):
+    return DocxRenderer(data).render()
@@ -0,0 +1,149 @@
+import copy
+import hashlib
+import io
+import re
+import zipfile
+
+from lxml import etree
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+
+PLACEHOLDER_PATTERN = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+# Parts of a .docx that can contain placeholders
+TEXT_PART_PATTERN = re.compile(r'^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$')
+
+W_P = qn('w:p')
+W_T = qn('w:t')
+W_BR = qn('w:br')
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+
+class Slot:
+    # One placeholder occurrence. fragments is a list of (text_index, start, end)
+    # pointing into the part's w:t elements in document order, so a token that
+    # Word split over several runs is patched without rescanning the part.
+    __slots__ = ('name', 'fragments')
+
+    def __init__(self, name, fragments):
+        self.name = name
+        self.fragments = fragments
+
+
+class CompiledTemplate:
+    def __init__(self, path):
+        self.path = path
+        self.members = []  # (ZipInfo, bytes) for every member of the package
+        self.parts = {}    # part name -> parsed XML root
+        self.slots = {}    # part name -> [Slot]
+
+        with open(path, 'rb') as f:
+            package_data = f.read()
+        # Identifies the template's content, e.g. for the render cache
+        self.digest = hashlib.sha256(package_data).hexdigest()
+        with zipfile.ZipFile(io.BytesIO(package_data)) as package:
+            for info in package.infolist():
+                data = package.read(info)
+                self.members.append((info, data))
+                if TEXT_PART_PATTERN.match(info.filename):
+                    root = parse_xml(data)
+                    slots = self._scan(root)
+                    if slots:
+                        self.parts[info.filename] = root
+                        self.slots[info.filename] = slots
+
+    @property
+    def placeholders(self):
+        names = []
+        for slots in self.slots.values():
+            for slot in slots:
+                if slot.name not in names:
+                    names.append(slot.name)
+        return names
+
+    @staticmethod
+    def _scan(root):
+        paragraphs = {}
+        for index, t in enumerate(root.iter(W_T)):
+            # A w:t belongs to its nearest paragraph, so text boxes nested in a
+            # paragraph are scanned on their own
+            paragraphs.setdefault(_parent_paragraph(t), []).append((index, t.text or ''))
+
+        slots = []
+        for texts in paragraphs.values():
+            offsets = []
+            joined = ''
+            for index, text in texts:
+                offsets.append((index, len(joined), len(joined) + len(text)))
+                joined += text
+            for match in PLACEHOLDER_PATTERN.finditer(joined):
+                fragments = []
+                for index, offset, end in offsets:
+                    start = max(match.start(), offset)
+                    stop = min(match.end(), end)
+                    if start < stop:
+                        fragments.append((index, start - offset, stop - offset))
+                slots.append(Slot(match.group(1), fragments))
+        return slots
+
+    def fill(self, values, output_path=None):
+        patched = {}
+        for name, root in self.parts.items():
+            root = copy.deepcopy(root)
+            texts = list(root.iter(W_T))
+            # Patch back to front so earlier offsets in the same w:t stay valid
+            for slot in reversed(self.slots[name]):
+                if slot.name in values:
+                    _patch(texts, slot, str(values[slot.name]))
+            patched[name] = root
+
+        buffer = output_path or io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as package:
+            for info, data in self.members:
+                if info.filename in patched:
+                    data = _serialize(patched[info.filename])
+                package.writestr(_member_info(info), data)
+        if output_path is None:
+            return buffer.getvalue()
+        return output_path
+
+
+def _member_info(info):
+    # writestr() records offsets and sizes in the ZipInfo it is given, so
+    # every fill writes a fresh copy; concurrent fills must not share one
+    member = zipfile.ZipInfo(info.filename, info.date_time)
+    member.compress_type = info.compress_type
+    member.external_attr = info.external_attr
+    return member
+
+
+def _parent_paragraph(element):
+    parent = element.getparent()
+    while parent is not None and parent.tag != W_P:
+        parent = parent.getparent()
+    return parent
+
+
+def _patch(texts, slot, value):
+    index, start, end = slot.fragments[0]
+    first = texts[index]
+    lines = value.split('\n')
+    for other_index, other_start, other_end in reversed(slot.fragments[1:]):
+        t = texts[other_index]
+        t.text = t.text[:other_start] + t.text[other_end:]
+    head, tail = first.text[:start], first.text[end:]
+    first.text = head + lines[0] + (tail if len(lines) == 1 else '')
+    first.set(XML_SPACE, 'preserve')
+    # Multi-line values continue as line breaks inside the same run
+    anchor = first
+    for i, line in enumerate(lines[1:], 1):
+        br = first.makeelement(W_BR, {})
+        t = first.makeelement(W_T, {XML_SPACE: 'preserve'})
+        t.text = line + (tail if i == len(lines) - 1 else '')
+        anchor.addnext(br)
+        br.addnext(t)
+        anchor = t
+
+
+def _serialize(root):
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
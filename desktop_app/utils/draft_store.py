@@ -0,0 +1,301 @@
+import json
+import os
+import zlib
+
+SNAPSHOT_FILE = 'draft.json'
+# The replaced snapshot, until it is overwritten
+OLD_SNAPSHOT_FILE = 'draft.json.old'
+JOURNAL_FILE = 'draft.journal'
+SNAPSHOT_VERSION = 1
+
+DEFAULT_COMPACT_RECORDS = 500
+# Values at least this long are journaled as the changed span only
+SPLICE_MIN_LENGTH = 256
+
+
+def empty_draft():
+    return {'template': '', 'author': '', 'fields': {}}
+
+
+def splice(old, new):
+    # The smallest (position, deleted count, inserted text) that turns old
+    # into new. Prefix and suffix are found by bisecting on slice
+    # comparisons, which run in C, instead of comparing character by character.
+    limit = min(len(old), len(new))
+    start = _common_length(limit, lambda n: old[:n] == new[:n])
+    limit -= start
+    end = _common_length(limit, lambda n: old[len(old) - n:] == new[len(new) - n:])
+    return start, len(old) - start - end, new[start:len(new) - end]
+
+
+def _common_length(limit, matches):
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if matches(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def apply_record(draft, record):
+    op = record['op']
+    if op == 'meta':
+        draft['template'] = record['template']
+        draft['author'] = record['author']
+    elif op == 'set':
+        draft['fields'][record['field']] = record['value']
+    elif op == 'splice':
+        value = draft['fields'].get(record['field'], '')
+        at = record['at']
+        draft['fields'][record['field']] = value[:at] + record['text'] + value[at + record['del']:]
+
+
+def encode_record(record):
+    # One line per record, prefixed with its CRC32 so a torn or partly
+    # written line is recognised when the journal is read back
+    payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+
+def decode_record(line):
+    if not line.endswith(b'\n') or len(line) < 10 or line[8:9] != b' ':
+        return None
+    payload = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def overwrite(f, start, end):
+    # Overwrite bytes start to end of an open file with random data, then
+    # zeros. On copy-on-write file systems and SSDs old blocks may survive;
+    # full-disk encryption is the complete answer there.
+    for pattern in (None, b'\0'):
+        f.seek(start)
+        remaining = end - start
+        while remaining:
+            block = min(remaining, 64 * 1024)
+            f.write(os.urandom(block) if pattern is None else pattern * block)
+            remaining -= block
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def secure_remove(path):
+    # Overwrite the file's bytes before unlinking it
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return
+    with open(path, 'r+b') as f:
+        overwrite(f, 0, size)
+    os.remove(path)
+
+
+def secure_truncate(path, length):
+    # Overwrite what follows length before cutting it off
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return
+    if size <= length:
+        return
+    with open(path, 'r+b') as f:
+        overwrite(f, length, size)
+        f.truncate(length)
+
+
+class DraftStore:
+    # The form data of the last document, kept so it can be resumed after
+    # the dialog was closed or the app crashed. Edits are buffered in memory
+    # and written by flush() as appended journal records: one record per
+    # changed field, and for long values only the changed span. When the
+    # journal has compact_records records, the draft is written as a new
+    # snapshot and the journal starts over, so loading reads at most one
+    # snapshot plus compact_records records however long the draft was
+    # edited. Records carry a sequence number; the snapshot stores the last
+    # one it contains, so a crash between writing the snapshot and
+    # truncating the journal does not apply records twice. Data that is
+    # dropped (a replaced snapshot, compacted or torn journal records) is
+    # overwritten before it is removed, as in secure_delete().
+
+    def __init__(self, drafts_dir, compact_records=DEFAULT_COMPACT_RECORDS):
+        self.drafts_dir = drafts_dir
+        self.snapshot_path = os.path.join(drafts_dir, SNAPSHOT_FILE)
+        self.old_snapshot_path = os.path.join(drafts_dir, OLD_SNAPSHOT_FILE)
+        self.journal_path = os.path.join(drafts_dir, JOURNAL_FILE)
+        self.compact_records = compact_records
+        self._draft = None
+        self._pending_meta = None
+        self._pending_fields = {}
+        self._seq = 0
+        self._journal_records = 0
+        self._journal = None
+
+    @classmethod
+    def for_config(cls, config):
+        return cls(config.get('Paths', 'drafts_dir', fallback='drafts/'),
+                   config.getint('Drafts', 'compact_records', fallback=DEFAULT_COMPACT_RECORDS))
+
+    def has_draft(self):
+        # Answered from the file system, without reading the draft
+        if self._draft is not None:
+            return bool(self._draft['fields'] or self._pending_fields or self._draft['template'])
+        return any(os.path.exists(path) and os.path.getsize(path)
+                   for path in (self.snapshot_path, self.journal_path))
+
+    def draft(self):
+        # The current draft including edits not flushed yet
+        self._load()
+        draft = {'template': self._draft['template'], 'author': self._draft['author'],
+                 'fields': dict(self._draft['fields'])}
+        if self._pending_meta is not None:
+            draft['template'], draft['author'] = self._pending_meta
+        draft['fields'].update(self._pending_fields)
+        return draft
+
+    def new_draft(self, template, author):
+        # Starts over with an empty draft; compacting drops the previous one at once
+        self._load()
+        self._pending_fields = {}
+        self._pending_meta = None
+        self._draft = {'template': template, 'author': author, 'fields': {}}
+        self.compact()
+
+    def set_meta(self, template, author):
+        self._pending_meta = (template, author)
+
+    def set_field(self, name, value):
+        self._pending_fields[name] = value
+
+    def flush(self):
+        self._load()
+        records = []
+        if self._pending_meta is not None:
+            template, author = self._pending_meta
+            if (template, author) != (self._draft['template'], self._draft['author']):
+                records.append({'op': 'meta', 'template': template, 'author': author})
+        for name, value in self._pending_fields.items():
+            old = self._draft['fields'].get(name)
+            if old == value:
+                continue
+            if old is not None and len(value) >= SPLICE_MIN_LENGTH:
+                at, deleted, text = splice(old, value)
+                records.append({'op': 'splice', 'field': name, 'at': at, 'del': deleted, 'text': text})
+            else:
+                records.append({'op': 'set', 'field': name, 'value': value})
+        self._pending_meta = None
+        self._pending_fields = {}
+        if records:
+            self._append(records)
+        if self._journal_records >= self.compact_records:
+            self.compact()
+
+    def compact(self):
+        # Write the whole draft as the new snapshot, then empty the journal.
+        # The previous snapshot is moved aside rather than replaced, so its
+        # bytes can be overwritten; until then _load() falls back to it.
+        self._load()
+        os.makedirs(self.drafts_dir, exist_ok=True)
+        secure_remove(self.old_snapshot_path)
+        tmp_path = self.snapshot_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'seq': self._seq, 'draft': self._draft}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(self.snapshot_path):
+            os.replace(self.snapshot_path, self.old_snapshot_path)
+        os.replace(tmp_path, self.snapshot_path)
+        secure_remove(self.old_snapshot_path)
+        self._close_journal()
+        secure_truncate(self.journal_path, 0)
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        os.close(fd)
+        self._journal_records = 0
+
+    def close(self):
+        if self._draft is not None:
+            self.flush()
+        self._close_journal()
+
+    def secure_delete(self):
+        # "Daten vorheriges Dokument löschen": the files are overwritten before they are removed
+        self._close_journal()
+        for path in (self.journal_path, self.snapshot_path, self.old_snapshot_path, self.snapshot_path + '.tmp'):
+            secure_remove(path)
+        self._draft = empty_draft()
+        self._pending_meta = None
+        self._pending_fields = {}
+        self._seq = 0
+        self._journal_records = 0
+
+    def _load(self):
+        if self._draft is not None:
+            return
+        draft = empty_draft()
+        seq = 0
+        # The old snapshot is only read when compaction stopped between moving it aside and renaming the new one
+        for path in (self.snapshot_path, self.old_snapshot_path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    snapshot = json.load(f)
+                if snapshot.get('version') == SNAPSHOT_VERSION:
+                    draft, seq = snapshot['draft'], snapshot['seq']
+                break
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, KeyError):
+                break
+
+        # Replay the journal up to the first damaged record; what follows it
+        # was being written when the app stopped and is cut off
+        records = 0
+        valid_length = 0
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    record = decode_record(line)
+                    if record is None:
+                        break
+                    if record['seq'] > seq:
+                        apply_record(draft, record)
+                        seq = record['seq']
+                    records += 1
+                    valid_length += len(line)
+            secure_truncate(self.journal_path, valid_length)
+        except FileNotFoundError:
+            pass
+        self._draft = draft
+        self._seq = seq
+        self._journal_records = records
+
+    def _append(self, records):
+        data = b''
+        for record in records:
+            self._seq += 1
+            record['seq'] = self._seq
+            apply_record(self._draft, record)
+            data += encode_record(record)
+        journal = self._open_journal()
+        journal.write(data)
+        journal.flush()
+        os.fsync(journal.fileno())
+        self._journal_records += len(records)
+
+    def _open_journal(self):
+        if self._journal is None:
+            os.makedirs(self.drafts_dir, exist_ok=True)
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            self._journal = os.fdopen(fd, 'ab')
+        return self._journal
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,193 @@
+import bisect
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# Upper bounds in seconds of the latency histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger('doccreator.spans')
+
+# Set by configure(); while False, span() hands out one shared no-op object
+_enabled = False
+_histograms = {}
+_counters = {}
+_metrics_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; fields passed as extra={'fields': {...}} become top-level keys
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(config):
+    # Applies [Logging]: level, log file and JSON or text format, written to the file and stderr
+    level = config.get('Logging', 'log_level', fallback='INFO').upper()
+    if config.get('Logging', 'format', fallback='json') == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    handlers = [logging.StreamHandler(sys.stderr)]
+    log_file = config.get('Logging', 'log_file', fallback='')
+    if log_file:
+        directory = os.path.dirname(log_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+    root.setLevel(getattr(logging, level, logging.INFO))
+    configure(config)
+
+
+def configure(config):
+    global _enabled
+    _enabled = config.getboolean('Logging', 'spans', fallback=False)
+
+
+def enabled():
+    return _enabled
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.bytes = 0
+
+    def observe(self, seconds, size=0):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.bytes += size
+
+
+def observe(name, seconds, size=0, **fields):
+    # Records a finished stage: histogram for /metrics and a JSON log line
+    with _metrics_lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds, size)
+    if logger.isEnabledFor(logging.INFO):
+        fields.update(span=name, duration_ms=round(seconds * 1000, 3), bytes=size)
+        logger.info(name, extra={'fields': fields})
+
+
+def count(name, value=1, **labels):
+    # Throughput counters; always kept, they cost one locked addition
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+class Span:
+    __slots__ = ('name', 'bytes', 'fields', 'start')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.bytes = 0
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        observe(self.name, time.perf_counter() - self.start, self.bytes, **self.fields)
+        return False
+
+    def add_bytes(self, size):
+        self.bytes += size
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def add_bytes(self, size):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+def span(name, **fields):
+    # with span('document.fill') as s: ...; s.add_bytes(len(data))
+    if not _enabled:
+        return NO_SPAN
+    return Span(name, fields)
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in labels)
+
+
+def prometheus_text(gauges=None, totals=None):
+    # All spans and counters in the Prometheus text exposition format;
+    # gauges is an optional {name: value} of current values from the caller,
+    # totals the same for counts kept by the caller (names end in _total)
+    with _metrics_lock:
+        histograms = {name: (list(h.buckets), h.count, h.sum, h.bytes) for name, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = ['# HELP doccreator_span_duration_seconds Duration of pipeline stages.',
+             '# TYPE doccreator_span_duration_seconds histogram']
+    for name, (buckets, total, seconds, _) in sorted(histograms.items()):
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS + (float('inf'),), buckets):
+            cumulative += bucket
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'doccreator_span_duration_seconds_bucket{{span="{name}",le="{le}"}} {cumulative}')
+        lines.append(f'doccreator_span_duration_seconds_sum{{span="{name}"}} {seconds:.6f}')
+        lines.append(f'doccreator_span_duration_seconds_count{{span="{name}"}} {total}')
+    lines += ['# HELP doccreator_span_bytes_total Bytes processed by pipeline stages.',
+              '# TYPE doccreator_span_bytes_total counter']
+    for name, (_, _, _, size) in sorted(histograms.items()):
+        lines.append(f'doccreator_span_bytes_total{{span="{name}"}} {size}')
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# TYPE {name} counter')
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f'{name}{{{_labels(labels)}}} {value}' if labels else f'{name} {value}')
+    for name, value in sorted((totals or {}).items()):
+        lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name} {value}')
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    with _metrics_lock:
+        _histograms.clear()
+        _counters.clear()
@@ -0,0 +1,78 @@
+import hashlib
+import struct
+
+# Merkle tree over document digests as in RFC 9162 (Certificate
+# Transparency): leaves and inner nodes are hashed with different prefixes,
+# so a node can never pass for a document, and a tree of any size is split
+# at the largest power of two below it. Only the root is signed.
+
+HASH_SIZE = hashlib.sha256().digest_size
+# Trees hold at most 2**MAX_DEPTH documents, so a proof has at most MAX_DEPTH hashes
+MAX_DEPTH = 16
+MAX_LEAVES = 1 << MAX_DEPTH
+# Prefix of the signed message, which keeps root signatures apart from document signatures
+ROOT_CONTEXT = b"DocCreator merkle root\x00"
+
+
+def leaf_hash(digest):
+    return hashlib.sha256(b"\x00" + digest).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+def depth(size):
+    # Length of the longest inclusion proof in a tree of size leaves
+    return max(0, size - 1).bit_length()
+
+
+def build_tree(digests):
+    # Root and the inclusion proof of every leaf, for a list of document digests
+    if not 0 < len(digests) <= MAX_LEAVES:
+        raise ValueError(f"A tree holds 1 to {MAX_LEAVES} documents")
+    hashes = [leaf_hash(digest) for digest in digests]
+    proofs = [[] for _ in digests]
+    root = _subtree(hashes, 0, len(hashes), proofs)
+    return root, proofs
+
+
+def _subtree(hashes, start, end, proofs):
+    if end - start == 1:
+        return hashes[start]
+    split = start + (1 << (end - start - 1).bit_length() - 1)
+    left = _subtree(hashes, start, split, proofs)
+    right = _subtree(hashes, split, end, proofs)
+    # Proofs are built from the leaf upwards, so the sibling is appended
+    for i in range(start, split):
+        proofs[i].append(right)
+    for i in range(split, end):
+        proofs[i].append(left)
+    return node_hash(left, right)
+
+
+def root_from_proof(digest, index, size, proof):
+    # The root a valid proof leads to, or None if the proof does not fit the
+    # position (RFC 9162, 2.1.3.2)
+    if index >= size or len(proof) > MAX_DEPTH:
+        return None
+    fn, sn = index, size - 1
+    root = leaf_hash(digest)
+    for sibling in proof:
+        if sn == 0:
+            return None
+        if fn & 1 or fn == sn:
+            root = node_hash(sibling, root)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            root = node_hash(root, sibling)
+        fn >>= 1
+        sn >>= 1
+    return root if sn == 0 else None
+
+
+def signed_message(root, size):
+    # The digest the private key signs for a tree
+    return hashlib.sha256(ROOT_CONTEXT + struct.pack('>I', size) + root).digest()
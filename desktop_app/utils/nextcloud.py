@@ -0,0 +1,530 @@
+import argparse
+import base64
+import datetime
+import http.client
+import os
+import queue
+import random
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import quote, urlsplit
+
+from desktop_app.config.config_manager import ConfigManager
+from desktop_app.utils.instrumentation import span
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY,
+    remote_name TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+# Columns added since the first version of the queue
+MIGRATIONS = {
+    'owner': 'ALTER TABLE uploads ADD COLUMN owner TEXT',
+    'lease_until': 'ALTER TABLE uploads ADD COLUMN lease_until REAL NOT NULL DEFAULT 0',
+}
+
+PENDING = 'pending'
+UPLOADING = 'uploading'
+FAILED = 'failed'
+
+DEFAULT_PATTERN = '{template_name}-{date}-{counter}-{client_name}-{signer}.pdf'
+DEFAULT_WORKERS = 2
+DEFAULT_CHUNK_MB = 10
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_TIMEOUT = 60
+# Seconds an upload stays claimed by its process; chunked uploads renew it after every chunk
+DEFAULT_LEASE = 600
+# Retry delays double from BACKOFF_BASE up to BACKOFF_MAX seconds
+BACKOFF_BASE = 5
+BACKOFF_MAX = 3600
+
+
+class UploadError(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def backoff_delay(attempts):
+    # Exponential with jitter, so queued uploads do not all retry at once after an outage
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** max(attempts - 1, 0))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def remote_name(pattern, template_name, form_data, signer, counter, date=None):
+    values = {key.lower(): value for key, value in form_data.items()}
+    fields = {
+        'template_name': os.path.splitext(template_name)[0],
+        'date': (date or datetime.date.today()).isoformat(),
+        'counter': counter,
+        'client_name': values.get('clientname', ''),
+        'signer': signer,
+    }
+    # Field values must not add directory levels
+    fields = {key: value.replace('/', '_').replace('\\', '_') if isinstance(value, str) else value
+              for key, value in fields.items()}
+    return pattern.format_map(fields)
+
+
+class ArchiveQueue:
+    # Finished PDFs waiting for upload, in a SQLite file. Each entry holds a
+    # copy of the PDF in the spool directory next to the database, so
+    # moving, deleting or rewriting the original does not change the upload.
+    # The {counter} of the file name pattern is taken in the same
+    # transaction that adds the entry, so it is unique across processes
+    # (batch workers) and continues after a restart. Several processes may
+    # upload from one queue: a claimed entry carries its owner and a lease,
+    # and is only taken over by others once the lease has run out.
+
+    def __init__(self, path, lease=DEFAULT_LEASE):
+        self.path = path
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.spool_dir = os.path.splitext(path)[0] + '-spool'
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(uploads)')}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self._conn.execute(statement)
+
+    def spool_path(self, upload_id):
+        return os.path.join(self.spool_dir, f"{upload_id}.pdf")
+
+    def enqueue(self, pdf_path, pattern, template_name, form_data, signer):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('upload', 0)")
+                self._conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'upload'")
+                counter = self._conn.execute("SELECT value FROM counters WHERE name = 'upload'").fetchone()[0]
+                name = remote_name(pattern, template_name, form_data, signer, counter)
+                cursor = self._conn.execute('INSERT INTO uploads (remote_name, created_at) VALUES (?, ?)',
+                                            (name, datetime.datetime.now().isoformat(timespec='seconds')))
+                # A copy, not a link: the original may be rewritten in place later.
+                # It gets its name only when complete, so a crash leaves no partial upload.
+                spool_path = self.spool_path(cursor.lastrowid)
+                temp_path = f"{spool_path}.{uuid.uuid4().hex}.tmp"
+                try:
+                    shutil.copyfile(pdf_path, temp_path)
+                    os.replace(temp_path, spool_path)
+                except BaseException:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return name
+
+    def claim(self, now=None):
+        # The next due upload, marked as in progress by this queue; None if
+        # nothing is due. Uploads whose owner let the lease run out (it
+        # exited or hangs) are due again.
+        now = time.time() if now is None else now
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            row = self._conn.execute('SELECT id, remote_name, attempts FROM uploads '
+                                     'WHERE (state = ? AND next_attempt <= ?) OR (state = ? AND lease_until <= ?) '
+                                     'ORDER BY id LIMIT 1', (PENDING, now, UPLOADING, now)).fetchone()
+            if row is not None:
+                self._conn.execute('UPDATE uploads SET state = ?, owner = ?, lease_until = ? WHERE id = ?',
+                                   (UPLOADING, self.owner, now + self.lease, row[0]))
+            self._conn.execute('COMMIT')
+        return row
+
+    def renew(self, upload_id):
+        # Extends the lease of an upload this queue is working on
+        with self._lock:
+            self._conn.execute('UPDATE uploads SET lease_until = ? WHERE id = ? AND state = ? AND owner = ?',
+                               (time.time() + self.lease, upload_id, UPLOADING, self.owner))
+
+    def complete(self, upload_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM uploads WHERE id = ?', (upload_id,))
+        try:
+            os.remove(self.spool_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def retry_later(self, upload_id, error, delay):
+        # This and fail() are ignored for an upload that another process has taken over meanwhile
+        with self._lock:
+            self._conn.execute('UPDATE uploads SET state = ?, attempts = attempts + 1, next_attempt = ?, error = ? '
+                               'WHERE id = ? AND owner = ?', (PENDING, time.time() + delay, error, upload_id,
+                                                              self.owner))
+
+    def fail(self, upload_id, error):
+        # Kept with its spool file until retried with "doccreator archive retry"
+        with self._lock:
+            self._conn.execute('UPDATE uploads SET state = ?, attempts = attempts + 1, error = ? '
+                               'WHERE id = ? AND owner = ?', (FAILED, error, upload_id, self.owner))
+
+    def recover(self, now=None):
+        # Uploads interrupted by an exit are started again: this queue's own,
+        # and those of other processes once their lease has run out. Uploads
+        # still running in another process are left alone.
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._conn.execute('UPDATE uploads SET state = ?, owner = NULL '
+                                      'WHERE state = ? AND (owner = ? OR lease_until <= ?)',
+                                      (PENDING, UPLOADING, self.owner, now)).rowcount
+
+    def retry_failed(self):
+        with self._lock:
+            return self._conn.execute('UPDATE uploads SET state = ?, attempts = 0, next_attempt = 0 '
+                                      'WHERE state = ?', (PENDING, FAILED)).rowcount
+
+    def next_due(self):
+        # When the next retry is due or the lease of another process's upload runs out
+        with self._lock:
+            row = self._conn.execute('SELECT MIN(CASE WHEN state = ? THEN next_attempt ELSE lease_until END) '
+                                     'FROM uploads WHERE state = ? OR (state = ? AND owner IS NOT ?)',
+                                     (PENDING, PENDING, UPLOADING, self.owner)).fetchone()
+        return row[0]
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT state, COUNT(*) FROM uploads GROUP BY state'))
+        return {state: counts.get(state, 0) for state in (PENDING, UPLOADING, FAILED)}
+
+    def failures(self):
+        with self._lock:
+            return self._conn.execute('SELECT id, remote_name, attempts, error FROM uploads WHERE state = ? '
+                                      'ORDER BY id', (FAILED,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class WebDavClient:
+    # Minimal WebDAV client over http.client with a pool of keep-alive
+    # connections, one per upload thread. Files up to chunk_size are sent
+    # with one PUT; larger ones use Nextcloud's chunked upload (MKCOL an
+    # upload folder, PUT the chunks, MOVE the assembled file into place), so
+    # an interrupted transfer does not leave a partial file at the target.
+
+    def __init__(self, files_url, uploads_url, username, password, chunk_size=DEFAULT_CHUNK_MB * 1024 * 1024,
+                 timeout=DEFAULT_TIMEOUT):
+        parsed = urlsplit(files_url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.files_path = parsed.path.rstrip('/')
+        self.uploads_path = urlsplit(uploads_url).path.rstrip('/')
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        credentials = base64.b64encode(f"{username}:{password}".encode('utf-8')).decode('ascii')
+        self.authorization = f"Basic {credentials}"
+        self._idle = queue.LifoQueue()
+        self._directories = set()
+
+    @classmethod
+    def for_config(cls, config):
+        url = config.get('Nextcloud', 'url').rstrip('/')
+        username = config.get('Nextcloud', 'username')
+        return cls(config.get('Nextcloud', 'webdav_url', fallback=f"{url}/remote.php/dav/files/{quote(username)}"),
+                   config.get('Nextcloud', 'uploads_url', fallback=f"{url}/remote.php/dav/uploads/{quote(username)}"),
+                   username, config.get('Nextcloud', 'password'),
+                   config.getint('Nextcloud', 'chunk_mb', fallback=DEFAULT_CHUNK_MB) * 1024 * 1024,
+                   config.getint('Nextcloud', 'timeout', fallback=DEFAULT_TIMEOUT))
+
+    def upload(self, local_path, remote_path, progress=None):
+        # progress, if given, is called after every chunk of a chunked upload
+        self.make_directories(os.path.dirname(remote_path))
+        size = os.path.getsize(local_path)
+        with open(local_path, 'rb') as f:
+            if size <= self.chunk_size:
+                self._check(self.request('PUT', self.files_path + '/' + remote_path, f, size), 'PUT')
+            else:
+                self._upload_chunked(f, size, remote_path, progress)
+
+    def make_directories(self, remote_dir):
+        path = ''
+        for part in [p for p in remote_dir.split('/') if p]:
+            path = f"{path}/{part}"
+            if path in self._directories:
+                continue
+            status = self.request('MKCOL', self.files_path + path)
+            # 405: exists already
+            if status not in (201, 405):
+                self._check(status, 'MKCOL')
+            self._directories.add(path)
+
+    def _upload_chunked(self, f, size, remote_path, progress=None):
+        upload_dir = f"{self.uploads_path}/doccreator-{uuid.uuid4().hex}"
+        destination = {'Destination': self._url(self.files_path + '/' + remote_path),
+                       'OC-Total-Length': str(size)}
+        self._check(self.request('MKCOL', upload_dir, headers=destination), 'MKCOL')
+        try:
+            number = 1
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                self._check(self.request('PUT', f"{upload_dir}/{number:05d}", chunk, len(chunk), destination),
+                            'PUT')
+                number += 1
+                if progress is not None:
+                    progress()
+            self._check(self.request('MOVE', f"{upload_dir}/.file", headers=destination), 'MOVE')
+        except UploadError:
+            # The server removes stale upload folders eventually; this just tidies up early
+            try:
+                self.request('DELETE', upload_dir)
+            except (OSError, http.client.HTTPException):
+                pass
+            raise
+
+    def request(self, method, path, body=None, length=None, headers=None):
+        request_headers = {'Authorization': self.authorization}
+        if body is not None:
+            request_headers['Content-Length'] = str(length if length is not None else len(body))
+        request_headers.update(headers or {})
+        start = body.tell() if hasattr(body, 'tell') else None
+        # A pooled connection may have been closed by the server meanwhile; then try once on a new one
+        for pooled in (True, False):
+            conn = self._connection(pooled)
+            try:
+                if start is not None:
+                    body.seek(start)
+                conn.request(method, quote(path), body=body, headers=request_headers)
+                response = conn.getresponse()
+                response.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if not pooled:
+                    raise
+                continue
+            except BaseException:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._idle.put(conn)
+            return response.status
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _connection(self, pooled):
+        if pooled:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _url(self, path):
+        return f"{self.scheme}://{self.netloc}{quote(path)}"
+
+    def _check(self, status, method):
+        if 200 <= status < 300:
+            return
+        # Server errors, rate limits and timeouts are worth retrying; other client errors are not
+        raise UploadError(f"{method} failed with HTTP {status}", status >= 500 or status in (408, 423, 429))
+
+
+class ArchiveUploader:
+    # Background threads that drain the archive queue. Document creation
+    # only adds to the queue and wakes them; it never waits for the network.
+
+    def __init__(self, archive_queue, client, remote_dir='', workers=DEFAULT_WORKERS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.queue = archive_queue
+        self.client = client
+        self.remote_dir = remote_dir.strip('/')
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.uploaded = 0
+        self._wake = threading.Condition()
+        self._stopping = False
+        self._threads = []
+
+    def start(self):
+        self.queue.recover()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        with self._wake:
+            self._wake.notify_all()
+
+    def stop(self):
+        with self._wake:
+            self._stopping = True
+            self._wake.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self.client.close()
+
+    def upload_one(self):
+        # Uploads the next due entry; False if none is due
+        row = self.queue.claim()
+        if row is None:
+            return False
+        upload_id, name, attempts = row
+        remote_path = f"{self.remote_dir}/{name}" if self.remote_dir else name
+        try:
+            with span('archive.upload', file=name) as timer:
+                local_path = self.queue.spool_path(upload_id)
+                timer.add_bytes(os.path.getsize(local_path))
+                self.client.upload(local_path, remote_path, lambda: self.queue.renew(upload_id))
+        except FileNotFoundError as e:
+            self.queue.fail(upload_id, f"Spool file missing: {e}")
+        except UploadError as e:
+            if e.retryable and attempts + 1 < self.max_attempts:
+                self.queue.retry_later(upload_id, str(e), backoff_delay(attempts + 1))
+            else:
+                self.queue.fail(upload_id, str(e))
+        except (OSError, http.client.HTTPException) as e:
+            # Network errors: the server may be back later
+            error = f"{type(e).__name__}: {e}"
+            if attempts + 1 < self.max_attempts:
+                self.queue.retry_later(upload_id, error, backoff_delay(attempts + 1))
+            else:
+                self.queue.fail(upload_id, error)
+        else:
+            self.queue.complete(upload_id)
+            self.uploaded += 1
+        return True
+
+    def _work(self):
+        while not self._stopping:
+            try:
+                if self.upload_one():
+                    continue
+                next_due = self.queue.next_due()
+            except sqlite3.Error:
+                next_due = None
+            timeout = None if next_due is None else max(0.0, next_due - time.time())
+            with self._wake:
+                if not self._stopping:
+                    self._wake.wait(timeout)
+
+
+_archives = {}
+_archives_lock = threading.Lock()
+_uploaders = {}
+
+
+def archive_enabled(config):
+    return config.getboolean('Nextcloud', 'enabled', fallback=False)
+
+
+def get_archive_queue(config):
+    # One queue per file and process; None when the Nextcloud upload is disabled
+    if not archive_enabled(config):
+        return None
+    path = config.get('Nextcloud', 'queue', fallback='archive/uploads.sqlite')
+    with _archives_lock:
+        if path not in _archives:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            _archives[path] = ArchiveQueue(path, config.getint('Nextcloud', 'lease', fallback=DEFAULT_LEASE))
+        return _archives[path]
+
+
+def start_uploader(config):
+    # Starts the background upload threads of this process, once per queue
+    archive_queue = get_archive_queue(config)
+    if archive_queue is None:
+        return None
+    with _archives_lock:
+        uploader = _uploaders.get(archive_queue.path)
+        if uploader is None:
+            uploader = ArchiveUploader(archive_queue, WebDavClient.for_config(config),
+                                       config.get('Nextcloud', 'remote_dir', fallback='DocCreator'),
+                                       config.getint('Nextcloud', 'upload_workers', fallback=DEFAULT_WORKERS),
+                                       config.getint('Nextcloud', 'max_attempts', fallback=DEFAULT_MAX_ATTEMPTS))
+            uploader.start()
+            _uploaders[archive_queue.path] = uploader
+        return uploader
+
+
+def enqueue_document(config, pdf_path, template_name, form_data, signer):
+    # Only queues the file; batch workers use this and leave the upload to the app or the CLI
+    archive_queue = get_archive_queue(config)
+    if archive_queue is None:
+        return None
+    pattern = config.get('Nextcloud', 'upload_pattern', fallback=DEFAULT_PATTERN)
+    return archive_queue.enqueue(pdf_path, pattern, template_name, form_data, signer)
+
+
+def archive_document(config, pdf_path, template_name, form_data, signer):
+    name = enqueue_document(config, pdf_path, template_name, form_data, signer)
+    if name is not None:
+        start_uploader(config).wake()
+    return name
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='doccreator archive', description='Manage the Nextcloud upload queue.')
+    parser.add_argument('--config', default='config.ini')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='queued and failed uploads')
+    commands.add_parser('run', help='upload everything that is due, then exit')
+    commands.add_parser('retry', help='queue failed uploads again')
+    args = parser.parse_args(argv)
+
+    config = ConfigManager(args.config)
+    archive_queue = get_archive_queue(config)
+    if archive_queue is None:
+        print("Nextcloud upload is not enabled ([Nextcloud] enabled)", file=sys.stderr)
+        return 1
+    if args.command == 'status':
+        stats = archive_queue.stats()
+        print(f"{stats[PENDING]} pending, {stats[UPLOADING]} uploading, {stats[FAILED]} failed")
+        for upload_id, name, attempts, error in archive_queue.failures():
+            print(f"{upload_id} {name} ({attempts} attempts): {error}")
+    elif args.command == 'retry':
+        print(f"{archive_queue.retry_failed()} uploads queued again")
+    elif args.command == 'run':
+        archive_queue.recover()
+        uploader = ArchiveUploader(archive_queue, WebDavClient.for_config(config),
+                                   config.get('Nextcloud', 'remote_dir', fallback='DocCreator'),
+                                   max_attempts=config.getint('Nextcloud', 'max_attempts',
+                                                              fallback=DEFAULT_MAX_ATTEMPTS))
+        while uploader.upload_one():
+            pass
+        uploader.client.close()
+        stats = archive_queue.stats()
+        print(f"{uploader.uploaded} uploaded, {stats[PENDING]} waiting for retry, {stats[FAILED]} failed")
+        return 1 if stats[FAILED] else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,133 @@
-from docx2pdf import convert
-from PyPDF2 import PdfFileWriter, PdfFileReader
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
 import io
+import datetime
+import logging
+from desktop_app.utils.template_manager import TemplateManager
 
-def create_pdf(config, template_name, form_data):
-    # TODO: Implement Word template filling
-    # TODO: Convert Word to PDF
-    # TODO: Add signature and other required elements
-    # TODO: Digitally sign the PDF
+# Entry point for the UI. The PDF, crypto and imaging stack is imported by
+# the functions that need it, so opening the app does not load it.
+
+# Stages of creating a document, in order. A progress callback is called
+# with each stage name before the stage starts; it may raise
+# GenerationCancelled to stop the document there. The document is signed
+# by then, so a cancel before 'archive' is ignored: the file is kept,
+# registered and archived like any other.
+STAGES = ('fill', 'convert', 'overlay', 'fingerprint', 'write', 'sign', 'archive')
+
+logger = logging.getLogger(__name__)
+
+class GenerationCancelled(Exception):
     pass
 
-def fill_template(template_path, output_path, form_data):
-    # TODO: Implement Word template filling using python-docx
+def no_progress(stage):
     pass
 
+def stage(progress, name, cancellable=True):
+    # Reports the stage and times it; with spans disabled the timer is a no-op
+    from desktop_app.utils.instrumentation import span
+
+    try:
+        progress(name)
+    except GenerationCancelled:
+        if cancellable:
+            raise
+    return span(f"document.{name}")
+
+def create_pdf(config, template_name, form_data, author, output_path=None, signature=None, progress=no_progress):
+    from desktop_app.utils.document_registry import register_document
+    from desktop_app.utils.nextcloud import archive_document
+
+    output_path, fingerprint = render_document(config, template_name, form_data, author, output_path, signature,
+                                               progress)
+    with stage(progress, 'archive', cancellable=False):
+        register_document(config, fingerprint, template_name, author.short_name)
+        # Only queued here; the upload runs in the background
+        archive_document(config, output_path, template_name, form_data, author.short_name)
+    return output_path
+
+def render_document(config, template_name, form_data, author, output_path=None, signature=None,
+                    progress=no_progress, batch_signing=None):
+    # Fill the Word template, convert it with the configured backend, then
+    # stamp signature and verification footer onto it and sign the result.
+    # With a render cache, a document filled with the same values before
+    # skips filling and conversion and only goes through the last steps.
+    from desktop_app.utils.docx_converter import anchor_text, get_converter
+    from desktop_app.utils.pdf_utils import render_pdf
+    from desktop_app.utils.render_cache import cache_key, get_render_cache, normalize_values
+    from desktop_app.utils.signing import get_signing_engine
+
+    converter = get_converter(config)
+    cache = get_render_cache(config)
+    cached = None
+    with stage(progress, 'fill') as timer:
+        template_manager = TemplateManager(config)
+        settings = template_manager.get_template_settings(template_name)
+        values = template_values(form_data, author, settings.get('current_date', 'DD.MM.YYYY'))
+        values['VerificationURL'] = config.get('Verification', 'url')
+        if converter.anchors:
+            # The signature goes where its placeholder lands
+            values['SignerSignature'] = anchor_text('SignerSignature')
+        values = normalize_values(values)
+        template = template_manager.get_compiled_template(template_name)
+        if cache is not None:
+            key_id = get_signing_engine(config.get('Paths', 'private_key')).key_id
+            key = cache_key(template.digest, values, config.get('Conversion', 'backend', fallback='builtin'),
+                            key_id)
+            cached = cache_lookup(cache, key)
+        if cached is None:
+            docx_data = template.fill(values)
+            timer.add_bytes(len(docx_data))
+
+    with stage(progress, 'convert') as timer:
+        if cached is None:
+            pdf_data, anchors = converter.convert_anchored(docx_data)
+            if cache is not None:
+                cache_store(cache, key, pdf_data, anchors)
+        else:
+            pdf_data, anchors = cached
+        base_pdf = io.BytesIO(pdf_data)
+        timer.add_bytes(len(pdf_data))
+    return render_pdf(config, template_name, form_data, author, output_path, signature, base_pdf, progress,
+                      anchors, batch_signing)
+
+def cache_lookup(cache, key):
+    # The cache only saves work; a full disk or a locked index never stops a document
+    import sqlite3
+
+    try:
+        return cache.get(key)
+    except (OSError, sqlite3.Error):
+        logger.warning("Render cache lookup failed", exc_info=True)
+        return None
+
+def cache_store(cache, key, pdf_data, anchors):
+    import sqlite3
+
+    try:
+        cache.put(key, pdf_data, anchors)
+    except (OSError, sqlite3.Error):
+        logger.warning("Render cache store failed", exc_info=True)
+
+def fill_template(template_path, output_path, form_data):
+    # The template is parsed once and cached; filling only patches the known placeholder slots
+    compiled = TemplateManager.compile_template_file(template_path)
+    return compiled.fill(form_data, output_path)
+
+def template_values(form_data, author, date_format='DD.MM.YYYY', date=None):
+    values = dict(form_data)
+    values.update(author.to_dict())
+    values['SignerName'] = author.full_name
+    values['SignerCell'] = author.mobile_phone
+    # The signature image is placed by the PDF stamp, not as text; converters
+    # that report anchors get a mark here to locate it
+    values['SignerSignature'] = ''
+    values['CurrentDate'] = format_current_date(date_format, date)
+    return values
+
+def format_current_date(date_format, date=None):
+    date = date or datetime.date.today()
+    pattern = date_format.replace('YYYY', '%Y').replace('MM', '%m').replace('DD', '%d')
+    return date.strftime(pattern)
+
 def add_signature(input_pdf, output_pdf, signature_image):
     # TODO: Implement adding signature to the PDF
     pass
@@ -0,0 +1,424 @@
+import datetime
+import hashlib
+import io
+import re
+import struct
+
+from cryptography.exceptions import InvalidSignature
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject,
+                            createStringObject)
+
+from desktop_app.utils import merkle
+from desktop_app.utils.fingerprint import FINGERPRINT_KEY
+from desktop_app.utils.signing import verify_digest, key_algorithm, key_id
+
+SIGNATURE_FILTER = '/DocCreator'
+SIGNATURE_SUBFILTER = '/DocCreator.sha256'
+# Signed as one leaf of a Merkle tree: /Contents holds the root signature and the inclusion proof
+MERKLE_SUBFILTER = '/DocCreator.merkle'
+
+# Space reserved in /Contents: a 2 byte length prefix plus the signature,
+# enough for RSA-4096. Unused space is zero padded.
+SIGNATURE_RESERVED = 1024
+# A Merkle proof adds leaf index, tree size and proof length, then one hash per level
+MERKLE_HEADER = struct.Struct('>IIB')
+CHUNK_SIZE = 1024 * 1024
+
+# The signature dictionary is written last, so the verifier only needs the tail of the file
+TAIL_SIZE = 64 * 1024
+
+_BYTE_RANGE_PLACEHOLDER = b"0 0000000000 0000000000 0000000000"
+_CONTENTS_PATTERN = re.compile(rb"/Contents\s*<")
+
+
+class HashingWriter:
+    # Passes writes through to a file while hashing them, so a freshly written
+    # document can be signed without reading its body back.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.stream.write(data)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def flush(self):
+        self.stream.flush()
+
+
+class SignatureError(Exception):
+    # reason is one of the REASON_* codes, so callers can present their own message
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+REASON_MISSING = 'missing'
+REASON_MODIFIED = 'modified'
+REASON_UNKNOWN_KEY = 'unknown_key'
+REASON_INVALID = 'invalid'
+
+
+def embed_signature(stream, engine, digest=None):
+    # Append the signature as an incremental update: a signature dictionary
+    # with /ByteRange, a signature field on the first page and the updated
+    # catalog, followed by an xref section chained to the previous one via
+    # /Prev. The existing document bytes are never rewritten.
+    #
+    # digest is a running SHA-256 over everything already in the stream; when
+    # it is not given the stream is hashed from the start in chunks.
+    update, contents_start, digest = _signature_update(stream, engine, SIGNATURE_SUBFILTER, SIGNATURE_RESERVED,
+                                                       digest)
+    signature = engine.sign_digest(digest)
+    _fill_contents(update, contents_start, struct.pack('>H', len(signature)) + signature, SIGNATURE_RESERVED)
+    stream.seek(0, io.SEEK_END)
+    stream.write(update)
+    return signature
+
+
+def embed_signature_placeholder(stream, engine, max_leaves, digest=None):
+    # Like embed_signature, for documents signed together as a Merkle tree of
+    # up to max_leaves documents: /Contents is left empty. Returns the
+    # document digest, which is the tree leaf, and the file offset at which
+    # fill_merkle_signature writes the contents once the root is signed.
+    reserved = merkle_reserved(max_leaves)
+    update, contents_start, digest = _signature_update(stream, engine, MERKLE_SUBFILTER, reserved, digest)
+    stream.seek(0, io.SEEK_END)
+    offset = stream.tell() + contents_start + 1
+    stream.write(update)
+    return digest, offset
+
+
+def fill_merkle_signature(stream, offset, max_leaves, signature, index, size, proof):
+    # Writes root signature and inclusion proof into a placeholder. /Contents
+    # is outside the signed byte range, so the document digest is unchanged.
+    contents = (struct.pack('>H', len(signature)) + signature + MERKLE_HEADER.pack(index, size, len(proof))
+                + b"".join(proof))
+    if len(contents) > merkle_reserved(max_leaves):
+        raise ValueError("Signature does not fit into the reserved space")
+    stream.seek(offset)
+    stream.write(contents.hex().upper().encode())
+
+
+def merkle_reserved(max_leaves):
+    return SIGNATURE_RESERVED + MERKLE_HEADER.size + merkle.depth(max_leaves) * merkle.HASH_SIZE
+
+
+def _signature_update(stream, engine, subfilter, reserved, digest=None):
+    # The incremental update with an empty /Contents of reserved bytes, the
+    # offset of /Contents in it and the digest of the signed byte ranges
+    stream.seek(0, io.SEEK_END)
+    body_size = stream.tell()
+    previous_xref = _previous_xref(stream, body_size)
+
+    reader = PdfFileReader(stream, strict=False)
+    trailer = reader.trailer
+    size = int(trailer['/Size'])
+    root_ref = trailer.raw_get('/Root')
+    page_ref = _first_page_ref(reader)
+    sig_num, field_num = size, size + 1
+
+    # Author and fingerprint are repeated in the signature dictionary, so a
+    # verifier that only sees the tail of the file can report them
+    info = reader.getDocumentInfo() or {}
+    details = b""
+    for key, info_key in (('/Name', '/Author'), ('/DCFingerprint', FINGERPRINT_KEY)):
+        if info_key in info:
+            details += b"%s %s " % (key.encode(), _serialize(createStringObject(info[info_key])))
+
+    objects = []
+    now = datetime.datetime.now().strftime("D:%Y%m%d%H%M%S")
+    objects.append((sig_num, (
+        b"<< /Type /Sig /Filter %s /SubFilter %s /DCAlgorithm /%s /DCKeyID (%s) %s/M (%s) "
+        b"/ByteRange [%s] /Contents <%s> >>" % (
+            SIGNATURE_FILTER.encode(), subfilter.encode(), engine.algorithm.encode(),
+            engine.key_id.encode(), details, now.encode(), _BYTE_RANGE_PLACEHOLDER,
+            b"0" * (reserved * 2)))))
+    objects.append((field_num, (
+        b"<< /Type /Annot /Subtype /Widget /FT /Sig /T (DocCreator Signature) /V %d 0 R "
+        b"/F 132 /Rect [0 0 0 0] /P %d %d R >>" % (sig_num, page_ref.idnum, page_ref.generation))))
+
+    field_ref = IndirectObject(field_num, 0, reader)
+    root = DictionaryObject(reader.getObject(root_ref))
+    acroform = root['/AcroForm'] if '/AcroForm' in root else None
+    acroform = DictionaryObject(acroform) if acroform is not None else DictionaryObject()
+    fields = ArrayObject(acroform['/Fields']) if '/Fields' in acroform else ArrayObject()
+    fields.append(field_ref)
+    acroform[NameObject('/Fields')] = fields
+    acroform[NameObject('/SigFlags')] = NumberObject(3)
+    root[NameObject('/AcroForm')] = acroform
+    objects.append((root_ref.idnum, _serialize(root)))
+
+    page = DictionaryObject(reader.getObject(page_ref))
+    annots = ArrayObject(page['/Annots']) if '/Annots' in page else ArrayObject()
+    annots.append(field_ref)
+    page[NameObject('/Annots')] = annots
+    objects.append((page_ref.idnum, _serialize(page)))
+
+    update = io.BytesIO()
+    update.write(b"\n")
+    offsets = {}
+    for num, data in objects:
+        offsets[num] = body_size + update.tell()
+        update.write(b"%d 0 obj\n%s\nendobj\n" % (num, data))
+
+    xref_offset = body_size + update.tell()
+    update.write(b"xref\n0 1\n0000000000 65535 f\r\n")
+    for num in sorted(offsets):
+        update.write(b"%d 1\n%010d 00000 n\r\n" % (num, offsets[num]))
+    new_trailer = DictionaryObject()
+    for key in ('/Root', '/Info', '/ID'):
+        if key in trailer:
+            new_trailer[NameObject(key)] = trailer.raw_get(key)
+    new_trailer[NameObject('/Size')] = NumberObject(size + 2)
+    new_trailer[NameObject('/Prev')] = NumberObject(previous_xref)
+    update.write(b"trailer\n" + _serialize(new_trailer) + b"\nstartxref\n%d\n%%%%EOF\n" % xref_offset)
+    update = bytearray(update.getvalue())
+
+    # Fill in the byte range around the /Contents hex string, then hash
+    contents_start = update.index(b"/Contents <", update.index(b"/Type /Sig")) + len(b"/Contents ")
+    contents_end = update.index(b">", contents_start) + 1
+    total_size = body_size + len(update)
+    byte_range = b"0 %010d %010d %010d" % (
+        body_size + contents_start, body_size + contents_end, total_size - body_size - contents_end)
+    range_start = update.index(_BYTE_RANGE_PLACEHOLDER)
+    update[range_start:range_start + len(byte_range)] = byte_range
+
+    if digest is None:
+        digest = _hash_range(stream, 0, body_size, hashlib.sha256())
+    else:
+        digest = digest.copy()
+    digest.update(update[:contents_start])
+    digest.update(update[contents_end:])
+    return update, contents_start, digest.digest()
+
+
+def _fill_contents(update, contents_start, contents, reserved):
+    if len(contents) > reserved:
+        raise ValueError("Signature does not fit into the reserved space")
+    contents = contents.hex().upper().encode()
+    update[contents_start + 1:contents_start + 1 + len(contents)] = contents
+
+
+def read_signature(stream):
+    # Returns the last embedded signature as a dict, or None if there is none
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    tail_start = max(0, size - TAIL_SIZE)
+    stream.seek(tail_start)
+    return _parse_signature(stream.read(), tail_start, size)
+
+
+def verify_signature(stream, keys):
+    # Hashes exactly the declared byte ranges in one sequential read and checks
+    # the signature. keys is a public key or a dict of public keys by key id.
+    # Raises SignatureError with a reason if it does not match.
+    signature = signature_digest(stream, keys)
+    verify_signature_digest(signature, keys)
+    return signature
+
+
+def signature_digest(stream, keys):
+    # Checks the signature structure and hashes the signed byte ranges into
+    # signature['digest'], without the public key operation
+    keys = key_ring(keys)
+    signature = read_signature(stream)
+    _check_signature(signature, keys)
+
+    start1, length1, start2, length2 = signature['byte_range']
+    digest = hashlib.sha256()
+    _hash_range(stream, start1, length1, digest)
+    _hash_range(stream, start2, length2, digest)
+    signature['digest'] = digest.digest()
+    return signature
+
+
+def verify_signature_digest(signature, keys, verified_roots=None):
+    # The public key operation, for a signature whose byte ranges were hashed
+    # into signature['digest']. verified_roots is an optional cache (get/put)
+    # of Merkle roots whose signature was already checked; further documents
+    # of the same tree then only need their proof hashed.
+    keys = key_ring(keys)
+    public_key = keys[signature['key_id']]
+    message, signed = signed_message(signature)
+    root_key = None
+    if verified_roots is not None and signature['subfilter'] == MERKLE_SUBFILTER:
+        root_key = _root_key(signature['key_id'], message, signed)
+        if verified_roots.get(root_key):
+            return
+    try:
+        verify_digest(public_key, signed, message)
+    except InvalidSignature:
+        raise SignatureError(REASON_INVALID, "The signature does not match the document")
+    if root_key is not None:
+        verified_roots.put(root_key, True)
+
+
+def signed_message(signature):
+    # The digest the key signed and the signature over it: the document
+    # digest itself, or for a Merkle signature the root its proof leads to
+    contents = signature['contents']
+    length = struct.unpack('>H', contents[:2])[0] if len(contents) >= 2 else 0
+    signed = contents[2:2 + length]
+    if signature['subfilter'] != MERKLE_SUBFILTER:
+        return signature['digest'], signed
+
+    proof_start = 2 + length + MERKLE_HEADER.size
+    if len(contents) < proof_start:
+        raise SignatureError(REASON_INVALID, "The signature has no Merkle proof")
+    index, size, proof_length = MERKLE_HEADER.unpack(contents[2 + length:proof_start])
+    proof_end = proof_start + proof_length * merkle.HASH_SIZE
+    if len(contents) < proof_end:
+        raise SignatureError(REASON_INVALID, "The Merkle proof is truncated")
+    proof = [contents[i:i + merkle.HASH_SIZE] for i in range(proof_start, proof_end, merkle.HASH_SIZE)]
+    root = merkle.root_from_proof(signature['digest'], index, size, proof)
+    if root is None:
+        raise SignatureError(REASON_INVALID, "The Merkle proof does not match the document")
+    return merkle.signed_message(root, size), signed
+
+
+def verified_root_key(signature):
+    # Cache key of the signed root of a Merkle signature, None for a document signature or a broken proof
+    if signature['subfilter'] != MERKLE_SUBFILTER:
+        return None
+    try:
+        message, signed = signed_message(signature)
+    except SignatureError:
+        return None
+    return _root_key(signature['key_id'], message, signed)
+
+
+def _root_key(key_id, message, signed):
+    return hashlib.sha256(key_id.encode() + message + signed).digest()
+
+
+def key_ring(keys):
+    if isinstance(keys, dict):
+        return keys
+    return {key_id(keys): keys}
+
+
+class SignatureVerifier:
+    # Incremental counterpart of verify_signature for documents that arrive as
+    # a stream and are never stored: data is hashed as it comes in and only
+    # the last TAIL_SIZE bytes, which hold the signature, are kept.
+
+    def __init__(self, keys):
+        self.keys = key_ring(keys)
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._tail = bytearray()
+
+    def update(self, data):
+        self.size += len(data)
+        self._tail += data
+        overflow = len(self._tail) - TAIL_SIZE
+        if overflow > 0:
+            self._digest.update(memoryview(self._tail)[:overflow])
+            del self._tail[:overflow]
+
+    def digest(self):
+        # Checks the signature structure and hashes the signed byte ranges,
+        # without the public key operation
+        tail_start = self.size - len(self._tail)
+        signature = _parse_signature(bytes(self._tail), tail_start, self.size)
+        _check_signature(signature, self.keys)
+
+        # Everything before the tail is already hashed; the gap for /Contents
+        # lies inside the tail because the signature dictionary is written last
+        start1, length1, start2, length2 = signature['byte_range']
+        if length1 < tail_start:
+            raise SignatureError(REASON_MODIFIED, "The signature is not at the end of the document")
+        digest = self._digest.copy()
+        digest.update(self._tail[:length1 - tail_start])
+        digest.update(self._tail[start2 - tail_start:])
+        signature['digest'] = digest.digest()
+        return signature
+
+    def finish(self):
+        signature = self.digest()
+        verify_signature_digest(signature, self.keys)
+        return signature
+
+
+def _parse_signature(tail, tail_start, size):
+    start = max(tail.rfind(b"/Type /Sig"), tail.rfind(b"/Type/Sig"))
+    dict_start = tail.rfind(b"<<", 0, start)
+    contents = _CONTENTS_PATTERN.search(tail, start)
+    if start < 0 or dict_start < 0 or contents is None:
+        return None
+    try:
+        sig = DictionaryObject.readFromStream(io.BytesIO(tail[dict_start:]), None)
+        byte_range = [int(value) for value in sig['/ByteRange']]
+    except Exception:
+        return None
+    if len(byte_range) != 4:
+        return None
+
+    contents_end = tail.find(b">", contents.end())
+    return {
+        'algorithm': str(sig.get('/DCAlgorithm', '/'))[1:],
+        'subfilter': str(sig.get('/SubFilter', SIGNATURE_SUBFILTER)),
+        'key_id': str(sig.get('/DCKeyID', '')),
+        'name': str(sig['/Name']) if '/Name' in sig else None,
+        'fingerprint': str(sig['/DCFingerprint']) if '/DCFingerprint' in sig else None,
+        'signed_at': str(sig['/M']) if '/M' in sig else None,
+        'byte_range': byte_range,
+        'contents': sig['/Contents'].original_bytes if '/Contents' in sig else b"",
+        'contents_range': (tail_start + contents.end() - 1, tail_start + contents_end + 1),
+        'size': size,
+    }
+
+
+def _check_signature(signature, keys):
+    if signature is None:
+        raise SignatureError(REASON_MISSING, "The document has no embedded signature")
+
+    start1, length1, start2, length2 = signature['byte_range']
+    if (start1 != 0 or (length1, start2) != signature['contents_range']
+            or start2 + length2 != signature['size']):
+        # The ranges must cover the whole file except the signature itself
+        raise SignatureError(REASON_MODIFIED, "The byte range does not cover the whole document")
+    public_key = keys.get(signature['key_id'])
+    if public_key is None or signature['algorithm'] != key_algorithm(public_key):
+        raise SignatureError(REASON_UNKNOWN_KEY, f"Signed with unknown key {signature['key_id']}")
+
+
+def _hash_range(stream, start, length, digest):
+    stream.seek(start)
+    while length > 0:
+        chunk = stream.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        digest.update(chunk)
+        length -= len(chunk)
+    return digest
+
+
+def _previous_xref(stream, size):
+    stream.seek(max(0, size - 1024))
+    tail = stream.read()
+    position = tail.rfind(b"startxref")
+    if position < 0:
+        raise ValueError("startxref not found")
+    return int(tail[position + len(b"startxref"):].split()[0])
+
+
+def _first_page_ref(reader):
+    node_ref = reader.trailer['/Root'].raw_get('/Pages')
+    while True:
+        node = reader.getObject(node_ref)
+        if node.get('/Type') != '/Pages':
+            return node_ref
+        node_ref = node['/Kids'][0]
+
+
+def _serialize(obj):
+    data = io.BytesIO()
+    obj.writeToStream(data, None)
+    return data.getvalue()
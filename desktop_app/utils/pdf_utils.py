@@ -1,114 +1,260 @@
-from PyPDF2 import PdfFileWriter, PdfFileReader
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject,
+                            NameObject, createStringObject)
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
+from reportlab.pdfbase.pdfmetrics import stringWidth
 import io
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.backends import default_backend
 import os
+import datetime
+from desktop_app.utils.signing import get_signing_engine, load_public_key
+from desktop_app.utils.pdf_signature import HashingWriter, SignatureError, embed_signature, verify_signature
+from desktop_app.utils.fingerprint import DocumentFingerprint, FINGERPRINT_KEY, FOOTER_XOBJECT
+from desktop_app.utils.document_registry import register_document
+from desktop_app.utils.signature_image import signature_image, SIGNATURE_BOX
+from desktop_app.utils.pdf_writer import StreamingPdfWriter, iter_pages, page_count
+from desktop_app.utils.pdf_creator import no_progress, stage
 
-def create_pdf(config, template_name, form_data, author):
-    # This is a placeholder implementation. You'll need to replace this with actual Word template filling.
-    packet = io.BytesIO()
-    can = canvas.Canvas(packet, pagesize=letter)
-    can.drawString(100, 100, f"Template: {template_name}")
-    for key, value in form_data.items():
-        can.drawString(100, 120, f"{key}: {value}")
+OVERLAY_XOBJECT = '/DCOverlay'
+SIGNATURE_XOBJECT = '/DCSignature'
+# Footer text starts at FOOTER_X and ends at least FOOTER_MARGIN before the
+# right page edge; lines too long for the font size shrink down to
+# FOOTER_MIN_FONT_SIZE and wrap beyond that
+FOOTER_X = 100
+FOOTER_MARGIN = 72
+FOOTER_FONT = 'Helvetica'
+FOOTER_FONT_SIZE = 12
+FOOTER_MIN_FONT_SIZE = 7
+
+def create_pdf(config, template_name, form_data, author, output_path=None, signature=None):
+    output_path, fingerprint = render_pdf(config, template_name, form_data, author, output_path, signature)
+    register_document(config, fingerprint, template_name, author.short_name)
+    return output_path
+
+def render_pdf(config, template_name, form_data, author, output_path=None, signature=None, base_pdf=None,
+               progress=no_progress, anchors=None, batch_signing=None):
+    # Without a converted template as base document, the form data is listed as text.
+    # With batch_signing (a PendingSignatures), the document gets an empty
+    # signature that is completed when its batch is sealed.
+    lines = []
+    if base_pdf is None:
+        lines.append(f"Template: {template_name}")
+        for key, value in form_data.items():
+            lines.append(f"{key}: {value}")
+
+    if signature is None:
+        signature = author.decrypt_signature(config)
+
+    info = {
+        '/Author': author.full_name,
+        '/CreationDate': datetime.datetime.now().strftime("D:%Y%m%d%H%M%S"),
+    }
+    verification_url = config.get('Verification', 'url')
+
+    if output_path is None:
+        output_path = os.path.join(config.get('Paths', 'output_dir'), f"{template_name}_{author.short_name}.pdf")
+    engine = get_signing_engine(config.get('Paths', 'private_key'))
+    try:
+        with open(output_path, "w+b") as output_stream:
+            # The body is hashed while it is written, so signing appends an
+            # incremental update without reading the document back
+            hashing_stream = HashingWriter(output_stream)
+            fingerprint = compose_pdf(hashing_stream, lines, signature, verification_url, base_pdf, info,
+                                      progress, anchors)
+
+            # Digitally sign the PDF
+            with stage(progress, 'sign') as timer:
+                body_size = output_stream.tell()
+                if batch_signing is None:
+                    embed_signature(output_stream, engine, hashing_stream.digest)
+                else:
+                    batch_signing.embed(output_path, output_stream, engine, hashing_stream.digest)
+                timer.add_bytes(output_stream.tell() - body_size)
+    except BaseException:
+        # No unsigned or half-written document is left behind, also when cancelled
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+    return output_path, fingerprint
+
+def compose_pdf(output_stream, lines, signature, verification_url, base_pdf=None, info=None,
+                progress=no_progress, anchors=None):
+    # Pages are read, stamped, fingerprinted and written one at a time, so
+    # memory does not grow with the page count. The form text is drawn into
+    # a single canvas and stamped onto the first page as one form XObject;
+    # the signature is a pre-compressed image XObject placed where the
+    # converter reported its placeholder (anchors['SignerSignature'] as
+    # page, x, y), or at SIGNATURE_BOX on the first page. The verification
+    # footer prints the fingerprint, so it is a shared form XObject whose
+    # content is written after the last page.
+    with stage(progress, 'overlay') as timer:
+        if base_pdf is None:
+            base_pdf = io.BytesIO()
+            draw_overlay(base_pdf, letter, lines)
+            lines = []
+        reader = PdfFileReader(base_pdf)
+        if page_count(reader) < 1:
+            raise ValueError("The base document has no pages")
+
+        output = StreamingPdfWriter(output_stream)
+        footer_ref = output.reserve()
+        open_ref = output.add_object(_content_stream(b"q\n"))
+
+        images = {}
+        signature_page = 0
+        if signature:
+            image = signature_image(signature)
+            box = SIGNATURE_BOX
+            anchor = (anchors or {}).get('SignerSignature')
+            if anchor is not None:
+                signature_page, x, y = anchor
+                box = (x, y) + SIGNATURE_BOX[2:]
+            images[SIGNATURE_XOBJECT] = (image.add_to(output), image.placement(box))
+
+        fingerprint = DocumentFingerprint()
+        page = None
+        for i, page in enumerate(iter_pages(reader)):
+            xobjects = {FOOTER_XOBJECT: footer_ref}
+            if lines and i == 0:
+                packet = io.BytesIO()
+                draw_overlay(packet, (float(page.mediaBox.getWidth()), float(page.mediaBox.getHeight())), lines)
+                xobjects[OVERLAY_XOBJECT] = output.add_object(_form_xobject(PdfFileReader(packet).getPage(0)))
+            _stamp_page(output, page, open_ref, xobjects, images if i == signature_page else None)
+            fingerprint.add_page(page)
+            output.add_page(page)
+        if page is None:
+            # A page tree whose /Count is wrong
+            raise ValueError("The base document has no pages")
+        timer.add_bytes(output_stream.tell())
+
+    with stage(progress, 'fingerprint'):
+        digest = fingerprint.hexdigest()
+        footer_packet = io.BytesIO()
+        draw_footer(footer_packet, (float(page.mediaBox.getWidth()), float(page.mediaBox.getHeight())),
+                    [f"Verification URL: {verification_url}", f"Fingerprint: {digest}"])
+        footer = DecodedStreamObject()
+        _fill_form_xobject(footer, PdfFileReader(footer_packet).getPage(0))
+        footer[NameObject(FINGERPRINT_KEY)] = createStringObject(digest)
+        output.add_object(footer, footer_ref)
+
+    with stage(progress, 'write') as timer:
+        metadata = dict(info or {})
+        metadata[FINGERPRINT_KEY] = digest
+        start = output_stream.tell()
+        output.close(metadata)
+        timer.add_bytes(output_stream.tell() - start)
+    return digest
+
+def draw_overlay(stream, pagesize, lines):
+    can = canvas.Canvas(stream, pagesize=pagesize)
+    y = pagesize[1] - 72
+    for line in lines:
+        can.drawString(100, y, line)
+        y -= 20
     can.save()
 
-    packet.seek(0)
-    new_pdf = PdfFileReader(packet)
-    output = PdfFileWriter()
-    output.addPage(new_pdf.getPage(0))
-
-    # Add signature
-    signature = author.decrypt_signature(config)
-    if signature:
-        packet = io.BytesIO()
-        can = canvas.Canvas(packet, pagesize=letter)
-        can.drawImage(io.BytesIO(signature), 100, 100, 100, 50)  # Adjust position and size as needed
-        can.save()
-        packet.seek(0)
-        sig_pdf = PdfFileReader(packet)
-        page = output.getPage(0)
-        page.mergePage(sig_pdf.getPage(0))
-
-    # Create fingerprint
-    fingerprint = create_fingerprint(output)
-    
-    # Add verification URL and other variables
-    packet = io.BytesIO()
-    can = canvas.Canvas(packet, pagesize=letter)
-    can.drawString(100, 80, f"Verification URL: {config.get('Verification', 'url')}")
-    can.drawString(100, 60, f"Fingerprint: {fingerprint}")
+def draw_footer(stream, pagesize, lines):
+    can = canvas.Canvas(stream, pagesize=pagesize)
+    y = 80
+    for line, size in footer_layout(pagesize, lines):
+        can.setFont(FOOTER_FONT, size)
+        can.drawString(FOOTER_X, y, line)
+        y -= size + 8
     can.save()
-    packet.seek(0)
-    extra_pdf = PdfFileReader(packet)
-    page = output.getPage(0)
-    page.mergePage(extra_pdf.getPage(0))
 
-    # Digitally sign the PDF
-    output = sign_pdf(output, config.get('Paths', 'private_key'))
+def footer_layout(pagesize, lines):
+    # (text, font size) per printed line; the fingerprint alone is wider than
+    # an A4 page at the regular size
+    width = pagesize[0] - FOOTER_X - FOOTER_MARGIN
+    layout = []
+    for line in lines:
+        size = FOOTER_FONT_SIZE
+        line_width = stringWidth(line, FOOTER_FONT, size)
+        if line_width > width:
+            size = max(FOOTER_MIN_FONT_SIZE, int(size * width / line_width * 10) / 10)
+        while stringWidth(line, FOOTER_FONT, size) > width:
+            # Cut before the first character that no longer fits; digests and URLs have no spaces to break at
+            end = 1
+            while stringWidth(line[:end + 1], FOOTER_FONT, size) <= width:
+                end += 1
+            layout.append((line[:end], size))
+            line = line[end:]
+        layout.append((line, size))
+    return layout
 
-    # Save the PDF
-    output_path = os.path.join(config.get('Paths', 'output_dir'), f"{template_name}_{author.short_name}.pdf")
-    with open(output_path, "wb") as output_stream:
-        output.write(output_stream)
+def _content_stream(data):
+    stream = DecodedStreamObject()
+    stream.setData(data)
+    return stream
 
-    return output_path
+def _form_xobject(page):
+    form = DecodedStreamObject()
+    _fill_form_xobject(form, page)
+    return form
 
-def create_fingerprint(pdf):
-    # This is a simple implementation. You might want to use a more sophisticated method.
-    return hash(pdf.getPage(0).extractText())
-
-def sign_pdf(pdf, private_key_path):
-    with open(private_key_path, "rb") as key_file:
-        private_key = serialization.load_pem_private_key(
-            key_file.read(),
-            password=None,
-            backend=default_backend()
-        )
-
-    pdf_content = io.BytesIO()
-    pdf.write(pdf_content)
-    pdf_bytes = pdf_content.getvalue()
-
-    signature = private_key.sign(
-        pdf_bytes,
-        padding.PSS(
-            mgf=padding.MGF1(hashes.SHA256()),
-            salt_length=padding.PSS.MAX_LENGTH
-        ),
-        hashes.SHA256()
-    )
-
-    # In a real implementation, you would embed this signature in the PDF
-    # For this example, we'll just return the original PDF
-    return pdf
+def _fill_form_xobject(form, page):
+    # Reuse the page's content stream bytes as they are, filters included,
+    # instead of decoding and re-encoding them
+    contents = page['/Contents']
+    if isinstance(contents, ArrayObject):
+        data = b"".join(stream.getObject().getData() for stream in contents)
+    else:
+        data = contents._data
+        for key in ('/Filter', '/DecodeParms'):
+            if key in contents:
+                form[NameObject(key)] = contents[key]
+    form._data = data
+    form[NameObject('/Type')] = NameObject('/XObject')
+    form[NameObject('/Subtype')] = NameObject('/Form')
+    form[NameObject('/BBox')] = page.mediaBox
+    form[NameObject('/Resources')] = page['/Resources']
 
-def verify_pdf(pdf_path, public_key_path):
-    with open(public_key_path, "rb") as key_file:
-        public_key = serialization.load_pem_public_key(
-            key_file.read(),
-            backend=default_backend()
-        )
+def _stamp_page(output, page, open_ref, xobjects, images=None):
+    # Wrap the existing content in q/Q and draw the given XObjects on top;
+    # images come with the matrix that places them. Only the page and its
+    # resource dictionaries are touched; the original content streams are
+    # carried over unparsed.
+    resources = DictionaryObject(page['/Resources']) if '/Resources' in page else DictionaryObject()
+    page_xobjects = DictionaryObject(resources['/XObject']) if '/XObject' in resources else DictionaryObject()
+    invocations = b"Q\n"
+    for name, ref in xobjects.items():
+        page_xobjects[NameObject(name)] = ref
+        invocations += b"q %s Do Q\n" % name.encode()
+    for name, (ref, matrix) in (images or {}).items():
+        page_xobjects[NameObject(name)] = ref
+        invocations += b"q %s cm %s Do Q\n" % (" ".join("%.4f" % v for v in matrix).encode(), name.encode())
+    resources[NameObject('/XObject')] = page_xobjects
+    page[NameObject('/Resources')] = resources
 
-    with open(pdf_path, "rb") as pdf_file:
-        pdf_bytes = pdf_file.read()
+    contents = page.raw_get('/Contents') if '/Contents' in page else None
+    if isinstance(contents, IndirectObject) and isinstance(contents.getObject(), ArrayObject):
+        contents = contents.getObject()
+    streams = ArrayObject([open_ref])
+    if isinstance(contents, ArrayObject):
+        streams.extend(contents)
+    elif contents is not None:
+        streams.append(contents)
+    streams.append(output.add_object(_content_stream(invocations)))
+    page[NameObject('/Contents')] = streams
 
-    # In a real implementation, you would extract the signature from the PDF
-    # For this example, we'll assume the entire PDF was signed
-    try:
-        public_key.verify(
-            signature,
-            pdf_bytes,
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256()
-        )
-        return True
-    except:
-        return False
\ No newline at end of file
+def sign_pdf(pdf_path, private_key_path):
+    # Appends the signature to an existing PDF as an incremental update
+    with open(pdf_path, "r+b") as pdf_file:
+        return embed_signature(pdf_file, get_signing_engine(private_key_path))
+
+def sign_pdfs(pdf_paths, private_key_path, max_leaves=None):
+    # Signs many existing PDFs as Merkle trees, one private key operation per
+    # max_leaves documents; returns the number of signatures made
+    from desktop_app.utils.batch_signing import DEFAULT_MAX_LEAVES, sign_files
+
+    return sign_files(pdf_paths, get_signing_engine(private_key_path), max_leaves or DEFAULT_MAX_LEAVES)
+
+def verify_pdf(pdf_path, public_key_path):
+    public_key = load_public_key(public_key_path)
+    with open(pdf_path, "rb") as pdf_file:
+        try:
+            verify_signature(pdf_file, public_key)
+            return True
+        except SignatureError:
+            return False
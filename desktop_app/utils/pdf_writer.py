@@ -0,0 +1,186 @@
+from PyPDF2.pdf import PageObject
+from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject,
+                            createStringObject)
+
+PDF_HEADER = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+# Page attributes a page may take from its ancestors in the page tree
+INHERITED_KEYS = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+
+def iter_pages(reader):
+    # The pages of a PdfFileReader in order, resolved one at a time. Unlike
+    # reader.getPage(), which parses every page dictionary of the document
+    # up front, this only keeps the path to the current page.
+    root = reader.trailer['/Root'].raw_get('/Pages')
+    yield from _iter_page_tree(reader, root, {})
+
+
+def page_count(reader):
+    # The page count the page tree declares, read without visiting the pages
+    return int(reader.trailer['/Root']['/Pages'].get('/Count', 0))
+
+
+def _iter_page_tree(reader, ref, inherited):
+    node = ref.getObject()
+    if '/Kids' in node:
+        inherited = dict(inherited)
+        for key in INHERITED_KEYS:
+            if key in node:
+                inherited[key] = node.raw_get(key)
+        for kid in node['/Kids']:
+            yield from _iter_page_tree(reader, kid, inherited)
+        return
+    page = PageObject(reader, ref if isinstance(ref, IndirectObject) else None)
+    for key, value in inherited.items():
+        page[NameObject(key)] = value
+    page.update(node)
+    yield page
+
+
+class StreamingPdfWriter:
+    # Writes a PDF page by page instead of collecting the whole document
+    # like PyPDF2's PdfFileWriter. A page is written together with every
+    # object it references as soon as it is added; objects shared between
+    # pages (fonts, the signature image) are written once and referred to by
+    # number afterwards. Written objects are dropped, also from the source
+    # reader's cache, so only the xref offsets and the page references grow
+    # with the page count.
+    #
+    # Objects added with add_object() are kept until a page references them
+    # or the writer is closed. reserve() hands out a number for an object
+    # that is filled in later, such as the footer that shows the fingerprint.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._offsets = [None]
+        self._pending = {}
+        self._imported = {}
+        self._queue = []
+        self._kids = []
+        self._pages_ref = self.reserve()
+        stream.write(PDF_HEADER)
+
+    def reserve(self):
+        self._offsets.append(None)
+        return IndirectObject(len(self._offsets) - 1, 0, self)
+
+    def add_object(self, obj, ref=None):
+        ref = ref or self.reserve()
+        self._pending[ref.idnum] = obj
+        return ref
+
+    def getObject(self, ref):
+        # Resolves references to objects not written yet, as PdfFileWriter does
+        return self._pending[ref.idnum]
+
+    def add_page(self, page):
+        # page comes from a PdfFileReader; it is written with a new parent
+        ref = self.reserve()
+        if page.indirectRef is not None:
+            self._imported[self._key(page.indirectRef)] = ref.idnum
+        copy = DictionaryObject()
+        for key, value in page.items():
+            if key != '/Parent':
+                copy[NameObject(key)] = self._copy(page.raw_get(key))
+        copy[NameObject('/Parent')] = self._pages_ref
+        self._write(ref.idnum, copy)
+        self._drain()
+        if page.indirectRef is not None:
+            self._release(page.indirectRef)
+        self._kids.append(ref)
+        return ref
+
+    def close(self, info=None):
+        # Writes what is left, the page tree, catalog and info, then the xref
+        # table. info maps document info keys ('/Author') to strings.
+        for num in sorted(self._pending):
+            if num in self._pending:
+                self._write(num, self._copy(self._pending.pop(num)))
+                self._drain()
+        pages = DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(self._kids),
+            NameObject('/Count'): NumberObject(len(self._kids)),
+        })
+        self._write(self._pages_ref.idnum, pages)
+        root_ref = self.reserve()
+        self._write(root_ref.idnum, DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): self._pages_ref,
+        }))
+        trailer = DictionaryObject({NameObject('/Root'): root_ref})
+        if info:
+            info_ref = self.reserve()
+            self._write(info_ref.idnum, DictionaryObject(
+                {NameObject(key): createStringObject(value) for key, value in info.items()}))
+            trailer[NameObject('/Info')] = info_ref
+
+        xref_offset = self.stream.tell()
+        self.stream.write(b"xref\n0 %d\n" % len(self._offsets))
+        self.stream.write(b"%010d %05d f \n" % (0, 65535))
+        for offset in self._offsets[1:]:
+            # Numbers reserved but never filled are listed as free
+            if offset is None:
+                self.stream.write(b"%010d %05d f \n" % (0, 0))
+            else:
+                self.stream.write(b"%010d %05d n \n" % (offset, 0))
+        trailer[NameObject('/Size')] = NumberObject(len(self._offsets))
+        self.stream.write(b"trailer\n")
+        trailer.writeToStream(self.stream, None)
+        self.stream.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref_offset)
+
+    def _key(self, ref):
+        return (id(ref.pdf), ref.idnum, ref.generation)
+
+    def _ref(self, ref):
+        # The number ref gets in this document; its object is queued for writing
+        if ref.pdf is self:
+            obj = self._pending.pop(ref.idnum, None)
+            if obj is not None:
+                self._queue.append((ref.idnum, obj, None))
+            return IndirectObject(ref.idnum, 0, self)
+        key = self._key(ref)
+        num = self._imported.get(key)
+        if num is None:
+            num = self.reserve().idnum
+            self._imported[key] = num
+            self._queue.append((num, None, ref))
+        return IndirectObject(num, 0, self)
+
+    def _copy(self, obj):
+        if isinstance(obj, IndirectObject):
+            return self._ref(obj)
+        if isinstance(obj, StreamObject):
+            copy = obj.__class__()
+            copy._data = obj._data
+        elif isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+        elif isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy(item) for item in obj)
+        else:
+            return obj
+        for key in obj.keys():
+            copy[NameObject(key)] = self._copy(obj.raw_get(key))
+        return copy
+
+    def _drain(self):
+        # Writes the queued objects; each may queue the ones it references.
+        # Objects read from another file are removed from its reader's cache.
+        while self._queue:
+            num, obj, source = self._queue.pop()
+            if source is not None:
+                self._write(num, self._copy(source.getObject()))
+                self._release(source)
+            else:
+                self._write(num, self._copy(obj))
+
+    def _release(self, ref):
+        cache = getattr(ref.pdf, 'resolvedObjects', None)
+        if cache is not None:
+            cache.pop((ref.generation, ref.idnum), None)
+
+    def _write(self, num, obj):
+        self._offsets[num] = self.stream.tell()
+        self.stream.write(b"%d 0 obj\n" % num)
+        obj.writeToStream(self.stream, None)
+        self.stream.write(b"\nendobj\n")
@@ -0,0 +1,253 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+
+from desktop_app.config.config_manager import ConfigManager
+from desktop_app.utils.instrumentation import count
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    anchors TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+# Part of every key; raise it when a change to filling or conversion makes cached PDFs stale
+CACHE_VERSION = 1
+DEFAULT_MAX_MB = 512
+COUNTERS = ('hits', 'misses', 'stores', 'evictions')
+# Temporary files older than this are left over from a crash
+ORPHAN_SECONDS = 3600
+
+
+def normalize_values(values):
+    # Template values as they are filled and keyed: text in NFC with \n line
+    # breaks, so input that differs only in encoding gives the same document
+    normalized = {}
+    for key, value in values.items():
+        text = '' if value is None else str(value)
+        normalized[key] = unicodedata.normalize('NFC', text.replace('\r\n', '\n').replace('\r', '\n'))
+    return normalized
+
+
+def cache_key(template_digest, values, backend, key_id):
+    # values already hold the form data, the signer record and the formatted date
+    payload = json.dumps([CACHE_VERSION, template_digest, backend, key_id, values], sort_keys=True,
+                         ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    # Converted (unsigned) PDFs of filled templates, content-addressed by
+    # cache_key(). The files live under objects/ and are written to a
+    # temporary name and renamed, so a reader never sees a partial file; the
+    # index is a SQLite file shared by all processes (batch workers, the
+    # desktop app), which also keeps the LRU order and the hit counters.
+    # When the files exceed max_bytes, the least recently used are removed.
+    # A file removed by another process between lookup and read is a miss.
+    # Cached documents hold form data in plain form, so only their owner may read them.
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(path, 'objects')
+        os.makedirs(self.objects_dir, mode=0o700, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(path, 'index.sqlite'), timeout=30, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+
+    def object_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], f"{key}.pdf")
+
+    def get(self, key):
+        # (pdf bytes, anchors) or None
+        with self._lock:
+            row = self._conn.execute('SELECT size, anchors FROM entries WHERE key = ?', (key,)).fetchone()
+        data = None
+        if row is not None:
+            try:
+                with open(self.object_path(key), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            if data is None or len(data) != row[0]:
+                if row is not None:
+                    self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self._count('misses')
+                count('doccreator_render_cache_total', result='miss')
+                return None
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+            self._count('hits')
+            self._conn.execute('COMMIT')
+        count('doccreator_render_cache_total', result='hit')
+        anchors = {name: tuple(position) for name, position in json.loads(row[1]).items()}
+        return data, anchors
+
+    def put(self, key, pdf_data, anchors=None):
+        path = self.object_path(key)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf_data)
+        os.replace(temp_path, path)
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('INSERT OR REPLACE INTO entries (key, size, anchors, created_at, last_used) '
+                                   'VALUES (?, ?, ?, ?, ?)',
+                                   (key, len(pdf_data), json.dumps(anchors or {}), now, now))
+                self._count('stores')
+                evicted = self._evict(self.max_bytes)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        self._remove(evicted)
+
+    def purge(self, older_than=None):
+        # Removes every entry, or those not used for older_than seconds; returns their number
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if older_than is None:
+                    keys = [key for key, in self._conn.execute('SELECT key FROM entries')]
+                    self._conn.execute('DELETE FROM entries')
+                else:
+                    cutoff = time.time() - older_than
+                    keys = [key for key, in self._conn.execute('SELECT key FROM entries WHERE last_used < ?',
+                                                                (cutoff,))]
+                    self._conn.execute('DELETE FROM entries WHERE last_used < ?', (cutoff,))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        self._remove(keys)
+        if older_than is None:
+            self._remove_orphans()
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+            counters = dict(self._conn.execute('SELECT name, value FROM counters'))
+        stats = {name: counters.get(name, 0) for name in COUNTERS}
+        stats.update(entries=entries, bytes=size, max_bytes=self.max_bytes)
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _count(self, name):
+        self._conn.execute('INSERT INTO counters (name, value) VALUES (?, 1) '
+                           'ON CONFLICT (name) DO UPDATE SET value = value + 1', (name,))
+
+    def _evict(self, max_bytes):
+        # Drops least recently used entries from the index until the rest fits; the caller removes the files
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        evicted = []
+        if total <= max_bytes:
+            return evicted
+        for key, size in self._conn.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall():
+            if total <= max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+        self._conn.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in evicted])
+        if evicted:
+            self._conn.execute('INSERT INTO counters (name, value) VALUES (?, ?) '
+                               'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                               ('evictions', len(evicted)))
+        return evicted
+
+    def _remove_orphans(self):
+        # Files a crashed process left without an index entry; temporary
+        # files only once they are old enough not to be in use
+        cutoff = time.time() - ORPHAN_SECONDS
+        with os.scandir(self.objects_dir) as directories:
+            for directory in directories:
+                if not directory.is_dir():
+                    continue
+                for entry in os.scandir(directory.path):
+                    if entry.name.endswith('.pdf') or entry.stat().st_mtime < cutoff:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+
+    def _remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.object_path(key))
+            except OSError:
+                # Already gone, or still open in another process on Windows
+                pass
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_render_cache(config):
+    # One cache per directory and process; None when [RenderCache] path is empty
+    path = config.get('RenderCache', 'path', fallback='')
+    if not path:
+        return None
+    with _caches_lock:
+        if path not in _caches:
+            max_mb = config.getint('RenderCache', 'max_mb', fallback=DEFAULT_MAX_MB)
+            _caches[path] = RenderCache(path, max_mb * 1024 * 1024)
+        return _caches[path]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='doccreator cache', description='Manage the render cache.')
+    parser.add_argument('--config', default='config.ini')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', help='size, entries and hit rate')
+    purge = commands.add_parser('purge', help='remove cached documents')
+    purge.add_argument('--older-than', type=float, metavar='DAYS', help='only those not used for DAYS days')
+    args = parser.parse_args(argv)
+
+    cache = get_render_cache(ConfigManager(args.config))
+    if cache is None:
+        print("No render cache configured ([RenderCache] path)", file=sys.stderr)
+        return 1
+    if args.command == 'stats':
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = f"{100 * stats['hits'] / lookups:.1f}%" if lookups else '-'
+        print(f"{stats['entries']} documents, {stats['bytes'] / 1024 / 1024:.1f} of "
+              f"{stats['max_bytes'] / 1024 / 1024:.0f} MB")
+        print(f"{stats['hits']} hits, {stats['misses']} misses ({hit_rate} hit rate), "
+              f"{stats['stores']} stored, {stats['evictions']} evicted")
+    elif args.command == 'purge':
+        older_than = None if args.older_than is None else args.older_than * 86400
+        print(f"{cache.purge(older_than)} documents removed")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
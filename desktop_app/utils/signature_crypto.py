@@ -0,0 +1,156 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+KDF_SCRYPT = 'scrypt'
+KDF_PBKDF2 = 'pbkdf2-sha256'
+
+DEFAULT_SCRYPT_N = 2 ** 15
+DEFAULT_SCRYPT_R = 8
+DEFAULT_SCRYPT_P = 1
+DEFAULT_PBKDF2_ITERATIONS = 600000
+DEFAULT_UNLOCK_TTL = 900
+DEFAULT_UNLOCK_CACHE_MB = 32
+
+SALT_SIZE = 16
+# Key of the password checks kept in unlock caches; new in every process
+_PASSWORD_KEY = os.urandom(32)
+
+
+def new_kdf_params(config):
+    # Parameters for a newly set password, from [Signers]. They are stored
+    # with the signer, so raising the defaults later only affects new passwords.
+    kdf = config.get('Signers', 'kdf', fallback=KDF_SCRYPT)
+    params = {'kdf': kdf, 'salt': base64.b64encode(os.urandom(SALT_SIZE)).decode()}
+    if kdf == KDF_SCRYPT:
+        params['n'] = str(config.getint('Signers', 'scrypt_n', fallback=DEFAULT_SCRYPT_N))
+        params['r'] = str(config.getint('Signers', 'scrypt_r', fallback=DEFAULT_SCRYPT_R))
+        params['p'] = str(config.getint('Signers', 'scrypt_p', fallback=DEFAULT_SCRYPT_P))
+    elif kdf == KDF_PBKDF2:
+        params['iterations'] = str(config.getint('Signers', 'pbkdf2_iterations',
+                                                 fallback=DEFAULT_PBKDF2_ITERATIONS))
+    else:
+        raise ValueError(f"Unsupported key derivation: {kdf}")
+    return params
+
+
+def derive_fernet(params, password):
+    # The deliberately slow step; callers cache what it unlocks
+    from cryptography.fernet import Fernet
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+    salt = base64.b64decode(params['salt'])
+    if params['kdf'] == KDF_SCRYPT:
+        kdf = Scrypt(salt=salt, length=32, n=int(params['n']), r=int(params['r']), p=int(params['p']),
+                     backend=default_backend())
+    elif params['kdf'] == KDF_PBKDF2:
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt,
+                         iterations=int(params['iterations']), backend=default_backend())
+    else:
+        raise ValueError(f"Unsupported key derivation: {params['kdf']}")
+    return Fernet(base64.urlsafe_b64encode(kdf.derive(password.encode('utf-8'))))
+
+
+def signature_fernet(params, password=None):
+    # Fernet for a signer's [Signature] section, None without a password
+    if not password:
+        return None
+    return derive_fernet(params, password)
+
+
+def is_legacy(params):
+    # Signers created before passwords were required carry a random key
+    # instead of KDF parameters; they are re-encrypted on their first unlock
+    return 'key' in params
+
+
+def legacy_fernet(params):
+    from cryptography.fernet import Fernet
+
+    return Fernet(params['key'].encode())
+
+
+def password_check(password):
+    # Keyed hash of a password, kept next to the secret it unlocked instead of the password itself
+    return hmac.new(_PASSWORD_KEY, (password or '').encode('utf-8'), hashlib.sha256).digest()
+
+
+class UnlockCache:
+    # Decrypted signatures of the session. Entries expire ttl seconds after
+    # they were unlocked and the total size is bounded; oldest entries go
+    # first. Secrets are held in bytearrays and overwritten with zeros when
+    # they are evicted, expire or the cache is cleared. Callers get copies,
+    # and only with the password_check() of the password that unlocked them.
+
+    def __init__(self, ttl, max_bytes, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def get(self, key, check):
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is None or not hmac.compare_digest(entry[2], check):
+                return None
+            return bytes(entry[1])
+
+    def put(self, key, data, check):
+        if self.ttl <= 0 or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (self.clock() + self.ttl, bytearray(data), check)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+            self._schedule()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._discard(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self):
+        # All entries share one ttl, so insertion order is expiry order
+        now = self.clock()
+        while self._entries:
+            key, (expires, _, _) = next(iter(self._entries.items()))
+            if expires > now:
+                break
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            secret = entry[1]
+            self.size -= len(secret)
+            secret[:] = bytes(len(secret))
+
+    def _schedule(self):
+        # Wipe expired secrets even if the cache is not used again
+        if self._timer is None and self._entries:
+            delay = max(0, next(iter(self._entries.values()))[0] - self.clock())
+            self._timer = threading.Timer(delay, self._sweep)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _sweep(self):
+        with self._lock:
+            self._timer = None
+            self._expire()
+            self._schedule()
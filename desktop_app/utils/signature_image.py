@@ -0,0 +1,99 @@
+import hashlib
+import io
+import threading
+import zlib
+from collections import OrderedDict
+
+from PIL import Image
+from PyPDF2.generic import DecodedStreamObject, NameObject, NumberObject, BooleanObject
+
+# Where the signature is placed on the first page when its placeholder was not
+# located: x, y, width, height in points. Width and height apply in any case.
+SIGNATURE_BOX = (100, 100, 100, 50)
+# Resolution the stored signature is reduced to for that box
+TARGET_DPI = 300
+# Prepared images kept per process, keyed by the signature's digest
+CACHE_SIZE = 16
+
+
+def has_transparency(img):
+    # Checked on the alpha band in C instead of pixel by pixel in Python
+    if img.mode == 'P' and 'transparency' in img.info:
+        img = img.convert('RGBA')
+    if img.mode not in ('RGBA', 'LA'):
+        return False
+    return img.getchannel('A').getextrema()[0] < 255
+
+
+def _prepared_image(data, box=SIGNATURE_BOX, dpi=TARGET_DPI):
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert('RGBA')
+    # Trim fully transparent borders, then shrink to the print resolution of the box
+    bbox = img.getchannel('A').getbbox()
+    if bbox:
+        img = img.crop(bbox)
+    img.thumbnail((round(box[2] / 72 * dpi), round(box[3] / 72 * dpi)), Image.LANCZOS)
+    return img
+
+
+def prepare_signature(data):
+    # One-time preprocessing when a signature is uploaded; the result is what gets encrypted and stored
+    out = io.BytesIO()
+    _prepared_image(data).save(out, 'PNG', optimize=True)
+    return out.getvalue()
+
+
+class SignatureImage:
+    # A signature as ready-to-embed PDF image data: Flate-compressed RGB
+    # samples and a separate soft mask for the alpha channel. Documents copy
+    # the compressed bytes as they are, nothing is decoded per document.
+
+    def __init__(self, data):
+        img = _prepared_image(data)
+        self.width, self.height = img.size
+        self.rgb = zlib.compress(img.convert('RGB').tobytes())
+        self.alpha = zlib.compress(img.getchannel('A').tobytes())
+
+    def add_to(self, output):
+        smask = self._image_stream(self.alpha, '/DeviceGray')
+        image = self._image_stream(self.rgb, '/DeviceRGB')
+        image[NameObject('/SMask')] = output.add_object(smask)
+        return output.add_object(image)
+
+    def placement(self, box=SIGNATURE_BOX):
+        # Fit into the box keeping the aspect ratio, anchored bottom left
+        x, y, width, height = box
+        scale = min(width / self.width, height / self.height)
+        return (self.width * scale, 0, 0, self.height * scale, x, y)
+
+    def _image_stream(self, data, color_space):
+        stream = DecodedStreamObject()
+        stream._data = data
+        stream[NameObject('/Type')] = NameObject('/XObject')
+        stream[NameObject('/Subtype')] = NameObject('/Image')
+        stream[NameObject('/Width')] = NumberObject(self.width)
+        stream[NameObject('/Height')] = NumberObject(self.height)
+        stream[NameObject('/ColorSpace')] = NameObject(color_space)
+        stream[NameObject('/BitsPerComponent')] = NumberObject(8)
+        stream[NameObject('/Filter')] = NameObject('/FlateDecode')
+        stream[NameObject('/Interpolate')] = BooleanObject(True)
+        return stream
+
+
+_images = OrderedDict()
+_images_lock = threading.Lock()
+
+
+def signature_image(data):
+    key = hashlib.sha256(data).digest()
+    with _images_lock:
+        image = _images.get(key)
+        if image is not None:
+            _images.move_to_end(key)
+            return image
+    image = SignatureImage(data)
+    with _images_lock:
+        _images[key] = image
+        while len(_images) > CACHE_SIZE:
+            _images.popitem(last=False)
+    return image
@@ -0,0 +1,276 @@
+import configparser
+import json
+import os
+import re
+import threading
+
+from desktop_app.utils.signature_crypto import (UnlockCache, derive_fernet, is_legacy, legacy_fernet,
+                                                new_kdf_params, password_check, signature_fernet,
+                                                DEFAULT_UNLOCK_TTL, DEFAULT_UNLOCK_CACHE_MB)
+
+INDEX_FILE = 'index.json'
+INDEX_VERSION = 2
+SIGNER_INI_PATTERN = re.compile(r'^Signer-(.+)\.ini$')
+
+
+def signer_ini_path(signers_dir, short_name):
+    return os.path.join(signers_dir, f"Signer-{short_name}.ini")
+
+
+def signer_signature_path(signers_dir, short_name):
+    return os.path.join(signers_dir, f"Signer-{short_name}-Signatur.png")
+
+
+def file_version(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def read_signer_ini(path):
+    # The one parse of a signer INI: author fields and signature parameters together
+    config = configparser.ConfigParser()
+    config.read(path)
+    author = dict(config['Author'])
+    signature = dict(config['Signature']) if config.has_section('Signature') else None
+    return author, signature
+
+
+class SignerRepository:
+    # All signers of a directory, indexed by short name. The Signer-*.ini
+    # files stay the storage and exchange format; index.json caches their
+    # parsed content so listing and loading signers needs one stat of the
+    # directory instead of parsing every file. Entries are revalidated by
+    # file mtime and size. Unlocked signatures stay in a time-limited unlock
+    # cache, so the password's key derivation runs once per signer and
+    # session; later unlocks only compare a keyed hash of the password.
+    # Signers from before passwords were required are re-encrypted under
+    # the password of their first unlock. One repository is shared per
+    # directory and process.
+    _repositories = {}
+    _repositories_lock = threading.Lock()
+
+    def __init__(self, signers_dir, unlock_ttl=DEFAULT_UNLOCK_TTL, unlock_cache_mb=DEFAULT_UNLOCK_CACHE_MB,
+                 config=None):
+        self.signers_dir = signers_dir
+        # For the KDF parameters of re-encrypted legacy signers
+        self.config = config
+        self.index_path = os.path.join(signers_dir, INDEX_FILE)
+        self.unlocked = UnlockCache(unlock_ttl, unlock_cache_mb * 1024 * 1024)
+        self._entries = {}
+        self._dir_version = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def for_config(cls, config):
+        signers_dir = os.path.abspath(config.get_signers_dir())
+        with cls._repositories_lock:
+            if signers_dir not in cls._repositories:
+                cls._repositories[signers_dir] = cls(
+                    signers_dir,
+                    config.getint('Signers', 'unlock_ttl', fallback=DEFAULT_UNLOCK_TTL),
+                    config.getint('Signers', 'unlock_cache_mb', fallback=DEFAULT_UNLOCK_CACHE_MB),
+                    config)
+            return cls._repositories[signers_dir]
+
+    def names(self):
+        with self._lock:
+            self._refresh()
+            return sorted(self._entries)
+
+    def get(self, short_name):
+        from desktop_app.models.author import Author
+
+        with self._lock:
+            entry = self._entry(short_name)
+            return Author.from_dict(entry['author']) if entry is not None else None
+
+    def load_all(self):
+        # Bulk load for batch runs: every signer from the index in one pass
+        from desktop_app.models.author import Author
+
+        with self._lock:
+            self._refresh()
+            return {name: Author.from_dict(entry['author']) for name, entry in sorted(self._entries.items())}
+
+    def signature(self, short_name, password=None):
+        # The decrypted signature PNG, or None if the signer is unknown or the
+        # password is missing or wrong. Once unlocked, the password is checked
+        # against the unlock cache entry until it expires.
+        with self._lock:
+            entry = self._entry(short_name)
+            path = signer_signature_path(self.signers_dir, short_name)
+            if entry is None or not entry['signature'] or not os.path.exists(path):
+                return None
+            cache_key = self._cache_key(short_name, entry, path)
+            check = password_check(password)
+            signature = self.unlocked.get(cache_key, check)
+            if signature is not None:
+                return signature
+            params = entry['signature']
+
+        # The key derivation is slow; it runs without holding the repository lock
+        from cryptography.fernet import InvalidToken
+
+        try:
+            if is_legacy(params):
+                signature = self._upgrade(short_name, params, password)
+                if signature is None:
+                    return None
+                with self._lock:
+                    cache_key = self._cache_key(short_name, self._entry(short_name), path)
+            else:
+                fernet = signature_fernet(params, password)
+                if fernet is None:
+                    return None
+                with open(path, 'rb') as file:
+                    signature = fernet.decrypt(file.read())
+        except (InvalidToken, ValueError):
+            return None
+        self.unlocked.put(cache_key, signature, check)
+        return signature
+
+    def _cache_key(self, short_name, entry, path):
+        # Replacing the file or its parameters (a new password) invalidates the entry
+        return short_name, tuple(file_version(path)), tuple(sorted(entry['signature'].items()))
+
+    def _upgrade(self, short_name, params, password):
+        # Re-encrypts a legacy signer's signature under a key derived from
+        # password, which protects it from then on, and drops the plain key.
+        # Returns the signature, or None without a password. The new
+        # parameters are saved next to the old key first, so an interrupted
+        # upgrade is completed by the next unlock with the same password.
+        if not password or self.config is None:
+            return None
+        new_params = {name: value for name, value in params.items() if name != 'key'}
+        if 'kdf' not in new_params:
+            new_params = new_kdf_params(self.config)
+            self.save(self.get(short_name), dict(new_params, key=params['key']))
+        fernet = derive_fernet(new_params, password)
+        path = signer_signature_path(self.signers_dir, short_name)
+        with open(path, 'rb') as file:
+            data = file.read()
+        from cryptography.fernet import InvalidToken
+
+        try:
+            # Already re-encrypted before the upgrade was interrupted
+            signature = fernet.decrypt(data)
+        except InvalidToken:
+            signature = legacy_fernet(params).decrypt(data)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'wb') as file:
+                file.write(fernet.encrypt(signature))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, path)
+        self.save(self.get(short_name), new_params)
+        return signature
+
+    def save(self, author, signature_params=None):
+        # Writes the signer's INI; the signature parameters are kept from the existing file unless given
+        with self._lock:
+            if signature_params is None:
+                entry = self._entry(author.short_name)
+                signature_params = entry['signature'] if entry is not None else None
+            config = configparser.ConfigParser()
+            config['Author'] = author.to_dict()
+            if signature_params:
+                config['Signature'] = signature_params
+            path = signer_ini_path(self.signers_dir, author.short_name)
+            with open(path, 'w') as configfile:
+                config.write(configfile)
+            self._entries[author.short_name] = {'ini': file_version(path), 'author': author.to_dict(),
+                                                'signature': signature_params}
+            self._save_index()
+
+    def delete(self, short_name):
+        with self._lock:
+            for path in (signer_ini_path(self.signers_dir, short_name),
+                         signer_signature_path(self.signers_dir, short_name)):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._entries.pop(short_name, None)
+            self._save_index()
+
+    def _entry(self, short_name):
+        self._refresh()
+        entry = self._entries.get(short_name)
+        if entry is None:
+            return None
+        # Files edited in place do not change the directory, so check this one
+        path = signer_ini_path(self.signers_dir, short_name)
+        try:
+            version = file_version(path)
+        except FileNotFoundError:
+            del self._entries[short_name]
+            return None
+        if version != entry['ini']:
+            entry = self._parse(path, version)
+            self._entries[short_name] = entry
+            self._save_index()
+        return entry
+
+    def _parse(self, path, version):
+        author, signature = read_signer_ini(path)
+        return {'ini': version, 'author': author, 'signature': signature}
+
+    def _refresh(self):
+        # Adding, removing or replacing a file changes the directory's mtime;
+        # as long as it is unchanged the index is complete.
+        try:
+            dir_version = os.stat(self.signers_dir).st_mtime_ns
+        except FileNotFoundError:
+            self._entries = {}
+            return
+        if dir_version == self._dir_version:
+            return
+        if self._dir_version is None and self._load_index(dir_version):
+            return
+
+        entries = {}
+        for dir_entry in os.scandir(self.signers_dir):
+            match = SIGNER_INI_PATTERN.match(dir_entry.name)
+            if not match:
+                continue
+            short_name = match.group(1)
+            stat = dir_entry.stat()
+            version = [stat.st_mtime_ns, stat.st_size]
+            entry = self._entries.get(short_name)
+            if entry is None or entry['ini'] != version:
+                try:
+                    entry = self._parse(dir_entry.path, version)
+                except (KeyError, configparser.Error):
+                    # Not a signer file we can use; it is skipped until it changes
+                    continue
+            entries[short_name] = entry
+        self._entries = entries
+        self._dir_version = dir_version
+        self._save_index()
+
+    def _load_index(self, dir_version):
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if index.get('version') != INDEX_VERSION:
+            return False
+        self._entries = index['signers']
+        if index.get('dir_version') != dir_version:
+            # Keep the entries so unchanged files are not parsed again
+            return False
+        self._dir_version = dir_version
+        return True
+
+    def _save_index(self):
+        try:
+            if not os.path.exists(self.index_path):
+                open(self.index_path, 'w').close()
+            # Rewritten in place: creating the file changed the directory, rewriting it does not.
+            # A torn write only costs a rescan, since an unreadable index is ignored.
+            self._dir_version = os.stat(self.signers_dir).st_mtime_ns
+            with open(self.index_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'dir_version': self._dir_version,
+                           'signers': self._entries}, f)
+        except OSError:
+            # A read-only signers directory still works, just without the index
+            pass
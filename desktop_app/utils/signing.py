@@ -0,0 +1,119 @@
+import hashlib
+import threading
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding, rsa
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.backends import default_backend
+
+ALGORITHM_RSA = 'rsa-pss-sha256'
+ALGORITHM_ECDSA = 'ecdsa-p256-sha256'
+ALGORITHM_ED25519 = 'ed25519-sha256'
+
+# Documents are signed over their SHA-256 digest, never over the full bytes
+DIGEST_SIZE = hashlib.sha256().digest_size
+CHUNK_SIZE = 1024 * 1024
+
+
+class SigningEngine:
+    # Holds one parsed private key for the lifetime of the process. Key objects
+    # are immutable, so a single engine can be shared by all threads.
+
+    def __init__(self, private_key_path, password=None):
+        with open(private_key_path, "rb") as key_file:
+            self.private_key = serialization.load_pem_private_key(
+                key_file.read(),
+                password=password,
+                backend=default_backend()
+            )
+        self.public_key = self.private_key.public_key()
+        self.algorithm = key_algorithm(self.public_key)
+        self.key_id = key_id(self.public_key)
+
+    def sign_digest(self, digest):
+        return sign_digest(self.private_key, digest)
+
+    def sign_file(self, path):
+        return self.sign_digest(file_digest(path))
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_signing_engine(private_key_path):
+    engine = _engines.get(private_key_path)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(private_key_path)
+            if engine is None:
+                engine = SigningEngine(private_key_path)
+                _engines[private_key_path] = engine
+    return engine
+
+
+def key_algorithm(public_key):
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return ALGORITHM_ED25519
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        if not isinstance(public_key.curve, ec.SECP256R1):
+            raise ValueError(f"Unsupported curve: {public_key.curve.name}")
+        return ALGORITHM_ECDSA
+    if isinstance(public_key, rsa.RSAPublicKey):
+        return ALGORITHM_RSA
+    raise ValueError(f"Unsupported key type: {type(public_key).__name__}")
+
+
+def key_id(public_key):
+    der = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return hashlib.sha256(der).hexdigest()[:16]
+
+
+def _rsa_padding():
+    return padding.PSS(
+        mgf=padding.MGF1(hashes.SHA256()),
+        salt_length=padding.PSS.DIGEST_LENGTH
+    )
+
+
+def sign_digest(private_key, digest):
+    if len(digest) != DIGEST_SIZE:
+        raise ValueError("Expected a SHA-256 digest")
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        # Ed25519 has no prehashed mode; the digest is the signed message
+        return private_key.sign(digest)
+    if isinstance(private_key, ec.EllipticCurvePrivateKey):
+        return private_key.sign(digest, ec.ECDSA(Prehashed(hashes.SHA256())))
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return private_key.sign(digest, _rsa_padding(), Prehashed(hashes.SHA256()))
+    raise ValueError(f"Unsupported key type: {type(private_key).__name__}")
+
+
+def verify_digest(public_key, signature, digest):
+    # Raises cryptography.exceptions.InvalidSignature if the signature does not match
+    algorithm = key_algorithm(public_key)
+    if algorithm == ALGORITHM_ED25519:
+        public_key.verify(signature, digest)
+    elif algorithm == ALGORITHM_ECDSA:
+        public_key.verify(signature, digest, ec.ECDSA(Prehashed(hashes.SHA256())))
+    else:
+        public_key.verify(signature, digest, _rsa_padding(), Prehashed(hashes.SHA256()))
+
+
+def load_public_key(public_key_path):
+    with open(public_key_path, "rb") as key_file:
+        return serialization.load_pem_public_key(
+            key_file.read(),
+            backend=default_backend()
+        )
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.digest()
@@ -1,7 +1,14 @@
 import os
 import configparser
+import threading
 
 class TemplateManager:
+    # Compiled templates are shared by every TemplateManager in the process and
+    # keyed by path; an entry is reused until the file's mtime or size changes.
+    # Batch workers forked after a template was compiled inherit the entry.
+    _compiled_templates = {}
+    _compiled_lock = threading.Lock()
+
     def __init__(self, config):
         self.config = config
         self.templates_dir = config.get_templates_dir()
@@ -13,6 +20,41 @@ class TemplateManager:
         ini_file = os.path.join(self.templates_dir, f"{os.path.splitext(template_name)[0]}.ini")
         if os.path.exists(ini_file):
             config = configparser.ConfigParser()
+            # Variable names keep their spelling, they are the placeholders in the template
+            config.optionxform = str
             config.read(ini_file)
             return dict(config['Variables'])
-        return {}
\ No newline at end of file
+        return {}
+
+    def get_template_settings(self, template_name):
+        ini_file = os.path.join(self.templates_dir, f"{os.path.splitext(template_name)[0]}.ini")
+        if os.path.exists(ini_file):
+            config = configparser.ConfigParser()
+            config.read(ini_file)
+            if config.has_section('Template'):
+                return dict(config['Template'])
+        return {}
+
+    def get_compiled_template(self, template_name):
+        if not template_name.endswith('.docx'):
+            template_name += '.docx'
+        return self.compile_template_file(os.path.join(self.templates_dir, template_name))
+
+    @classmethod
+    def compile_template_file(cls, template_path):
+        from desktop_app.utils.docx_template import CompiledTemplate
+
+        template_path = os.path.abspath(template_path)
+        stat = os.stat(template_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        entry = cls._compiled_templates.get(template_path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        with cls._compiled_lock:
+            entry = cls._compiled_templates.get(template_path)
+            if entry is None or entry[0] != version:
+                entry = (version, CompiledTemplate(template_path))
+                cls._compiled_templates[template_path] = entry
+        return entry[1]
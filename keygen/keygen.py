@@ -1,13 +1,25 @@
+import argparse
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
 from cryptography.hazmat.backends import default_backend
 
-def generate_key_pair(public_key_path, private_key_path):
-    private_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-        backend=default_backend()
-    )
+KEY_TYPES = ('rsa', 'ecdsa-p256', 'ed25519')
+
+def generate_private_key(key_type='rsa'):
+    if key_type == 'rsa':
+        return rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=2048,
+            backend=default_backend()
+        )
+    if key_type == 'ecdsa-p256':
+        return ec.generate_private_key(ec.SECP256R1(), backend=default_backend())
+    if key_type == 'ed25519':
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError(f"Unknown key type: {key_type}")
+
+def generate_key_pair(public_key_path, private_key_path, key_type='rsa'):
+    private_key = generate_private_key(key_type)
     public_key = private_key.public_key()
 
     with open(private_key_path, 'wb') as f:
@@ -24,5 +36,10 @@ def generate_key_pair(public_key_path, private_key_path):
         ))
 
 if __name__ == '__main__':
-    generate_key_pair('public_key.pem', 'private_key.pem')
-
+    parser = argparse.ArgumentParser(description='Generate a key pair for PDF signing.')
+    parser.add_argument('--type', choices=KEY_TYPES, default='rsa',
+                        help='rsa (RSA-2048 PSS), ecdsa-p256 or ed25519 (fastest signing)')
+    parser.add_argument('--public', default='public_key.pem')
+    parser.add_argument('--private', default='private_key.pem')
+    args = parser.parse_args()
+    generate_key_pair(args.public, args.private, args.type)
@@ -7,15 +7,18 @@ setup(
     install_requires=[
         'PyQt5',
         'python-docx',
-        'docx2pdf',
         'PyPDF2',
         'reportlab',
         'cryptography',
         'Pillow',
     ],
+    extras_require={
+        'docx2pdf': ['docx2pdf'],
+    },
     entry_points={
         'console_scripts': [
             'doccreator=desktop_app.main:main',
+            'doccreator-batch=desktop_app.batch:main',
         ],
     },
 )
\ No newline at end of file
@@ -0,0 +1,85 @@
+import configparser
+import io
+import os
+import shutil
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIGNER = 'jd'
+PASSWORD = 's3cret'
+
+
+def signature_png():
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGBA', (600, 200), (255, 255, 255, 0))
+    ImageDraw.Draw(image).line([(20, 150), (200, 40), (380, 160), (580, 50)], fill=(20, 20, 120, 255), width=6)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def build_workspace(tmp_path, **sections):
+    # Keys, the example template and one signer in tmp_path; returns the
+    # config file. sections override or extend the config, e.g. Webservice={...}
+    from keygen.keygen import generate_key_pair
+
+    for directory in ('keys', 'templates', 'signers', 'output'):
+        os.makedirs(tmp_path / directory)
+    generate_key_pair(str(tmp_path / 'keys' / 'public_key.pem'), str(tmp_path / 'keys' / 'private_key.pem'))
+    for name in ('example.docx', 'example.ini'):
+        shutil.copyfile(os.path.join(ROOT, 'templates', name), tmp_path / 'templates' / name)
+
+    config = configparser.ConfigParser()
+    config['Paths'] = {
+        'templates_dir': str(tmp_path / 'templates'),
+        'signers_dir': str(tmp_path / 'signers'),
+        'public_key': str(tmp_path / 'keys' / 'public_key.pem'),
+        'private_key': str(tmp_path / 'keys' / 'private_key.pem'),
+        'output_dir': str(tmp_path / 'output'),
+        'drafts_dir': str(tmp_path / 'drafts'),
+        'registry': str(tmp_path / 'registry' / 'documents.sqlite'),
+    }
+    config['Verification'] = {'url': 'https://verify.example.com/'}
+    config['Nextcloud'] = {'enabled': 'false'}
+    config['Conversion'] = {'backend': 'builtin'}
+    config['Signers'] = {'kdf': 'scrypt', 'scrypt_n': '1024'}
+    config['Logging'] = {'spans': 'false'}
+    for section, values in sections.items():
+        config[section] = values
+    config_path = tmp_path / 'config.ini'
+    with open(config_path, 'w') as f:
+        config.write(f)
+
+    from desktop_app.config.config_manager import ConfigManager
+    from desktop_app.models.author import Author
+
+    png_path = tmp_path / 'signature.png'
+    png_path.write_bytes(signature_png())
+    author = Author('Jane Doe', SIGNER, 'jane@example.com', '030 123', '0170 123', 'Clerk',
+                    '', '', '', '', '', PASSWORD)
+    author.encrypt_signature(str(png_path), ConfigManager(str(config_path)), PASSWORD)
+    return str(config_path)
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    return build_workspace(tmp_path)
+
+
+@pytest.fixture
+def config(workspace):
+    from desktop_app.config.config_manager import ConfigManager
+
+    return ConfigManager(workspace)
+
+
+@pytest.fixture
+def webdav(tmp_path):
+    # A local WebDAV server standing in for Nextcloud
+    from tests.webdav_server import WebDavServer
+
+    server = WebDavServer(str(tmp_path / 'webdav')).start()
+    yield server
+    server.stop()
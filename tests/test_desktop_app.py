@@ -0,0 +1,993 @@
+import json
+import os
+
+import pytest
+
+from tests.conftest import PASSWORD, SIGNER
+
+
+# Batch generation
+
+@pytest.mark.parametrize('merkle_leaves', [0, 2])
+def test_batch_writes_manifest_and_registry(workspace, config, tmp_path, monkeypatch, merkle_leaves):
+    from desktop_app.batch import run_batch
+    from desktop_app.utils.document_registry import get_registry
+    from desktop_app.utils.pdf_utils import verify_pdf
+
+    monkeypatch.setenv('DOCCREATOR_SIGNER_PASSWORD', PASSWORD)
+    rows = tmp_path / 'rows.jsonl'
+    rows.write_text(''.join(json.dumps({'ClientName': f'Client {i}', 'Subject': 'Hi', 'Content': 'Text'}) + '\n'
+                            for i in range(3)))
+    output_dir = tmp_path / 'batch'
+    manifest = tmp_path / 'manifest.jsonl'
+
+    succeeded, failed = run_batch(workspace, str(rows), str(output_dir), str(manifest), 'example.docx', SIGNER,
+                                  workers=1, chunk_size=2, merkle_leaves=merkle_leaves)
+
+    assert (succeeded, failed) == (3, 0)
+    results = sorted((json.loads(line) for line in manifest.read_text().splitlines()), key=lambda r: r['row'])
+    assert [result['row'] for result in results] == [0, 1, 2]
+    registry = get_registry(config)
+    for result in results:
+        assert result['error'] is None
+        assert verify_pdf(result['path'], config.get('Paths', 'public_key'))
+        record = registry.lookup(result['fingerprint'])
+        assert record['template'] == 'example.docx'
+        assert record['signer'] == SIGNER
+
+
+@pytest.mark.parametrize('name', ['../escaped.pdf', '/tmp/absolute.pdf', 'sub/../../escaped.pdf', '.'])
+def test_batch_rejects_output_outside_output_dir(tmp_path, name):
+    from desktop_app.batch import output_file
+
+    with pytest.raises(ValueError):
+        output_file(str(tmp_path / 'out'), name)
+
+
+def test_batch_output_name_inside_output_dir(tmp_path):
+    from desktop_app.batch import output_file
+
+    path = output_file(str(tmp_path / 'out'), 'sub/letter.pdf')
+    assert path == os.path.join(os.path.realpath(tmp_path / 'out'), 'sub', 'letter.pdf')
+
+
+def create_document(config, output_path, form_data=None):
+    from desktop_app.models.author import Author
+    from desktop_app.utils.pdf_creator import render_document
+
+    author = Author.load(SIGNER, config)
+    form_data = form_data or {'ClientName': 'Client', 'Subject': 'Subject', 'Content': 'Text'}
+    return render_document(config, 'example.docx', form_data, author, str(output_path),
+                           author.decrypt_signature(config, PASSWORD))
+
+
+# Fingerprint
+
+def test_fingerprint_recomputed_from_file(config, tmp_path):
+    from PyPDF2 import PdfFileReader
+    from desktop_app.utils.fingerprint import compute_fingerprint, stored_fingerprint
+
+    path, fingerprint = create_document(config, tmp_path / 'a.pdf')
+    with open(path, 'rb') as f:
+        reader = PdfFileReader(f)
+        assert stored_fingerprint(reader) == fingerprint
+        assert compute_fingerprint(reader) == fingerprint
+
+
+def test_fingerprint_depends_on_content(config, tmp_path):
+    _, first = create_document(config, tmp_path / 'a.pdf', {'Content': 'One'})
+    _, second = create_document(config, tmp_path / 'b.pdf', {'Content': 'Two'})
+    _, again = create_document(config, tmp_path / 'c.pdf', {'Content': 'One'})
+    assert first != second
+    assert first == again
+
+
+def test_fingerprint_covers_every_page(tmp_path):
+    import io
+    from PyPDF2 import PdfFileReader
+    from reportlab.pdfgen import canvas
+    from desktop_app.utils.fingerprint import compute_fingerprint
+
+    def document(last_page_text):
+        buffer = io.BytesIO()
+        can = canvas.Canvas(buffer)
+        for text in ('first', 'second', last_page_text):
+            can.drawString(100, 700, text)
+            can.showPage()
+        can.save()
+        return PdfFileReader(io.BytesIO(buffer.getvalue()))
+
+    assert compute_fingerprint(document('third')) != compute_fingerprint(document('changed'))
+
+@pytest.mark.parametrize('pagesize', ['A4', 'letter', 'A5'])
+def test_footer_stays_inside_the_page(pagesize):
+    from reportlab.lib import pagesizes
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    from desktop_app.utils.pdf_utils import FOOTER_FONT, FOOTER_MARGIN, FOOTER_X, footer_layout
+
+    pagesize = getattr(pagesizes, pagesize)
+    lines = ['Verification URL: https://verify.example.com/documents/check?source=letter',
+             'Fingerprint: v1:' + '0123456789abcdef' * 4]
+    layout = footer_layout(pagesize, lines)
+    assert all(FOOTER_X + stringWidth(text, FOOTER_FONT, size) <= pagesize[0] - FOOTER_MARGIN
+               for text, size in layout)
+    # Nothing is cut off, long lines continue on the next line
+    assert ''.join(text for text, _ in layout) == ''.join(lines)
+
+
+# Signatures
+
+def unsigned_document(client_name='Client'):
+    import io
+    from desktop_app.utils.pdf_utils import compose_pdf
+
+    stream = io.BytesIO()
+    compose_pdf(stream, ['Template: test', f'ClientName: {client_name}'], None, 'https://verify.example.com/')
+    return stream.getvalue()
+
+
+@pytest.mark.parametrize('declared', [b'0', b'1'])
+def test_base_pdf_without_pages_is_rejected(declared):
+    import io
+    from PyPDF2 import PdfFileWriter
+    from desktop_app.utils.pdf_utils import compose_pdf
+
+    empty = io.BytesIO()
+    PdfFileWriter().write(empty)
+    # Also when the page tree claims a page it does not have
+    data = empty.getvalue().replace(b'/Count 0', b'/Count ' + declared)
+    with pytest.raises(ValueError):
+        compose_pdf(io.BytesIO(), [], None, 'https://verify.example.com/', io.BytesIO(data))
+
+
+@pytest.fixture(params=['rsa', 'ecdsa-p256', 'ed25519'])
+def key_pair(request, tmp_path):
+    from keygen.keygen import generate_key_pair
+
+    public_path, private_path = str(tmp_path / 'public.pem'), str(tmp_path / 'private.pem')
+    generate_key_pair(public_path, private_path, request.param)
+    return public_path, private_path
+
+
+def test_sign_and_verify_round_trip(key_pair, tmp_path):
+    from desktop_app.utils.pdf_utils import sign_pdf, verify_pdf
+
+    path = tmp_path / 'document.pdf'
+    path.write_bytes(unsigned_document())
+    sign_pdf(str(path), key_pair[1])
+    assert verify_pdf(str(path), key_pair[0])
+
+
+def test_tampered_byte_is_rejected(key_pair, tmp_path):
+    from desktop_app.utils.pdf_utils import sign_pdf, verify_pdf
+
+    path = tmp_path / 'document.pdf'
+    path.write_bytes(unsigned_document())
+    sign_pdf(str(path), key_pair[1])
+    data = bytearray(path.read_bytes())
+    data[len(data) // 3] ^= 0x01
+    path.write_bytes(bytes(data))
+    assert not verify_pdf(str(path), key_pair[0])
+
+
+def test_appended_bytes_are_rejected(key_pair, tmp_path):
+    import io
+    from desktop_app.utils.pdf_signature import REASON_MODIFIED, SignatureError, embed_signature, verify_signature
+    from desktop_app.utils.signing import SigningEngine, load_public_key
+
+    stream = io.BytesIO(unsigned_document())
+    embed_signature(stream, SigningEngine(key_pair[1]))
+    stream.write(b"\n% appended\n")
+    with pytest.raises(SignatureError) as error:
+        verify_signature(stream, load_public_key(key_pair[0]))
+    assert error.value.reason == REASON_MODIFIED
+
+
+def test_signature_of_other_key_is_rejected(workspace, config, tmp_path):
+    from desktop_app.utils.pdf_utils import sign_pdf, verify_pdf
+    from keygen.keygen import generate_key_pair
+
+    other_public, other_private = str(tmp_path / 'other.pem'), str(tmp_path / 'other-private.pem')
+    generate_key_pair(other_public, other_private, 'ed25519')
+    path = tmp_path / 'document.pdf'
+    path.write_bytes(unsigned_document())
+    sign_pdf(str(path), other_private)
+    assert not verify_pdf(str(path), config.get('Paths', 'public_key'))
+
+@pytest.mark.parametrize('anchor', [None, (1, 300, 400), (2, 72, 90)])
+def test_signature_lands_on_the_anchor(anchor):
+    import io
+    from PyPDF2 import PdfFileReader
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    from tests.conftest import signature_png
+    from desktop_app.utils.pdf_utils import SIGNATURE_XOBJECT, compose_pdf
+    from desktop_app.utils.signature_image import SIGNATURE_BOX, signature_image
+
+    base = io.BytesIO()
+    can = canvas.Canvas(base, pagesize=A4)
+    for text in ('first', 'second', 'third'):
+        can.drawString(100, 700, text)
+        can.showPage()
+    can.save()
+    output = io.BytesIO()
+    anchors = {'SignerSignature': anchor} if anchor else None
+    compose_pdf(output, [], signature_png(), 'https://verify.example.com/', base, anchors=anchors)
+
+    page_number, x, y = anchor or (0,) + SIGNATURE_BOX[:2]
+    expected = signature_image(signature_png()).placement((x, y) + SIGNATURE_BOX[2:])
+    reader = PdfFileReader(output)
+    for i in range(reader.getNumPages()):
+        page = reader.getPage(i)
+        has_signature = SIGNATURE_XOBJECT in page['/Resources']['/XObject']
+        assert has_signature == (i == page_number)
+        if has_signature:
+            content = page['/Contents'][-1].getObject().getData().decode()
+            placement = content.split(f'{SIGNATURE_XOBJECT} Do')[0].split('q ')[-1].split()[:6]
+            assert [float(v) for v in placement] == pytest.approx(expected, abs=1e-3)
+
+
+# Signer passwords
+
+def test_wrong_password_is_rejected(workspace, config):
+    from desktop_app.models.author import Author
+
+    author = Author.load(SIGNER, config)
+    assert author.decrypt_signature(config, 'wrong') is None
+    assert author.decrypt_signature(config, PASSWORD) is not None
+
+
+def test_unlocked_signature_still_needs_the_password(workspace, config):
+    from desktop_app.utils.signer_repository import SignerRepository
+
+    repository = SignerRepository.for_config(config)
+    signature = repository.signature(SIGNER, PASSWORD)
+    assert signature is not None
+    assert len(repository.unlocked) == 1
+    assert repository.signature(SIGNER, 'wrong') is None
+    assert repository.signature(SIGNER) is None
+    assert repository.signature(SIGNER, PASSWORD) == signature
+
+
+def legacy_signer(config):
+    # A signer as created before passwords were required: a plain Fernet key in its INI file
+    from cryptography.fernet import Fernet
+    from desktop_app.models.author import Author
+    from desktop_app.utils.signer_repository import SignerRepository, signer_signature_path
+    from tests.conftest import signature_png
+
+    key = Fernet.generate_key()
+    author = Author('Old Signer', 'old', '', '', '', '', '', '', '', '', '', '')
+    repository = SignerRepository.for_config(config)
+    repository.save(author, {'key': key.decode()})
+    png = signature_png()
+    with open(signer_signature_path(config.get_signers_dir(), 'old'), 'wb') as f:
+        f.write(Fernet(key).encrypt(png))
+    return repository, key, png
+
+
+def test_legacy_signer_is_reencrypted_on_first_unlock(workspace, config):
+    from cryptography.fernet import Fernet, InvalidToken
+    from desktop_app.utils.signer_repository import (SignerRepository, read_signer_ini, signer_ini_path,
+                                                     signer_signature_path)
+
+    repository, key, png = legacy_signer(config)
+    assert repository.signature('old') is None
+    assert repository.signature('old', 'new password') == png
+
+    _, params = read_signer_ini(signer_ini_path(config.get_signers_dir(), 'old'))
+    assert 'key' not in params and params['kdf'] == 'scrypt'
+    with open(signer_signature_path(config.get_signers_dir(), 'old'), 'rb') as f:
+        with pytest.raises(InvalidToken):
+            Fernet(key).decrypt(f.read())
+    # Another process, without the unlock cache
+    other = SignerRepository(config.get_signers_dir(), config=config)
+    assert other.signature('old') is None
+    assert other.signature('old', 'wrong') is None
+    assert other.signature('old', 'new password') == png
+
+
+def test_interrupted_legacy_upgrade_is_completed(workspace, config):
+    from desktop_app.utils.signature_crypto import derive_fernet, new_kdf_params
+    from desktop_app.utils.signer_repository import read_signer_ini, signer_ini_path, signer_signature_path
+
+    repository, key, png = legacy_signer(config)
+    # Stopped after re-encrypting the file, before the key was removed from the INI file
+    params = new_kdf_params(config)
+    repository.save(repository.get('old'), dict(params, key=key.decode()))
+    with open(signer_signature_path(config.get_signers_dir(), 'old'), 'wb') as f:
+        f.write(derive_fernet(params, 'new password').encrypt(png))
+
+    assert repository.signature('old', 'wrong') is None
+    assert repository.signature('old', 'new password') == png
+    _, saved = read_signer_ini(signer_ini_path(config.get_signers_dir(), 'old'))
+    assert saved == params
+
+# Signer index
+
+def write_signer_ini(signers_dir, short_name, full_name):
+    import configparser
+    from desktop_app.models.author import Author
+    from desktop_app.utils.signer_repository import signer_ini_path
+
+    ini = configparser.ConfigParser()
+    ini['Author'] = Author(full_name, short_name, '', '', '', '', '', '', '', '', '', '').to_dict()
+    with open(signer_ini_path(signers_dir, short_name), 'w') as f:
+        ini.write(f)
+
+
+def touch_dir(path):
+    # Directory timestamps can be coarser than the time between two changes in a test
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_signer_index_is_reused_and_rebuilt(workspace, config, monkeypatch):
+    from desktop_app.utils.signer_repository import INDEX_FILE, SignerRepository
+
+    signers_dir = config.get_signers_dir()
+    write_signer_ini(signers_dir, 'mm', 'Max Muster')
+    assert SignerRepository(signers_dir).names() == ['jd', 'mm']
+    index_path = os.path.join(signers_dir, INDEX_FILE)
+    with open(index_path, encoding='utf-8') as f:
+        assert sorted(json.load(f)['signers']) == ['jd', 'mm']
+
+    # An up-to-date index is loaded without parsing a single signer file
+    parsed = []
+    original_parse = SignerRepository._parse
+    monkeypatch.setattr(SignerRepository, '_parse',
+                        lambda self, path, version: parsed.append(path) or original_parse(self, path, version))
+    repository = SignerRepository(signers_dir)
+    assert repository.names() == ['jd', 'mm']
+    assert repository.get('mm').full_name == 'Max Muster'
+    assert parsed == []
+
+    # An unreadable index is ignored and written again from the files
+    with open(index_path, 'w', encoding='utf-8') as f:
+        f.write('{"version": 2, "sig')
+    assert SignerRepository(signers_dir).names() == ['jd', 'mm']
+    assert len(parsed) == 2
+    with open(index_path, encoding='utf-8') as f:
+        assert sorted(json.load(f)['signers']) == ['jd', 'mm']
+
+
+def test_signer_index_follows_directory_changes(workspace, config):
+    from desktop_app.utils.signer_repository import SignerRepository, signer_ini_path
+
+    signers_dir = config.get_signers_dir()
+    repository = SignerRepository(signers_dir)
+    assert repository.names() == ['jd']
+
+    # Files added or removed by another process change the directory's mtime
+    write_signer_ini(signers_dir, 'mm', 'Max Muster')
+    touch_dir(signers_dir)
+    assert repository.names() == ['jd', 'mm']
+    # An index written by a process that had not seen the new file yet is not trusted either
+    assert SignerRepository(signers_dir).names() == ['jd', 'mm']
+
+    os.remove(signer_ini_path(signers_dir, 'mm'))
+    touch_dir(signers_dir)
+    assert repository.names() == ['jd']
+    assert repository.get('mm') is None
+
+    # Edited in place, which leaves the directory alone: the file's own version is checked
+    write_signer_ini(signers_dir, 'jd', 'Jane Roe')
+    path = signer_ini_path(signers_dir, 'jd')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert repository.get('jd').full_name == 'Jane Roe'
+
+
+# Cancelling
+
+@pytest.mark.parametrize('stage', ['fill', 'sign'])
+def test_cancel_removes_the_document(config, tmp_path, stage):
+    from desktop_app.models.author import Author
+    from desktop_app.utils.pdf_creator import GenerationCancelled, create_pdf
+
+    def progress(name):
+        if name == stage:
+            raise GenerationCancelled()
+
+    author = Author.load(SIGNER, config)
+    path = tmp_path / 'letter.pdf'
+    with pytest.raises(GenerationCancelled):
+        create_pdf(config, 'example.docx', {'ClientName': 'Client'}, author, str(path),
+                   author.decrypt_signature(config, PASSWORD), progress)
+    assert not path.exists()
+
+
+def test_cancel_at_archive_keeps_the_registered_document(config, tmp_path):
+    from PyPDF2 import PdfFileReader
+    from desktop_app.models.author import Author
+    from desktop_app.utils.document_registry import get_registry
+    from desktop_app.utils.fingerprint import stored_fingerprint
+    from desktop_app.utils.pdf_creator import GenerationCancelled, create_pdf
+
+    def progress(name):
+        if name == 'archive':
+            raise GenerationCancelled()
+
+    author = Author.load(SIGNER, config)
+    path = create_pdf(config, 'example.docx', {'ClientName': 'Client'}, author, str(tmp_path / 'letter.pdf'),
+                      author.decrypt_signature(config, PASSWORD), progress)
+    with open(path, 'rb') as f:
+        fingerprint = stored_fingerprint(PdfFileReader(f))
+    assert get_registry(config).lookup(fingerprint) is not None
+
+
+# Drafts
+
+def test_journal_replay_stops_at_a_truncated_record(tmp_path):
+    from desktop_app.utils.draft_store import DraftStore, encode_record
+
+    store = DraftStore(str(tmp_path))
+    store.set_meta('example.docx', SIGNER)
+    store.set_field('ClientName', 'Client')
+    store.flush()
+    store.set_field('Content', 'x' * 300)
+    store.flush()
+    store.close()
+    journal = tmp_path / 'draft.journal'
+    valid_length = journal.stat().st_size
+    record = encode_record({'op': 'set', 'field': 'Subject', 'value': 'lost', 'seq': 3})
+    with open(journal, 'ab') as f:
+        f.write(record[:len(record) // 2])
+
+    store = DraftStore(str(tmp_path))
+    assert store.draft() == {'template': 'example.docx', 'author': SIGNER,
+                             'fields': {'ClientName': 'Client', 'Content': 'x' * 300}}
+    assert journal.stat().st_size == valid_length
+    store.set_field('Content', 'x' * 299 + 'y')
+    store.close()
+    assert DraftStore(str(tmp_path)).draft()['fields']['Content'] == 'x' * 299 + 'y'
+
+
+def test_compaction_keeps_the_draft_and_empties_the_journal(tmp_path):
+    from desktop_app.utils.draft_store import DraftStore
+
+    store = DraftStore(str(tmp_path), compact_records=3)
+    for i in range(7):
+        store.set_field('Content', f'version {i}')
+        store.flush()
+    store.close()
+    assert not (tmp_path / 'draft.json.old').exists()
+    assert (tmp_path / 'draft.journal').stat().st_size < 100
+    assert DraftStore(str(tmp_path)).draft()['fields'] == {'Content': 'version 6'}
+
+
+def test_draft_falls_back_to_the_snapshot_moved_aside(tmp_path):
+    import os
+    from desktop_app.utils.draft_store import DraftStore
+
+    store = DraftStore(str(tmp_path))
+    store.set_field('Content', 'saved')
+    store.compact()
+    store.close()
+    # Compaction stopped after moving the old snapshot aside
+    os.replace(tmp_path / 'draft.json', tmp_path / 'draft.json.old')
+    assert DraftStore(str(tmp_path)).draft()['fields'] == {'Content': 'saved'}
+
+
+def test_secure_delete_removes_every_file(tmp_path):
+    from desktop_app.utils.draft_store import DraftStore
+
+    store = DraftStore(str(tmp_path), compact_records=2)
+    for i in range(3):
+        store.set_field('Content', f'version {i}')
+        store.flush()
+    store.secure_delete()
+    assert sorted(path.name for path in tmp_path.iterdir()) == []
+    assert not DraftStore(str(tmp_path)).has_draft()
+
+
+# Nextcloud archive
+
+def archive_queue(tmp_path, lease=600):
+    from desktop_app.utils.nextcloud import ArchiveQueue
+
+    return ArchiveQueue(str(tmp_path / 'archive' / 'uploads.sqlite'), lease)
+
+
+def pdf_file(tmp_path, name='letter.pdf', size=1000):
+    path = tmp_path / name
+    path.write_bytes(b'%PDF-1.4\n' + os.urandom(size))
+    return path
+
+
+def test_archive_counter_continues_after_reopen(tmp_path):
+    pattern = '{counter:03d}-{client_name}.pdf'
+    queue = archive_queue(tmp_path)
+    names = [queue.enqueue(str(pdf_file(tmp_path)), pattern, 'example.docx', {'ClientName': f'c{i}'}, SIGNER)
+             for i in range(2)]
+    queue.close()
+    queue = archive_queue(tmp_path)
+    names.append(queue.enqueue(str(pdf_file(tmp_path)), pattern, 'example.docx', {'ClientName': 'c2'}, SIGNER))
+    assert names == ['001-c0.pdf', '002-c1.pdf', '003-c2.pdf']
+
+
+def test_archive_spool_is_a_copy(tmp_path):
+    queue = archive_queue(tmp_path)
+    path = pdf_file(tmp_path)
+    data = path.read_bytes()
+    queue.enqueue(str(path), '{counter}.pdf', 'example.docx', {}, SIGNER)
+    upload_id, _, _ = queue.claim()
+    # The output file is rewritten in place, as render_pdf does
+    with open(path, 'r+b') as f:
+        f.truncate(0)
+        f.write(b'%PDF-1.4\nrewritten')
+    with open(queue.spool_path(upload_id), 'rb') as f:
+        assert f.read() == data
+
+
+def test_archive_recover_leaves_running_uploads_of_others(tmp_path):
+    import time
+
+    first, second = archive_queue(tmp_path), archive_queue(tmp_path)
+    for _ in range(2):
+        first.enqueue(str(pdf_file(tmp_path)), '{counter}.pdf', 'example.docx', {}, SIGNER)
+    first.claim()
+    assert second.recover() == 0
+    assert second.claim()[1] == '2.pdf'
+    assert second.claim() is None
+    # Once the lease has run out, the upload can be taken over
+    assert second.claim(now=time.time() + 601)[1] == '1.pdf'
+    # The first owner's result no longer counts
+    first.fail(1, 'late')
+    assert second.stats() == {'pending': 0, 'uploading': 2, 'failed': 0}
+    assert archive_queue(tmp_path).recover(now=time.time() + 1202) == 2
+
+
+def test_archive_uploads_to_webdav(tmp_path, webdav):
+    from desktop_app.utils.nextcloud import ArchiveUploader, WebDavClient
+
+    queue = archive_queue(tmp_path)
+    small, large = pdf_file(tmp_path, 'small.pdf', 1000), pdf_file(tmp_path, 'large.pdf', 5000)
+    for path, client_name in ((small, 'Small'), (large, 'Large')):
+        queue.enqueue(str(path), '{client_name}.pdf', 'example.docx', {'ClientName': client_name}, SIGNER)
+    client = WebDavClient(webdav.files_url, webdav.uploads_url, 'user', 'secret', chunk_size=2048)
+    uploader = ArchiveUploader(queue, client, 'Archive/2024')
+    while uploader.upload_one():
+        pass
+    client.close()
+
+    assert uploader.uploaded == 2
+    archive_dir = os.path.join(webdav.files_dir, 'Archive', '2024')
+    with open(os.path.join(archive_dir, 'Small.pdf'), 'rb') as f:
+        assert f.read() == small.read_bytes()
+    with open(os.path.join(archive_dir, 'Large.pdf'), 'rb') as f:
+        assert f.read() == large.read_bytes()
+    assert [method for method, _ in webdav.requests].count('MOVE') == 1
+    assert queue.stats() == {'pending': 0, 'uploading': 0, 'failed': 0}
+    assert os.listdir(queue.spool_dir) == []
+
+
+def test_archive_upload_errors(tmp_path, webdav):
+    from desktop_app.utils.nextcloud import ArchiveUploader, WebDavClient
+
+    queue = archive_queue(tmp_path)
+    for _ in range(2):
+        queue.enqueue(str(pdf_file(tmp_path)), '{counter}.pdf', 'example.docx', {}, SIGNER)
+    client = WebDavClient(webdav.files_url, webdav.uploads_url, 'user', 'secret')
+    uploader = ArchiveUploader(queue, client)
+    # A server error is retried later, a refused upload is not
+    webdav.put_errors = [503, 403]
+    while uploader.upload_one():
+        pass
+    client.close()
+    assert queue.stats() == {'pending': 1, 'uploading': 0, 'failed': 1}
+    assert [(name, error) for _, name, _, error in queue.failures()] == [('2.pdf', 'PUT failed with HTTP 403')]
+
+
+# Render cache
+
+def test_render_cache_is_off_by_default():
+    from desktop_app.config.config_manager import ConfigManager
+    from desktop_app.utils.render_cache import get_render_cache
+
+    assert get_render_cache(ConfigManager(os.path.join(os.path.dirname(__file__), '..', 'config.ini.default'))) is None
+
+
+def test_render_cache_reuses_converted_documents(config, tmp_path):
+    import stat
+    from desktop_app.utils.render_cache import get_render_cache
+
+    config.config['RenderCache'] = {'path': str(tmp_path / 'renders')}
+    _, first = create_document(config, tmp_path / 'a.pdf')
+    _, again = create_document(config, tmp_path / 'b.pdf')
+    cache = get_render_cache(config)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+    assert first == again
+    for directory, _, files in os.walk(cache.objects_dir):
+        for name in files:
+            assert stat.S_IMODE(os.stat(os.path.join(directory, name)).st_mode) == 0o600
+
+
+# Merkle batch signatures
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 8, 13])
+def test_merkle_proofs_lead_to_the_root(size):
+    import hashlib
+    from desktop_app.utils.merkle import build_tree, root_from_proof
+
+    digests = [hashlib.sha256(b'%d' % i).digest() for i in range(size)]
+    root, proofs = build_tree(digests)
+    for index, (digest, proof) in enumerate(zip(digests, proofs)):
+        assert root_from_proof(digest, index, size, proof) == root
+        if size > 1:
+            assert root_from_proof(digest, (index + 1) % size, size, proof) != root
+            assert root_from_proof(hashlib.sha256(b'other').digest(), index, size, proof) != root
+    assert root_from_proof(digests[0], size, size, proofs[0]) is None
+
+
+def test_batch_signed_documents_verify(tmp_path):
+    from desktop_app.utils.pdf_utils import sign_pdfs, verify_pdf
+    from keygen.keygen import generate_key_pair
+
+    public_path, private_path = str(tmp_path / 'public.pem'), str(tmp_path / 'private.pem')
+    generate_key_pair(public_path, private_path, 'ed25519')
+    paths = []
+    for i in range(5):
+        path = tmp_path / f'{i}.pdf'
+        path.write_bytes(unsigned_document(f'Client {i}'))
+        paths.append(str(path))
+    assert sign_pdfs(paths, private_path, max_leaves=4) == 2
+    assert all(verify_pdf(path, public_path) for path in paths)
+
+    data = bytearray(open(paths[2], 'rb').read())
+    data[len(data) // 3] ^= 0x01
+    with open(paths[2], 'wb') as f:
+        f.write(bytes(data))
+    assert not verify_pdf(paths[2], public_path)
+    assert verify_pdf(paths[3], public_path)
+
+
+class RootCache(dict):
+    def put(self, key, value):
+        self[key] = value
+
+
+def test_tampered_merkle_proof_is_rejected(tmp_path):
+    from desktop_app.utils.batch_signing import PendingSignatures
+    from desktop_app.utils.merkle import build_tree, signed_message
+    from desktop_app.utils.pdf_signature import (SignatureError, fill_merkle_signature, signature_digest,
+                                                 verify_signature_digest)
+    from desktop_app.utils.signing import SigningEngine, load_public_key
+    from keygen.keygen import generate_key_pair
+
+    public_path, private_path = str(tmp_path / 'public.pem'), str(tmp_path / 'private.pem')
+    generate_key_pair(public_path, private_path, 'ecdsa-p256')
+    engine, public_key = SigningEngine(private_path), load_public_key(public_path)
+    pending = PendingSignatures(4)
+    for i in range(3):
+        path = tmp_path / f'{i}.pdf'
+        path.write_bytes(unsigned_document(f'Client {i}'))
+        with open(path, 'r+b') as f:
+            pending.embed(str(path), f, engine)
+    documents = pending.take()
+    root, proofs = build_tree([leaf for _, leaf, _ in documents])
+    signature = engine.sign_digest(signed_message(root, len(documents)))
+    for index, ((path, _, offset), proof) in enumerate(zip(documents, proofs)):
+        with open(path, 'r+b') as f:
+            fill_merkle_signature(f, offset, 4, signature, index, len(documents), proof)
+    # Another document of the tree passed, so its root is cached
+    verified_roots = RootCache()
+    with open(documents[1][0], 'rb') as f:
+        verify_signature_digest(signature_digest(f, public_key), public_key, verified_roots)
+    assert len(verified_roots) == 1
+
+    path, _, offset = documents[0]
+    proof = proofs[0]
+    forged = [bytes([proof[0][0] ^ 0x01]) + proof[0][1:]] + proof[1:]
+    for index, proof in ((0, forged), (1, proof)):
+        with open(path, 'r+b') as f:
+            fill_merkle_signature(f, offset, 4, signature, index, len(documents), proof)
+        with open(path, 'rb') as f, pytest.raises(SignatureError):
+            verify_signature_digest(signature_digest(f, public_key), public_key, verified_roots)
+
+
+# Builtin DOCX renderer
+
+@pytest.mark.parametrize('style', [None, 'Table Grid'])
+def test_renderer_draws_tables(style):
+    import io
+    from docx import Document
+    from docx.oxml.ns import qn
+    from PyPDF2 import PdfFileReader
+    from desktop_app.utils.docx_renderer import DocxRenderer
+
+    document = Document()
+    document.add_paragraph('Before the table')
+    table = document.add_table(rows=1, cols=2)
+    if style is not None:
+        table.style = style
+    table.cell(0, 0).text = 'Left cell'
+    table.cell(0, 1).text = 'Right cell'
+    buffer = io.BytesIO()
+    document.save(buffer)
+
+    renderer = DocxRenderer(buffer.getvalue())
+    flowable = renderer._table(renderer.document.element.body.find(qn('w:tbl')), renderer.document.part)
+    assert any(command[0] == 'GRID' for command in flowable._linecmds) == (style is not None)
+    text = PdfFileReader(io.BytesIO(renderer.render())).getPage(0).extractText()
+    assert 'Left cell' in text and 'Right cell' in text
+
+
+# Converter pool
+
+class FakeSession:
+    # Stands in for a LibreOffice session: writes the input back as the PDF.
+    # Documents starting with b'crash' kill it, b'hang' blocks until killed,
+    # b'block' until the gate is opened.
+
+    def __init__(self, started, gate=None):
+        import threading
+
+        self.killed = threading.Event()
+        self.gate = gate
+        started.append(self)
+
+    def alive(self):
+        return not self.killed.is_set()
+
+    def kill(self):
+        self.killed.set()
+
+    def convert(self, docx_path, pdf_path):
+        with open(docx_path, 'rb') as f:
+            data = f.read()
+        if data.startswith(b'crash'):
+            self.kill()
+            raise RuntimeError('session crashed')
+        if data.startswith(b'hang'):
+            self.killed.wait()
+            raise RuntimeError('session killed')
+        if data.startswith(b'block'):
+            self.gate.wait()
+        with open(pdf_path, 'wb') as f:
+            f.write(data)
+
+
+def converter_pool(started, gate=None, **options):
+    from desktop_app.utils.docx_converter import ConverterPool
+
+    return ConverterPool(lambda: FakeSession(started, gate), **options)
+
+
+def test_converter_pool_restarts_crashed_sessions():
+    from desktop_app.utils.docx_converter import ConversionError
+
+    started = []
+    pool = converter_pool(started, workers=1)
+    assert pool.convert(b'one') == b'one'
+    with pytest.raises(ConversionError):
+        pool.convert(b'crash')
+    assert pool.restarts == 1
+    assert pool.convert(b'two') == b'two'
+    pool.close()
+    assert len(started) == 2
+    assert pool.restarts == 1
+
+
+def test_converter_pool_kills_sessions_that_time_out():
+    from desktop_app.utils.docx_converter import ConversionTimeout
+
+    started = []
+    pool = converter_pool(started, workers=1, timeout=0.2)
+    with pytest.raises(ConversionTimeout):
+        pool.convert(b'hang')
+    assert started[0].killed.is_set()
+    assert pool.convert(b'after') == b'after'
+    assert pool.restarts == 1
+    pool.close()
+
+
+def test_converter_pool_queue_is_bounded():
+    import threading
+    import time
+    from desktop_app.utils.docx_converter import ConversionError
+
+    started = []
+    gate = threading.Event()
+    pool = converter_pool(started, gate, workers=1, queue_size=1, timeout=0.2)
+    results = {}
+
+    def convert(data):
+        try:
+            results[data] = pool.convert(data)
+        except ConversionError as e:
+            results[data] = e
+
+    # One job runs until the gate opens, one waits in the queue
+    threads = [threading.Thread(target=convert, args=(data,)) for data in (b'block', b'queued')]
+    threads[0].start()
+    while not started:
+        time.sleep(0.01)
+    threads[1].start()
+    while pool._jobs.qsize() < 1:
+        time.sleep(0.01)
+    with pytest.raises(ConversionError, match='full'):
+        pool.convert(b'rejected')
+    gate.set()
+    for thread in threads:
+        thread.join()
+    assert results[b'queued'] == b'queued'
+    pool.close()
+
+
+# Compiled templates
+
+def split_template(path, *runs):
+    import docx
+
+    document = docx.Document()
+    paragraph = document.add_paragraph()
+    for text in runs:
+        paragraph.add_run(text)
+    document.save(str(path))
+
+
+def template_text(data):
+    import io
+    import docx
+
+    return '\n'.join(p.text for p in docx.Document(io.BytesIO(data)).paragraphs)
+
+
+def test_template_placeholder_split_across_runs(tmp_path):
+    from desktop_app.utils.docx_template import CompiledTemplate
+
+    path = tmp_path / 'split.docx'
+    # Word splits a token over runs e.g. after a spelling check or a format change
+    split_template(path, 'Dear {{ Cli', 'ent', 'Name }}, see {{Subject}}.')
+    template = CompiledTemplate(str(path))
+
+    assert template.placeholders == ['ClientName', 'Subject']
+    assert template_text(template.fill({'ClientName': 'Ada', 'Subject': 'the offer'})) == 'Dear Ada, see the offer.'
+    assert template_text(template.fill({'ClientName': 'Bob'})) == 'Dear Bob, see {{Subject}}.'
+
+
+def test_template_is_recompiled_when_the_file_changes(tmp_path):
+    from desktop_app.utils.template_manager import TemplateManager
+
+    path = tmp_path / 'changing.docx'
+    split_template(path, 'Hello {{ClientName}}')
+    first = TemplateManager.compile_template_file(str(path))
+    assert TemplateManager.compile_template_file(str(path)) is first
+
+    split_template(path, 'Bye {{ClientName}}')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    second = TemplateManager.compile_template_file(str(path))
+    assert second is not first
+    assert second.digest != first.digest
+    assert template_text(second.fill({'ClientName': 'Ada'})) == 'Bye Ada'
+    assert TemplateManager.compile_template_file(str(path)) is second
+
+
+# Document registry
+
+def test_registry_register_and_lookup(tmp_path):
+    from desktop_app.utils.document_registry import DocumentRegistry
+
+    registry = DocumentRegistry(str(tmp_path / 'registry' / 'documents.sqlite'))
+    registry.register('v1:' + 'a' * 64, 'example.docx', 'jd', '2024-01-02T03:04:05')
+    registry.register_many([('v1:' + 'b' * 64, 'other.docx', 'mm', None),
+                            ('v1:' + 'a' * 64, 'changed.docx', 'xx', None)])
+
+    assert len(registry) == 2
+    # Re-registering keeps the first record
+    assert registry.lookup('v1:' + 'a' * 64) == {'template': 'example.docx', 'signer': 'jd',
+                                                 'issued_at': '2024-01-02T03:04:05'}
+    assert registry.lookup('v1:' + 'b' * 64)['signer'] == 'mm'
+    assert registry.lookup('v1:' + 'c' * 64) is None
+    registry.close()
+
+
+def test_registry_replica_filters_unknown_fingerprints(tmp_path):
+    from desktop_app.utils.document_registry import DocumentRegistry, RegistryReplica
+
+    registry = DocumentRegistry(str(tmp_path / 'documents.sqlite'))
+    fingerprints = [f'v1:{i:064x}' for i in range(200)]
+    registry.register_many([(fingerprint, 'example.docx', 'jd', None) for fingerprint in fingerprints])
+    replica_path = str(tmp_path / 'replica.sqlite')
+    registry.export_replica(replica_path)
+    assert not os.path.exists(replica_path + '.tmp')
+    # Registered after the export, so not in the replica
+    registry.register('v1:' + 'f' * 64, 'example.docx', 'jd')
+
+    replica = RegistryReplica(replica_path)
+    assert all(replica.lookup(fingerprint)['template'] == 'example.docx' for fingerprint in fingerprints)
+    assert replica.stats() == {'filtered': 0, 'lookups': 200}
+    unknown = [f'v1:{i:064x}' for i in range(1000, 2000)]
+    assert all(replica.lookup(fingerprint) is None for fingerprint in unknown)
+    assert replica.lookup(None) is None
+    stats = replica.stats()
+    # Nearly every unknown fingerprint is rejected by the Bloom filter without a query
+    assert stats['filtered'] > 950
+    assert stats['filtered'] + stats['lookups'] == 1201
+    assert replica.lookup('v1:' + 'f' * 64) is None
+    replica.close()
+    registry.close()
+
+
+def test_registry_compact_keeps_records(tmp_path):
+    from desktop_app.utils.document_registry import DocumentRegistry
+
+    path = str(tmp_path / 'documents.sqlite')
+    registry = DocumentRegistry(path)
+    registry.register_many([(f'v1:{i:064x}', 'example.docx', 'jd', None) for i in range(500)])
+    assert os.path.getsize(path + '-wal') > 0
+
+    registry.compact()
+    assert os.path.getsize(path + '-wal') == 0
+    assert len(registry) == 500
+    assert registry.lookup(f'v1:{499:064x}') is not None
+    registry.close()
+    # A fresh connection sees everything from the main file
+    reopened = DocumentRegistry(path, readonly=True)
+    assert len(reopened) == 500
+    reopened.close()
+
+
+# Signature images
+
+def image_bytes(img):
+    import io
+
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def palette_signature(transparent=True):
+    from PIL import Image, ImageDraw
+
+    img = Image.new('P', (400, 200), 0)
+    img.putpalette([255, 255, 255, 20, 20, 120] + [0] * 762)
+    ImageDraw.Draw(img).rectangle([100, 50, 299, 149], fill=1)
+    if transparent:
+        img.info['transparency'] = 0
+    return img
+
+
+def test_has_transparency():
+    from PIL import Image
+    from desktop_app.utils.signature_image import has_transparency
+
+    rgba = Image.new('RGBA', (50, 20), (0, 0, 0, 255))
+    assert not has_transparency(rgba)
+    rgba.putpixel((10, 10), (0, 0, 0, 0))
+    assert has_transparency(rgba)
+    assert has_transparency(palette_signature())
+    assert not has_transparency(palette_signature(transparent=False))
+    assert not has_transparency(Image.new('RGB', (50, 20), (255, 255, 255)))
+    assert not has_transparency(Image.new('L', (50, 20), 255))
+
+
+def test_prepare_signature_trims_and_shrinks():
+    import io
+    from PIL import Image
+    from tests.conftest import signature_png
+    from desktop_app.utils.signature_image import SIGNATURE_BOX, TARGET_DPI, prepare_signature
+
+    max_size = (round(SIGNATURE_BOX[2] / 72 * TARGET_DPI), round(SIGNATURE_BOX[3] / 72 * TARGET_DPI))
+
+    # RGBA: the transparent border around the stroke is cut off
+    with Image.open(io.BytesIO(prepare_signature(signature_png()))) as img:
+        assert img.mode == 'RGBA'
+        assert img.width < 600 and img.height < 200
+        assert img.getchannel('A').getbbox() == (0, 0) + img.size
+
+    # Palette with a transparent background: cropped to the opaque rectangle
+    with Image.open(io.BytesIO(prepare_signature(image_bytes(palette_signature())))) as img:
+        assert img.mode == 'RGBA'
+        assert img.size == (200, 100)
+        assert img.getpixel((100, 50)) == (20, 20, 120, 255)
+
+    # Opaque: nothing to trim, only reduced to the box's print resolution
+    opaque = Image.new('RGB', (3000, 1000), (255, 255, 255))
+    with Image.open(io.BytesIO(prepare_signature(image_bytes(opaque)))) as img:
+        assert img.width == max_size[0] and img.height <= max_size[1]
+        assert img.getchannel('A').getextrema() == (255, 255)
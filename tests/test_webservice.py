@@ -0,0 +1,217 @@
+import io
+import json
+import tarfile
+
+import pytest
+
+from tests.conftest import PASSWORD, SIGNER, build_workspace
+
+
+@pytest.fixture(scope='module')
+def service(tmp_path_factory):
+    # The web service reads its configuration once, at import
+    from desktop_app.config.config_manager import ConfigManager
+    from webservice import verification
+
+    webservice = {'max_upload_mb': '1', 'max_batch_mb': '2', 'verify_workers': '1', 'registry': ''}
+    config_path = build_workspace(tmp_path_factory.mktemp('service'), Webservice=webservice)
+    verification._config = ConfigManager(config_path)
+    verification._result_cache = verification._root_cache = None
+    verification.load_keys()
+    verification.load_registry()
+    import webservice.app  # loads the keys again, from the config above
+
+    yield verification.get_config()
+    verification.shutdown_verify_pool()
+
+
+@pytest.fixture
+def client(service):
+    from webservice.app import app
+
+    return app.test_client()
+
+
+@pytest.fixture(scope='module')
+def documents(service, tmp_path_factory):
+    # Two signed documents as bytes
+    from desktop_app.models.author import Author
+    from desktop_app.utils.pdf_creator import render_document
+
+    directory = tmp_path_factory.mktemp('documents')
+    author = Author.load(SIGNER, service)
+    signature = author.decrypt_signature(service, PASSWORD)
+    documents = []
+    for i in range(2):
+        path, _ = render_document(service, 'example.docx', {'ClientName': f'Client {i}'}, author,
+                                  str(directory / f'{i}.pdf'), signature)
+        with open(path, 'rb') as f:
+            documents.append(f.read())
+    return documents
+
+
+def tampered(document):
+    data = bytearray(document)
+    data[len(data) // 3] ^= 0x01
+    return bytes(data)
+
+
+def ndjson(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_form_upload_valid(client, documents):
+    response = client.post('/', data={'file': (io.BytesIO(documents[0]), 'a.pdf')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert 'Jane Doe' in response.get_data(as_text=True)
+
+
+def test_form_upload_not_a_pdf_is_415(client):
+    response = client.post('/', data={'file': (io.BytesIO(b'GIF89a....'), 'a.pdf')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 415
+
+
+def test_form_upload_too_large_is_413(client):
+    data = b'%PDF-1.4\n' + b'0' * (1024 * 1024)
+    response = client.post('/', data={'file': (io.BytesIO(data), 'a.pdf')}, content_type='multipart/form-data')
+    assert response.status_code == 413
+
+
+def test_batch_multipart(client, documents):
+    response = client.post('/api/verify', data={
+        'a': (io.BytesIO(documents[0]), 'a.pdf'),
+        'b': (io.BytesIO(tampered(documents[1])), 'b.pdf'),
+        'c': (io.BytesIO(b'text'), 'c.txt'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = ndjson(response)
+    results = {line['name']: line for line in lines[:-1]}
+    assert results['a.pdf']['valid'] and results['a.pdf']['author'] == 'Jane Doe'
+    assert not results['b.pdf']['valid']
+    assert not results['c.txt']['valid']
+    assert lines[-1] == {'summary': {'files': 3, 'valid': 1}}
+
+
+def test_batch_tar(client, documents):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+        for name, data in (('one.pdf', documents[0]), ('two.pdf', documents[1])):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    response = client.post('/api/verify', data=archive.getvalue(), content_type='application/gzip')
+    lines = ndjson(response)
+    assert sorted(line['name'] for line in lines[:-1]) == ['one.pdf', 'two.pdf']
+    assert all(line['valid'] for line in lines[:-1])
+    assert lines[-1] == {'summary': {'files': 2, 'valid': 2}}
+
+
+def test_batch_wrong_content_type_is_415(client):
+    response = client.post('/api/verify', data=b'{}', content_type='application/json')
+    assert response.status_code == 415
+
+
+def test_batch_too_large_is_413(client):
+    response = client.post('/api/verify', data=b'0' * (3 * 1024 * 1024), content_type='application/x-tar')
+    assert response.status_code == 413
+
+
+def test_batch_malformed_multipart_gives_error_line(client):
+    body = b'--xx\r\nnot a header line\r\n\r\ndata\r\n--xx--\r\n'
+    response = client.post('/api/verify', data=body, content_type='multipart/form-data; boundary=xx')
+    lines = ndjson(response)
+    assert 'error' in lines[0]
+    assert lines[-1] == {'summary': {'files': 0, 'valid': 0}}
+
+
+def test_metrics_counters(client, documents):
+    client.post('/api/verify', data={'a': (io.BytesIO(documents[0]), 'a.pdf')}, content_type='multipart/form-data')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'doccreator_verifications_total{endpoint="api",result="valid"}' in text
+    for name in ('doccreator_verification_cache_hits_total', 'doccreator_verification_cache_misses_total',
+                 'doccreator_verified_roots_hits_total'):
+        assert f'# TYPE {name} counter\n{name} ' in text
+    assert '# TYPE doccreator_verification_cache_entries gauge' in text
+
+
+# Result cache and key reloads
+
+def upload(document):
+    from webservice.verification import UploadVerifier
+
+    verifier = UploadVerifier()
+    verifier.update(document)
+    return verifier
+
+
+def test_result_cache_hit(service, documents):
+    from webservice.verification import get_result_cache
+
+    cache = get_result_cache()
+    cache.clear()
+    before = cache.stats()
+    first = upload(documents[0]).finish()
+    second = upload(documents[0]).finish()
+    after = cache.stats()
+    assert first == second and first['valid']
+    assert (after['misses'] - before['misses'], after['hits'] - before['hits']) == (1, 1)
+
+
+def test_result_cache_entries_expire():
+    from webservice.cache import LRUCache
+
+    now = [0.0]
+    cache = LRUCache(10, 60, clock=lambda: now[0])
+    cache.put('key', 'result')
+    now[0] = 59.0
+    assert cache.get('key') == 'result'
+    now[0] = 60.0
+    assert cache.get('key') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_reload_clears_the_result_cache(service, documents):
+    from webservice.verification import get_result_cache, load_keys
+
+    upload(documents[0]).finish()
+    assert len(get_result_cache()) > 0
+    load_keys()
+    assert len(get_result_cache()) == 0
+
+
+def test_sighup_reloads_outside_the_handler(service, documents):
+    import os
+    import signal
+    import time
+    from webservice import verification
+
+    if not hasattr(signal, 'SIGHUP'):
+        pytest.skip('no SIGHUP')
+    upload(documents[0]).finish()
+    generation = verification._keys_generation
+    os.kill(os.getpid(), signal.SIGHUP)
+    deadline = time.monotonic() + 10
+    while verification._keys_generation == generation and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert verification._keys_generation == generation + 1
+    assert len(verification.get_result_cache()) == 0
+
+
+def test_key_reload_during_batch(service, documents):
+    from webservice import verification
+
+    verification.get_result_cache().clear()
+    verification.get_root_cache().clear()
+
+    def uploads():
+        for i, document in enumerate(documents * 2):
+            if i == 2:
+                verification.load_keys()
+            yield f'{i}.pdf', upload(document)
+
+    results = list(verification.verify_many(uploads()))
+    assert sorted(result['name'] for result in results) == ['0.pdf', '1.pdf', '2.pdf', '3.pdf']
+    assert all(result['valid'] for result in results)
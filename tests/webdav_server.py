@@ -0,0 +1,94 @@
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+# Local stand-in for the parts of Nextcloud's WebDAV API the archive uses:
+# MKCOL, PUT, DELETE and chunked uploads (PUT chunks into an upload folder,
+# then MOVE its .file into place). Files are kept under root.
+
+
+class WebDavHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def local_path(self, url=None):
+        return os.path.join(self.server.root, unquote(urlsplit(url or self.path).path).lstrip('/'))
+
+    def reply(self, status):
+        with self.server.lock:
+            self.server.requests.append((self.command, unquote(urlsplit(self.path).path)))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_MKCOL(self):
+        path = self.local_path()
+        if os.path.isdir(path):
+            return self.reply(405)
+        if not os.path.isdir(os.path.dirname(path)):
+            return self.reply(409)
+        os.mkdir(path)
+        self.reply(201)
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            status = self.server.put_errors.pop(0) if self.server.put_errors else None
+        if status is not None:
+            return self.reply(status)
+        path = self.local_path()
+        if not os.path.isdir(os.path.dirname(path)):
+            return self.reply(409)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.reply(201)
+
+    def do_MOVE(self):
+        source, destination = self.local_path(), self.local_path(self.headers['Destination'])
+        if os.path.basename(source) == '.file':
+            upload_dir = os.path.dirname(source)
+            with open(destination, 'wb') as out:
+                for name in sorted(os.listdir(upload_dir)):
+                    with open(os.path.join(upload_dir, name), 'rb') as f:
+                        out.write(f.read())
+            shutil.rmtree(upload_dir)
+        else:
+            os.replace(source, destination)
+        self.reply(201)
+
+    def do_DELETE(self):
+        shutil.rmtree(self.local_path(), ignore_errors=True)
+        self.reply(204)
+
+
+class WebDavServer(ThreadingHTTPServer):
+    # Runs on a free local port until stop(); files_url and uploads_url are
+    # the user's WebDAV roots, as in [Nextcloud] webdav_url and uploads_url
+    daemon_threads = True
+
+    def __init__(self, root, username='user'):
+        super().__init__(('127.0.0.1', 0), WebDavHandler)
+        self.root = root
+        self.lock = threading.Lock()
+        self.requests = []
+        # Statuses returned by the next PUT requests instead of storing the file
+        self.put_errors = []
+        base = f"http://127.0.0.1:{self.server_address[1]}/remote.php/dav"
+        self.files_url = f"{base}/files/{username}"
+        self.uploads_url = f"{base}/uploads/{username}"
+        for kind in ('files', 'uploads'):
+            os.makedirs(os.path.join(root, 'remote.php', 'dav', kind, username), exist_ok=True)
+        self.files_dir = os.path.join(root, 'remote.php', 'dav', 'files', username)
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,21 +1,222 @@
-from flask import Flask, request, render_template
-from webservice.verification import verify_pdf
+import json
+import signal
+import sqlite3
+import tarfile
+import threading
+from flask import Flask, Response, request, render_template, jsonify, stream_with_context
+from desktop_app.utils import instrumentation
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, File, Data, Epilogue, NeedData
+from webservice.verification import (UploadVerifier, UploadError, max_upload_size, max_batch_size, get_config,
+                                     load_keys, load_registry, get_registry, get_result_cache, get_root_cache,
+                                     verify_many)
+
+CHUNK_SIZE = 64 * 1024
+TAR_TYPES = ('application/x-tar', 'application/gzip', 'application/x-gzip', 'application/x-gtar')
 
 app = Flask(__name__)
+# Room for the multipart envelope around the file itself
+app.config['MAX_CONTENT_LENGTH'] = max_upload_size() + CHUNK_SIZE
+
+reload_requested = threading.Event()
+
+def reload_keys():
+    try:
+        load_keys()
+    except (OSError, ValueError):
+        # Keep serving with the previous keys if the new set cannot be read
+        pass
+    try:
+        load_registry()
+    except sqlite3.Error:
+        pass
+
+def reload_worker():
+    while True:
+        reload_requested.wait()
+        reload_requested.clear()
+        reload_keys()
+
+def request_reload(signum, frame):
+    # The reload itself runs on reload_worker's thread: a signal handler
+    # interrupts the main thread anywhere, also while it holds one of the
+    # locks load_keys() takes
+    reload_requested.set()
+
+# Trusted keys and the registry replica are loaded once at startup; SIGHUP reloads them
+instrumentation.setup_logging(get_config())
+load_keys()
+load_registry()
+try:
+    signal.signal(signal.SIGHUP, request_reload)
+except (AttributeError, ValueError):
+    # No SIGHUP on Windows, and handlers can only be set from the main thread
+    pass
+else:
+    threading.Thread(target=reload_worker, daemon=True).start()
+
+def iter_upload(field_name=None):
+    # Yields ('file', filename), ('data', chunk) and ('end', None) for the
+    # named file field, or for every file when no name is given, parsing the
+    # multipart body straight from the request stream instead of letting
+    # Flask spool it into request.files.
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        raise UploadError('Keine Datei hochgeladen')
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    in_field = False
+    while True:
+        chunk = request.stream.read(CHUNK_SIZE)
+        decoder.receive_data(chunk or None)
+        event = next_event(decoder)
+        while not isinstance(event, NeedData):
+            if isinstance(event, File):
+                in_field = field_name is None or event.name == field_name
+                if in_field:
+                    yield 'file', event.filename
+            elif isinstance(event, Data):
+                if in_field:
+                    if event.data:
+                        yield 'data', event.data
+                    if not event.more_data:
+                        in_field = False
+                        yield 'end', None
+            elif isinstance(event, Epilogue):
+                return
+            else:
+                in_field = False
+            event = next_event(decoder)
+        if not chunk:
+            return
+
+def next_event(decoder):
+    # A malformed body is an upload error, also once the response has started
+    try:
+        return decoder.next_event()
+    except ValueError:
+        raise UploadError('Der Multipart-Inhalt ist fehlerhaft.')
+
+def iter_tar():
+    # Same events for the regular files of a tar archive (optionally
+    # compressed), read member by member without seeking
+    with tarfile.open(fileobj=request.stream, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            yield 'file', member.name
+            data = archive.extractfile(member)
+            for chunk in iter(lambda: data.read(CHUNK_SIZE), b''):
+                yield 'data', chunk
+            yield 'end', None
+
+def count_result(result, endpoint):
+    instrumentation.count('doccreator_verifications_total', endpoint=endpoint,
+                          result='valid' if result['valid'] else 'invalid')
+
+def iter_verifiers(events):
+    # Feeds each file into its own UploadVerifier and yields (name, verifier)
+    # once the file is complete, or (name, message) if it was rejected
+    name = verifier = error = None
+    for kind, value in events:
+        if kind == 'file':
+            name, verifier, error = value, UploadVerifier(), None
+            if not value.lower().endswith('.pdf'):
+                error = 'Nur PDF-Dateien können geprüft werden'
+        elif kind == 'data':
+            if error is None:
+                try:
+                    verifier.update(value)
+                except UploadError as e:
+                    error = str(e)
+        else:
+            if error is None:
+                instrumentation.count('doccreator_verified_bytes_total', verifier.size)
+            yield name, error or verifier
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        if 'file' not in request.files:
-            return 'Keine Datei hochgeladen', 400
-        file = request.files['file']
-        if file.filename == '':
-            return 'Keine Datei ausgewählt', 400
-        if file and file.filename.endswith('.pdf'):
-            result = verify_pdf(file)
-            return render_template('result.html', result=result)
+        verifier = None
+        try:
+            for kind, value in iter_upload('file'):
+                if kind == 'file':
+                    if value == '':
+                        return 'Keine Datei ausgewählt', 400
+                    if not value.endswith('.pdf'):
+                        return 'Nur PDF-Dateien können geprüft werden', 400
+                    verifier = UploadVerifier()
+                elif kind == 'data':
+                    verifier.update(value)
+            if verifier is None:
+                return 'Keine Datei hochgeladen', 400
+            instrumentation.count('doccreator_verified_bytes_total', verifier.size)
+            result = verifier.finish()
+        except UploadError as e:
+            instrumentation.count('doccreator_rejected_uploads_total', endpoint='form', status=e.status)
+            return str(e), e.status
+        count_result(result, 'form')
+        return render_template('result.html', result=result)
     return render_template('upload.html')
 
+@app.route('/api/verify', methods=['POST'])
+def verify_batch():
+    # Verifies many PDFs from one multipart upload or tar stream and answers
+    # with one JSON line per file as soon as its result is known
+    request.max_content_length = max_batch_size()
+    if request.mimetype == 'multipart/form-data':
+        events = iter_upload()
+    elif request.mimetype in TAR_TYPES:
+        events = iter_tar()
+    else:
+        return jsonify(error='Erwartet multipart/form-data oder ein tar-Archiv'), 415
+    # Opening the stream checks the declared length, while a 413 can still be sent
+    request.stream
+
+    def generate():
+        files = valid = 0
+        try:
+            for result in verify_many(iter_verifiers(events)):
+                files += 1
+                valid += result['valid']
+                count_result(result, 'api')
+                yield json.dumps(result, ensure_ascii=False) + '\n'
+        except (UploadError, tarfile.TarError) as e:
+            yield json.dumps({'error': str(e)}, ensure_ascii=False) + '\n'
+        except RequestEntityTooLarge:
+            yield json.dumps({'error': 'Die Dateien sind zu groß.'}, ensure_ascii=False) + '\n'
+        yield json.dumps({'summary': {'files': files, 'valid': valid}}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/stats')
+def stats():
+    registry = get_registry()
+    return jsonify(verification_cache=get_result_cache().stats(),
+                   verified_roots=get_root_cache().stats(),
+                   registry=registry.stats() if registry is not None else None)
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text format: stage latency histograms (with [Logging] spans
+    # enabled), verification, cache and registry counters, and cache sizes
+    cache = get_result_cache().stats()
+    roots = get_root_cache().stats()
+    totals = {
+        'doccreator_verification_cache_hits_total': cache['hits'],
+        'doccreator_verification_cache_misses_total': cache['misses'],
+        'doccreator_verified_roots_hits_total': roots['hits'],
+    }
+    gauges = {
+        'doccreator_verification_cache_entries': cache['size'],
+        'doccreator_verified_roots_entries': roots['size'],
+    }
+    registry = get_registry()
+    if registry is not None:
+        registry_stats = registry.stats()
+        totals['doccreator_registry_lookups_total'] = registry_stats['lookups']
+        totals['doccreator_registry_filtered_total'] = registry_stats['filtered']
+    return Response(instrumentation.prometheus_text(gauges, totals), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run(debug=True)
-
@@ -0,0 +1,387 @@
+import glob
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PyPDF2 import PdfFileReader
+from PyPDF2.utils import PdfReadError
+from desktop_app.config.config_manager import ConfigManager
+from desktop_app.utils.document_registry import RegistryReplica
+from desktop_app.utils import instrumentation
+from desktop_app.utils.instrumentation import span
+from desktop_app.utils.fingerprint import FINGERPRINT_PREFIX, compute_fingerprint, stored_fingerprint
+from desktop_app.utils.pdf_signature import (SignatureError, SignatureVerifier, signature_digest,
+                                             verified_root_key, verify_signature_digest, REASON_MISSING,
+                                             REASON_MODIFIED, REASON_UNKNOWN_KEY, REASON_INVALID)
+from desktop_app.utils.signing import load_public_key, key_id
+from webservice.cache import LRUCache
+
+SIGNATURE_REASONS = {
+    REASON_MISSING: 'Das Dokument enthält keine Signatur von DocCreator.',
+    REASON_MODIFIED: 'Das Dokument wurde nach dem Signieren verändert.',
+    REASON_UNKNOWN_KEY: 'Das Dokument wurde nicht mit unserem Schlüssel signiert.',
+    REASON_INVALID: 'Die Signatur passt nicht zum Dokument.',
+}
+
+PDF_MAGIC = b'%PDF-'
+DEFAULT_MAX_UPLOAD_MB = 50
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_ROOT_CACHE_SIZE = 1000
+DEFAULT_MAX_BATCH_MB = 1024
+
+_config = None
+_keys = None
+# Counts key reloads, so results checked with replaced keys are not cached
+_keys_generation = 0
+_keys_lock = threading.Lock()
+_result_cache = None
+_root_cache = None
+_registry = None
+_verify_pool = None
+# Batches running on each pool; a replaced pool is shut down when its last batch ends
+_verify_pool_users = {}
+_verify_pool_lock = threading.Lock()
+
+def get_config():
+    global _config
+    if _config is None:
+        _config = ConfigManager(os.environ.get('DOCCREATOR_CONFIG', 'config.ini'))
+    return _config
+
+def load_keys():
+    # Parses every trusted public key once. Called at startup and again when
+    # the service is told to reload; cached results are dropped with the old keys.
+    global _keys, _keys_generation
+    config = get_config()
+    paths = [config.get('Paths', 'public_key')]
+    keys_dir = config.get('Webservice', 'trusted_keys_dir', fallback='')
+    if keys_dir:
+        paths.extend(sorted(glob.glob(os.path.join(keys_dir, '*.pem'))))
+
+    keys = {}
+    for path in paths:
+        public_key = load_public_key(path)
+        keys[key_id(public_key)] = public_key
+    with _keys_lock:
+        _keys = keys
+        _keys_generation += 1
+        get_result_cache().clear()
+        get_root_cache().clear()
+    # Pool workers hold their own copy of the keys, so start fresh ones
+    shutdown_verify_pool()
+    return keys
+
+def load_registry():
+    # Opens the read-only registry replica named by [Webservice] registry.
+    # Called at startup and on reload, like the keys.
+    global _registry
+    path = get_config().get('Webservice', 'registry', fallback='')
+    registry = RegistryReplica(path) if path else None
+    old, _registry = _registry, registry
+    if old is not None:
+        old.close()
+    return registry
+
+def get_registry():
+    return _registry
+
+def check_registry(result):
+    # When a registry is configured, only documents recorded there as issued
+    # by us are accepted, even if the signature itself is valid
+    result['issued'] = None
+    if _registry is not None and result['valid']:
+        result['issued'] = _registry.lookup(result['fingerprint'])
+        if result['issued'] is None:
+            result['valid'] = False
+            result['reasons'].append('Das Dokument ist nicht als von uns ausgestellt registriert.')
+    return result
+
+def get_keys():
+    if _keys is None:
+        load_keys()
+    return _keys
+
+def get_result_cache():
+    global _result_cache
+    if _result_cache is None:
+        config = get_config()
+        _result_cache = LRUCache(
+            config.getint('Webservice', 'cache_size', fallback=DEFAULT_CACHE_SIZE),
+            config.getint('Webservice', 'cache_ttl', fallback=DEFAULT_CACHE_TTL))
+    return _result_cache
+
+def get_root_cache():
+    # Merkle roots of batch-signed documents whose signature was checked; the
+    # other documents of the batch then verify by hashing their proof
+    global _root_cache
+    if _root_cache is None:
+        config = get_config()
+        _root_cache = LRUCache(
+            config.getint('Webservice', 'root_cache_size', fallback=DEFAULT_ROOT_CACHE_SIZE),
+            config.getint('Webservice', 'cache_ttl', fallback=DEFAULT_CACHE_TTL))
+    return _root_cache
+
+def get_verify_pool():
+    # Public key operations are CPU-bound, so batches are verified in worker
+    # processes, one per core unless [Webservice] verify_workers says otherwise
+    global _verify_pool
+    with _verify_pool_lock:
+        if _verify_pool is None:
+            workers = get_config().getint('Webservice', 'verify_workers', fallback=0) or os.cpu_count() or 1
+            _verify_pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_verify_worker)
+        return _verify_pool
+
+def acquire_verify_pool():
+    # The current pool for one batch, which keeps it until release_verify_pool(),
+    # also when the keys are reloaded meanwhile
+    pool = get_verify_pool()
+    with _verify_pool_lock:
+        _verify_pool_users[pool] = _verify_pool_users.get(pool, 0) + 1
+    return pool
+
+def release_verify_pool(pool):
+    with _verify_pool_lock:
+        _verify_pool_users[pool] -= 1
+        retired = not _verify_pool_users[pool] and pool is not _verify_pool
+        if not _verify_pool_users[pool]:
+            del _verify_pool_users[pool]
+    if retired:
+        pool.shutdown(wait=False)
+
+def _init_verify_worker():
+    global _verify_pool
+    # A forked worker inherits the parent's pool handle, which is not its own to use
+    _verify_pool = None
+    load_keys()
+
+def shutdown_verify_pool():
+    # Replaces the pool; one that batches still run on is shut down by the last of them
+    global _verify_pool
+    with _verify_pool_lock:
+        pool, _verify_pool = _verify_pool, None
+        in_use = pool in _verify_pool_users
+    if pool is not None and not in_use:
+        pool.shutdown(wait=False)
+
+def max_upload_size():
+    return get_config().getint('Webservice', 'max_upload_mb', fallback=DEFAULT_MAX_UPLOAD_MB) * 1024 * 1024
+
+def max_batch_size():
+    return get_config().getint('Webservice', 'max_batch_mb', fallback=DEFAULT_MAX_BATCH_MB) * 1024 * 1024
+
+def new_result():
+    return {
+        'valid': False,
+        'fingerprint': None,
+        'author': None,
+        'creation_date': None,
+        'issued': None,
+        'reasons': [],
+    }
+
+def signature_result(signature, keys=None):
+    # Outcome of the public key check for a signature whose byte ranges are
+    # already hashed. Outcomes are cached by content digest, so verifying the
+    # same document again costs the hash pass but no public key operation.
+    cache = get_result_cache()
+    cache_key = result_cache_key(signature)
+    result = cache.get(cache_key)
+    if result is None:
+        with span('verify.signature'):
+            result = verify_result(signature, keys)
+        cache.put(cache_key, result)
+    return dict(result, reasons=list(result['reasons']))
+
+def result_cache_key(signature):
+    return hashlib.sha256(signature['digest'] + signature['contents']).digest()
+
+def verify_result(signature, keys=None):
+    result = new_result()
+    try:
+        verify_signature_digest(signature, keys or get_keys(), get_root_cache())
+        # These come from the signature dictionary and are covered by the
+        # signature. The signed byte ranges include every stream the
+        # fingerprint hashes, so a valid signature also vouches for it and an
+        # upload need not be parsed to recompute it; it only has to be there.
+        result['fingerprint'] = signature['fingerprint']
+        result['author'] = signature['name']
+        result['creation_date'] = signature['signed_at']
+        if not (signature['fingerprint'] or '').startswith(FINGERPRINT_PREFIX):
+            result['reasons'].append('Das Dokument enthält keinen Fingerabdruck von DocCreator.')
+        else:
+            result['valid'] = True
+    except SignatureError as e:
+        result['reasons'].append(SIGNATURE_REASONS[e.reason])
+    return result
+
+def timed_verify_result(signature):
+    # Runs in a pool worker; the time is returned so the parent process can record it
+    start = time.perf_counter()
+    result = verify_result(signature)
+    return result, time.perf_counter() - start
+
+def verify_many(uploads):
+    # uploads yields (name, UploadVerifier or error message) as each file of a
+    # batch has been received. Cache hits, documents of an already verified
+    # Merkle root and failed uploads are answered at once; the rest are
+    # verified on the process pool. Results are yielded in completion order
+    # while later files are still being read. A key reload during the batch
+    # does not stop it: it finishes on the pool it started with, but results
+    # of the old keys are no longer cached.
+    pool = acquire_verify_pool()
+    try:
+        yield from _verify_many(uploads, pool)
+    finally:
+        release_verify_pool(pool)
+
+def _verify_many(uploads, pool):
+    cache = get_result_cache()
+    roots = get_root_cache()
+    generation = _keys_generation
+    pending = {}
+
+    def completed(return_when):
+        done, _ = wait(list(pending), timeout=None if return_when else 0,
+                       return_when=return_when or FIRST_COMPLETED)
+        for future in done:
+            name, cache_key, root_key = pending.pop(future)
+            result, seconds = future.result()
+            if instrumentation.enabled():
+                instrumentation.observe('verify.signature', seconds)
+            if generation != _keys_generation:
+                yield check_registry(dict(result, name=name, reasons=list(result['reasons'])))
+                continue
+            cache.put(cache_key, result)
+            if root_key is not None and result['valid']:
+                # The pool worker checked the root; later documents of its batch are verified here
+                roots.put(root_key, True)
+            yield check_registry(dict(result, name=name, reasons=list(result['reasons'])))
+
+    for name, upload in uploads:
+        yield from completed(None)
+        if isinstance(upload, str):
+            yield dict(new_result(), name=name, reasons=[upload])
+            continue
+        try:
+            signature = upload.signature()
+        except UploadError as e:
+            yield dict(new_result(), name=name, reasons=[str(e)])
+            continue
+        except SignatureError as e:
+            yield dict(new_result(), name=name, reasons=[SIGNATURE_REASONS[e.reason]])
+            continue
+
+        cache_key = result_cache_key(signature)
+        result = cache.get(cache_key)
+        root_key = verified_root_key(signature)
+        if result is None and root_key is not None and roots.contains(root_key):
+            result = verify_result(signature)
+            cache.put(cache_key, result)
+        if result is not None:
+            yield check_registry(dict(result, name=name, reasons=list(result['reasons'])))
+        else:
+            pending[pool.submit(timed_verify_result, signature)] = (name, cache_key, root_key)
+
+    while pending:
+        yield from completed(FIRST_COMPLETED)
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class UploadVerifier:
+    # Verifies an upload while it is being received. Nothing is buffered
+    # except the tail window of the signature check, so uploads are never
+    # stored in memory or on disk.
+
+    def __init__(self, keys=None, max_size=None):
+        self.keys = keys or get_keys()
+        self.max_size = max_size or max_upload_size()
+        self._signature = SignatureVerifier(self.keys)
+        self._head = b''
+        # Time spent hashing, kept apart from waiting for the upload; only measured with spans enabled
+        self._timed = instrumentation.enabled()
+        self._started = time.perf_counter()
+        self._hash_seconds = 0.0
+
+    @property
+    def size(self):
+        return self._signature.size
+
+    def update(self, data):
+        if len(self._head) < len(PDF_MAGIC):
+            self._head = (self._head + data)[:len(PDF_MAGIC)]
+            if not PDF_MAGIC.startswith(self._head):
+                raise UploadError('Die Datei ist kein PDF-Dokument.', 415)
+        if self.size + len(data) > self.max_size:
+            raise UploadError('Die Datei ist zu groß.', 413)
+        if self._timed:
+            start = time.perf_counter()
+            self._signature.update(data)
+            self._hash_seconds += time.perf_counter() - start
+        else:
+            self._signature.update(data)
+
+    def signature(self):
+        # The embedded signature with its byte ranges hashed, ready for the public key check
+        if self._head != PDF_MAGIC:
+            raise UploadError('Die Datei ist kein PDF-Dokument.', 415)
+        if not self._timed:
+            return self._signature.digest()
+        start = time.perf_counter()
+        try:
+            return self._signature.digest()
+        finally:
+            end = time.perf_counter()
+            self._hash_seconds += end - start
+            instrumentation.observe('verify.read', end - self._started - self._hash_seconds, self.size)
+            instrumentation.observe('verify.hash', self._hash_seconds, self.size)
+
+    def finish(self):
+        try:
+            signature = self.signature()
+        except SignatureError as e:
+            result = new_result()
+            result['reasons'].append(SIGNATURE_REASONS[e.reason])
+            return result
+        return check_registry(signature_result(signature, self.keys))
+
+def verify_pdf(pdf_file, keys=None):
+    # Verifies a complete, seekable file. Unlike UploadVerifier it can also
+    # recompute the fingerprint to tell whether the page content was changed.
+    stream = getattr(pdf_file, 'stream', pdf_file)
+    keys = keys or get_keys()
+    try:
+        with span('verify.hash'):
+            signature = signature_digest(stream, keys)
+        result = signature_result(signature, keys)
+        if result['valid']:
+            return check_registry(result)
+    except SignatureError as e:
+        result = new_result()
+        result['reasons'].append(SIGNATURE_REASONS[e.reason])
+
+    try:
+        stream.seek(0)
+        reader = PdfFileReader(stream, strict=False)
+        expected = stored_fingerprint(reader)
+        info = reader.getDocumentInfo() or {}
+        if expected is None:
+            result['reasons'].append('Das Dokument enthält keinen Fingerabdruck von DocCreator.')
+            return result
+        # Recomputed page by page from the file, no text extraction
+        with span('verify.fingerprint'):
+            fingerprint = compute_fingerprint(reader)
+    except (PdfReadError, ValueError, KeyError) as e:
+        result['reasons'].append(f'Die Datei ist kein lesbares PDF-Dokument ({e}).')
+        return result
+
+    result['fingerprint'] = fingerprint
+    result['author'] = info.get('/Author')
+    result['creation_date'] = info.get('/CreationDate')
+    if fingerprint != expected:
+        result['reasons'].append('Der Inhalt des Dokuments wurde nach der Erstellung verändert.')
+    return result